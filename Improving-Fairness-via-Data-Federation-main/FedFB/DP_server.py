@@ -8,7 +8,7 @@ from ray import tune
 import torch.nn as nn
 
 ################## MODEL SETTING ########################
-DEVICE = 'cuda:5'
+DEVICE = 'cuda:5' if torch.cuda.is_available() else 'cpu'
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
 #########################################################
 
@@ -6,7 +6,7 @@ from scipy.stats import multivariate_normal
 import torch, random, copy, os
 
 ################## MODEL SETTING ########################
-DEVICE = 'cuda:5'
+DEVICE = 'cuda:5' if torch.cuda.is_available() else 'cpu'
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
 #########################################################
 
@@ -1,5 +1,4 @@
 import os
-os.environ['CUDA_VISIBLE_DEVICES'] = "1, 2, 3, 4, 5, 6, 7"
 import argparse
 import logging
 import random
@@ -15,11 +14,14 @@ from tqdm import trange
 from experiments.new.pFedHN.pFedHN_models import LR, Constraint
 from experiments.new.pFedHN.node import BaseNodes
 from experiments.new.pFedHN.utils import seed_everything, set_logger, TP_FP_TN_FN, metrics
+from experiments.new.execution import add_execution_args, execution_from_args
+from experiments.new.dual import DualAscent
+from experiments.new.checkpoint import pack_optimizer_states, load_optimizer_states, pack_module_states, load_module_states, rng_state, set_rng_state, add_checkpoint_args, checkpoints_from_args
 from torch.utils.tensorboard import SummaryWriter
 warnings.filterwarnings("ignore")
 
-def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, device, fair, constraint, alpha, confusion, which_position):
-    curr_results, preds, true, a, f_a, m_a, eod, spd = evaluate(nodes, num_nodes, hnet, model, cnet, num_features, loss, device, fair, constraint, alpha, which_position)
+def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, ctx, fair, constraint, alpha, confusion, which_position):
+    curr_results, preds, true, a, f_a, m_a, eod, spd = evaluate(nodes, num_nodes, hnet, model, cnet, num_features, loss, ctx, fair, constraint, alpha, which_position)
     total_correct = sum([val['correct'] for val in curr_results.values()])
     total_samples = sum([val['total'] for val in curr_results.values()])
     avg_acc = total_correct / total_samples
@@ -29,7 +31,7 @@ def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, device,
     return curr_results, avg_acc, all_acc, f_a, m_a, eod, spd
 
 @torch.no_grad()
-def evaluate(nodes, num_nodes, global_model, models, cnets, num_features, loss, device, fair, constraints, alpha, which_position):
+def evaluate(nodes, num_nodes, global_model, models, cnets, num_features, loss, ctx, fair, constraints, alpha, which_position):
     results = defaultdict(lambda: defaultdict(list))
     preds = []
     true = []
@@ -42,24 +44,25 @@ def evaluate(nodes, num_nodes, global_model, models, cnets, num_features, loss,
         model = models[node_id]
         sd = global_model.state_dict()
         model.load_state_dict(sd)
-        model.to(device)
+        ctx.module(model)
 
         running_loss, running_correct, running_samples = 0, 0, 0
 
         curr_data = nodes.test_loaders[node_id]
 
         for batch_count, batch in enumerate(curr_data):
-            x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-            s = x[:, which_position].to(device)
+            x, y = ctx.batch(batch)
+            s = x[:, which_position]
 
-            true_client.extend(y.cpu().numpy())
-            queries_client.extend(x.cpu().numpy())
+            # numpy has no bfloat16, the host copies are upcast
+            true_client.extend(y.cpu().float().numpy())
+            queries_client.extend(x.cpu().float().numpy())
 
             pred, m_mu_q = model(x, s, y)
             pred_thresh = (pred > 0.5).long()
             pred_client.extend(pred_thresh.flatten().cpu().numpy())
 
-            correct = torch.eq(pred_thresh, y.unsqueeze(1)).type(torch.cuda.LongTensor)
+            correct = torch.eq(pred_thresh, y.unsqueeze(1)).long()
             running_correct += torch.count_nonzero(correct).item()
 
             running_samples += len(y)
@@ -80,8 +83,8 @@ def evaluate(nodes, num_nodes, global_model, models, cnets, num_features, loss,
 
     return results, preds, true, a, f_a, m_a, eod, spd
 
-def train(save_file_name, device, data_name,model_name,classes_per_node,num_nodes,steps,inner_steps,lr,inner_lr,wd,inner_wd, hyper_hid,n_hidden,bs, alpha,fair, which_position):
-    b = 1/alpha[0]
+def train(save_file_name, ctx, data_name,model_name,classes_per_node,num_nodes,steps,inner_steps,lr,inner_lr,wd,inner_wd, hyper_hid,n_hidden,bs, alpha,fair, which_position,
+          checkpoints=None, resume=False):
     avg_acc = [[] for i in range(num_nodes + 1)]
     all_eod =  [[] for i in range(num_nodes)]
     all_spd = [[] for i in range(num_nodes)]
@@ -95,7 +98,7 @@ def train(save_file_name, device, data_name,model_name,classes_per_node,num_node
     for i in range(1):
         seed_everything(0)
 
-        nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node)
+        nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node, pin_memory=ctx.pin_memory)
         num_features = len(nodes.features)
 
         total_data_length = 0
@@ -127,26 +130,40 @@ def train(save_file_name, device, data_name,model_name,classes_per_node,num_node
 
         # Set models for all clients
         for i in range(num_nodes):
-            models[i] = LR(input_size=num_features, bound=alphas[i], fairness=client_fairness[i])
-            constraints[i] = Constraint(fair=client_fairness[i], bound=alphas[i])
+            models[i] = ctx.module(LR(input_size=num_features, bound=alphas[i], fairness=client_fairness[i]))
+            constraints[i] = ctx.module(Constraint(fair=client_fairness[i], bound=alphas[i]))
             client_optimizers_theta[i] = torch.optim.Adam(models[i].parameters(), lr=inner_lr, weight_decay=inner_wd)
             if fair != 'none':
-                client_optimizers_lambda[i] = torch.optim.Adam(constraints[i].parameters(), lr=inner_lr,
-                                                               weight_decay=inner_wd)
+                client_optimizers_lambda[i] = DualAscent(constraints[i].parameters(), torch.optim.Adam(constraints[i].parameters(), lr=inner_lr,
+                                                               weight_decay=inner_wd),
+                                                         radius=constraints[i].bound)
 
-        global_model.to(device)
+        ctx.module(global_model)
 
         loss = torch.nn.BCELoss()
-        step_iter = trange(steps)
+
+        start_step = 0
+        state = checkpoints.load() if checkpoints is not None and resume else None
+        if state is not None:
+            start_step, sampled = state['step'], state['sampled']
+            alpha = alphas[sampled[-1]]
+            global_model.load_state_dict(state['global_model'])
+            load_module_states(models, state['models'])
+            load_module_states(constraints, state['constraints'])
+            load_optimizer_states(client_optimizers_theta, state['client_optimizers_theta'])
+            load_optimizer_states(client_optimizers_lambda, state['client_optimizers_lambda'])
+            set_rng_state(state['rng'])
+
+        step_iter = trange(start_step, steps)
 
         for step in step_iter:
 
             client_weights = []
             client_biases = []
             sampled = []
-            choices = [0, 1, 2, 3]
+            choices = list(range(num_nodes))
 
-            sample_precentage = random.choice([1,2,3,4])
+            sample_precentage = random.choice(range(1, num_nodes + 1))
             for j in range(sample_precentage):
                 node_id = random.choice(choices)
                 sampled.append(node_id)
@@ -156,12 +173,12 @@ def train(save_file_name, device, data_name,model_name,classes_per_node,num_node
                 model = models[node_id]
                 if fair != 'none':
                     constraint = constraints[node_id]
-                    constraint.to(device)
+                    ctx.module(constraint)
                 alpha=alphas[node_id]
 
                 sd = global_model.state_dict()
                 model.load_state_dict(sd)
-                model.to(device)
+                ctx.module(model)
                 model.train()
 
                 inner_optim_theta = client_optimizers_theta[node_id]
@@ -173,8 +190,8 @@ def train(save_file_name, device, data_name,model_name,classes_per_node,num_node
                         inner_optim_lambda.zero_grad()
 
                     batch = next(iter(nodes.train_loaders[node_id]))
-                    x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-                    s = x[:, which_position].to(device)
+                    x, y = ctx.batch(batch)
+                    s = x[:, which_position]
 
                     # train and update local
                     pred, m_mu_q = model(x, s, y)
@@ -191,23 +208,6 @@ def train(save_file_name, device, data_name,model_name,classes_per_node,num_node
                     inner_optim_theta.step()
 
                     if fair != 'none':
-                        constraint.lmbda.data = torch.clamp(constraint.lmbda.data, min=0)
-                        torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1)
-
-                        if torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1) > b:
-                            print(torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1))
-                            print(constraint.lmbda)
-                            exit(1)
-
-                        for i, item in enumerate(constraint.lmbda.data):
-                            if item < 0:
-                                print(constraint.lmbda)
-                                exit(2)
-
-                        for group in inner_optim_lambda.param_groups:
-                            for p in group['params']:
-                                p.grad = -1 * p.grad
-
                         inner_optim_lambda.step()
 
                 # delta theta and global updates
@@ -223,13 +223,24 @@ def train(save_file_name, device, data_name,model_name,classes_per_node,num_node
             for i, c in enumerate(sampled):
                 new_weights += ((client_data_length[c] / total_sampled_length) * client_weights[i].cpu())
                 new_bias += ((client_data_length[c] / total_sampled_length) * client_biases[i].cpu())
-            new_weights = (new_weights).to(device)
-            new_biases = (new_bias).to(device)
+            new_weights = (new_weights).to(ctx.device)
+            new_biases = (new_bias).to(ctx.device)
             global_model.fc1.weight.data = new_weights.data.clone()
             global_model.fc1.bias.data = new_biases.data.clone()
 
+            if checkpoints is not None and checkpoints.due(step):
+                checkpoints.save(step + 1, {
+                    'sampled': sampled,
+                    'global_model': global_model.state_dict(),
+                    'models': pack_module_states(models),
+                    'constraints': pack_module_states(constraints),
+                    'client_optimizers_theta': pack_optimizer_states(client_optimizers_theta),
+                    'client_optimizers_lambda': pack_optimizer_states(client_optimizers_lambda),
+                    'rng': rng_state(),
+                })
+
         step_results, avg_acc_all, all_acc, f_a, m_a, eod, spd = eval_model(
-            nodes, num_nodes, global_model, models, None, num_features, loss, device, confusion=False, fair=fair,
+            nodes, num_nodes, global_model, models, None, num_features, loss, ctx, confusion=False, fair=fair,
             constraint=constraints, alpha=alpha, which_position=which_position)
 
         logging.info(f"\n\nFinal Results | AVG Acc: {avg_acc_all:.4f}")
@@ -294,7 +305,6 @@ def main():
             parser.add_argument("--inner_wd", type=float, default=1e-10, help="inner weight decay")
             parser.add_argument("--embed_dim", type=int, default=10, help="embedding dim")
             parser.add_argument("--hyper_hid", type=int, default=100, help="hypernet hidden dim")
-            parser.add_argument("--gpu", type=int, default=5, help="gpu device ID")
             parser.add_argument("--eval_every", type=int, default=50, help="eval every X selected epochs")
             parser.add_argument("--save_path", type=str, default="/home/ancarey/FairFLHN/experiments/adult/results",
                                 help="dir path for output file")
@@ -307,17 +317,22 @@ def main():
             parser.add_argument("--save_file_name", type=str,
                                 default="/home/ancarey/FairFLHN/experiments/new/FedAvg/all-runs.txt")
 
+            add_execution_args(parser)
+            add_checkpoint_args(parser)
             args = parser.parse_args()
-            assert args.gpu <= torch.cuda.device_count()
             set_logger()
 
-            device = "cuda:4"
+            ctx = execution_from_args(args)
+            checkpoints = checkpoints_from_args(args)
+            if checkpoints is not None:
+                # one checkpoint dir per dataset/fairness run of the loop
+                checkpoints.ckpt_dir = os.path.join(args.ckpt_dir, f'{n}-{f}')
 
             args.classes_per_node = 2
 
             train(
                 save_file_name=args.save_file_name,
-                device=device,
+                ctx=ctx,
                 data_name=args.data_name,
                 model_name=args.model_name,
                 classes_per_node=args.classes_per_node,
@@ -333,7 +348,9 @@ def main():
                 bs=args.batch_size,
                 alpha=args.alpha,
                 fair=args.fair,
-                which_position=args.which_position)
+                which_position=args.which_position,
+                checkpoints=checkpoints,
+                resume=args.resume)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+import os
+import sys
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import resource
+import subprocess
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from torch.profiler import profile, ProfilerActivity
+from experiments.new.benchmarks.synthetic import SyntheticNodes
+from experiments.new.cFHN.models import LR, NN, LowRankNN, Context, LRHyper, NNHyper, Constraint
+from experiments.new.cFHN.trainer import outer_step, evaluate
+from experiments.new.cFHN.batched_eval import evaluate_batched
+from experiments.new.cFHN.utils import seed_everything, set_logger
+from experiments.new.execution import add_execution_args, execution_from_args
+from experiments.new.dual import DualAscent
+warnings.filterwarnings("ignore")
+
+# settings shared by every config unless the grid overrides them
+BASE_CONFIG = {
+    "hnet": "LR",
+    "n_nodes": 4,
+    "batch_size": 256,
+    "hnet_hidden_dim": 100,
+    "hnet_n_hidden": 3,
+    "n_features": 12,
+    "rows_per_client": 256,
+    "nn_hidden": 12,
+    "hnet_chunk_size": 0,
+    "hnet_rank": 0,
+    "inner_steps": 50,
+    "clients_per_step": 1,
+    "inner_engine": "loop",
+    "fair": "dp",
+}
+
+# metrics where a larger value is a regression
+LOWER_IS_BETTER = ["eval_latency_per_client", "peak_rss_mb", "allocs_per_step", "alloc_mb_per_step"]
+HIGHER_IS_BETTER = ["outer_steps_per_sec", "inner_steps_per_sec"]
+
+def expand_grid(grid):
+    keys = list(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        config = dict(BASE_CONFIG)
+        config.update(zip(keys, values))
+        configs.append(config)
+    return configs
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+def sync(ctx):
+    if ctx.device.type == "cuda":
+        torch.cuda.synchronize(ctx.device)
+
+def build(config, ctx):
+    n_nodes, d = config["n_nodes"], config["n_features"]
+    nodes = SyntheticNodes(n_nodes, config["batch_size"], n_features=d, rows_per_client=config["rows_per_client"], device=ctx.device)
+
+    if config["hnet"] == "LR":
+        hnet = LRHyper(device=ctx.device, n_nodes=n_nodes, embedding_dim=d, context_vector_size=d, hidden_size=d,
+                       hnet_hidden_dim=config["hnet_hidden_dim"], hnet_n_hidden=config["hnet_n_hidden"])
+        make_model = lambda: LR(input_size=d, bound=0.05, fairness=config["fair"])
+    else:
+        hnet = NNHyper(n_nodes=n_nodes, embedding_dim=d, context_vector_size=d, hidden_size=config["nn_hidden"],
+                       hnet_hidden_dim=config["hnet_hidden_dim"], hnet_n_hidden=config["hnet_n_hidden"], chunk_size=config["hnet_chunk_size"], rank=config["hnet_rank"])
+        if config["hnet_rank"]:
+            make_model = lambda: LowRankNN(input_size=d, hidden_size=config["nn_hidden"], rank=config["hnet_rank"], bound=0.05, fairness=config["fair"])
+        else:
+            make_model = lambda: NN(input_size=d, hidden_size=config["nn_hidden"], bound=0.05, fairness=config["fair"])
+    ctx.module(hnet)
+
+    models, cnets, constraints, duals = [], [], [], []
+    for i in range(n_nodes):
+        models.append(make_model())
+        cnets.append(Context(input_size=d, context_vector_size=d, context_hidden_size=100))
+        constraints.append(Constraint(fair=config["fair"]))
+        params = list(models[i].parameters()) + list(cnets[i].parameters()) + list(constraints[i].parameters())
+        duals.append(DualAscent(constraints[i].parameters(), torch.optim.Adam(params, lr=1e-3)))
+
+    optimizer = torch.optim.Adam(params=hnet.parameters(), lr=1e-4)
+    return nodes, hnet, optimizer, models, cnets, constraints, duals
+
+def run_config(config, args):
+    """Times one configuration and returns its metrics, every config starts from the same seed."""
+    ctx = execution_from_args(args)
+    seed_everything(0)
+
+    nodes, hnet, optimizer, models, cnets, constraints, duals = build(config, ctx)
+    n_nodes, d = config["n_nodes"], config["n_features"]
+    losses = [torch.nn.BCELoss() for i in range(n_nodes)]
+    alphas = [1.0 for i in range(n_nodes)]
+    k = min(config["clients_per_step"], n_nodes)
+
+    def step():
+        hnet.train()
+        node_ids = random.sample(range(n_nodes), k)
+        outer_step(nodes, node_ids, hnet, optimizer, models, cnets, constraints, duals, losses, alphas,
+                   config["inner_steps"], d, ctx, config["fair"], nodes.which_position, inner_engine=config["inner_engine"])
+
+    for i in range(args.warmup):
+        step()
+
+    sync(ctx)
+    start = time.perf_counter()
+    for i in range(args.steps):
+        step()
+    sync(ctx)
+    train_time = time.perf_counter() - start
+
+    # allocations of a few extra steps, counted by the profiler apart from the timed ones
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if ctx.device.type == "cuda" else [])
+    with profile(activities=activities, profile_memory=True) as prof:
+        for i in range(args.profile_steps):
+            step()
+    allocating = [e for e in prof.events() if e.self_cpu_memory_usage > 0 or getattr(e, "self_device_memory_usage", 0) > 0]
+    alloc_bytes = sum(max(e.self_cpu_memory_usage, 0) + max(getattr(e, "self_device_memory_usage", 0), 0) for e in allocating)
+
+    eval_clients = min(n_nodes, args.eval_clients)
+    sync(ctx)
+    start = time.perf_counter()
+    # the batched engine covers LR client models, NN ones always take the loop
+    evaluate_fn = evaluate_batched if args.eval_engine == "batched" and config["hnet"] == "LR" else evaluate
+    evaluate_fn(nodes, eval_clients, hnet, models, cnets, d, losses[0], ctx, config["fair"], constraints, alphas[0], nodes.which_position)
+    sync(ctx)
+    eval_time = time.perf_counter() - start
+
+    outer_per_sec = args.steps / train_time
+    result = {
+        "outer_steps_per_sec": outer_per_sec,
+        "inner_steps_per_sec": outer_per_sec * k * config["inner_steps"],
+        "eval_latency_per_client": eval_time / eval_clients,
+        # ru_maxrss is in KB on linux and bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024),
+        "allocs_per_step": len(allocating) / max(args.profile_steps, 1),
+        "alloc_mb_per_step": alloc_bytes / 2 ** 20 / max(args.profile_steps, 1),
+        "hnet_params": sum(p.numel() for p in hnet.parameters()),
+    }
+    if ctx.device.type == "cuda":
+        result["peak_cuda_mb"] = torch.cuda.max_memory_allocated(ctx.device) / 2 ** 20
+    return result
+
+def environment(args):
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+
+def compare(results, baseline, tolerance):
+    # relative change of every metric against a previous run, only configs present in both are compared
+    old = {config_key(r["config"]): r["metrics"] for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        before = old.get(config_key(r["config"]))
+        if before is None:
+            continue
+        for name in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if name not in before or not before[name]:
+                continue
+            change = r["metrics"][name] / before[name] - 1
+            worse = change > tolerance if name in LOWER_IS_BETTER else change < -tolerance
+            logging.info(f"{config_key(r['config'])} {name}: {before[name]:.4g} -> {r['metrics'][name]:.4g} ({change:+.1%}){' REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append((r["config"], name, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Hypernetwork federated training benchmarks on synthetic data")
+    parser.add_argument("--hnet", type=str, nargs="+", default=["LR", "NN"], choices=["LR", "NN"], help="hypernetworks to benchmark")
+    parser.add_argument("--n_nodes", type=int, nargs="+", default=[4, 64, 1024], help="numbers of clients")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[64, 256])
+    parser.add_argument("--hnet_hidden_dim", type=int, nargs="+", default=[100])
+    parser.add_argument("--hnet_n_hidden", type=int, nargs="+", default=[3])
+    parser.add_argument("--hnet_chunk_size", type=int, nargs="+", default=[0], help="NN hypernet chunk sizes, 0 is one dense head per tensor")
+    parser.add_argument("--hnet_rank", type=int, nargs="+", default=[0], help="NN hypernet ranks of the generated fc1/fc2, 0 is full matrices")
+    parser.add_argument("--nn_hidden", type=int, default=None, help="NN client hidden width, defaults to --n_features")
+    parser.add_argument("--n_features", type=int, default=12, help="synthetic feature columns")
+    parser.add_argument("--inner_steps", type=int, default=BASE_CONFIG["inner_steps"])
+    parser.add_argument("--clients_per_step", type=int, nargs="+", default=[BASE_CONFIG["clients_per_step"]], help="clients sampled per outer step")
+    parser.add_argument("--inner_engine", type=str, nargs="+", default=[BASE_CONFIG["inner_engine"]], choices=["loop", "batched"],
+                        help="loop: the sampled clients' inner loops one after another, batched: all of them as one (LR only)")
+    parser.add_argument("--steps", type=int, default=20, help="timed outer steps per config")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed outer steps before timing")
+    parser.add_argument("--profile_steps", type=int, default=2, help="outer steps whose allocations are counted")
+    parser.add_argument("--eval_clients", type=int, default=64, help="clients evaluated for the per-client eval latency")
+    parser.add_argument("--eval_engine", type=str, default="loop", choices=["loop", "batched"], help="evaluation engine timed for the eval latency")
+    parser.add_argument("--isolate", type=int, default=1, choices=[0, 1], help="run every config in a fresh process, so peak RSS is its own")
+    parser.add_argument("--output", type=str, default="results/bench_hnet.json", help="JSON results")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change counted as a regression")
+    add_execution_args(parser)
+    args = parser.parse_args()
+    set_logger()
+
+    grid = {"hnet": args.hnet, "n_nodes": args.n_nodes, "batch_size": args.batch_size,
+            "hnet_hidden_dim": args.hnet_hidden_dim, "hnet_n_hidden": args.hnet_n_hidden, "hnet_chunk_size": args.hnet_chunk_size,
+            "hnet_rank": args.hnet_rank, "clients_per_step": args.clients_per_step, "inner_engine": args.inner_engine}
+    configs = expand_grid(grid)
+    # chunking and low-rank heads only apply to the NN hypernetwork
+    configs = [c for c in configs if c["hnet"] == "NN" or (c["hnet_chunk_size"] == 0 and c["hnet_rank"] == 0)]
+    # so do batched inner steps to the LR one
+    configs = [c for c in configs if c["hnet"] == "LR" or c["inner_engine"] == "loop"]
+    for config in configs:
+        config.update(n_features=args.n_features, nn_hidden=args.nn_hidden or args.n_features, inner_steps=args.inner_steps)
+
+    results = []
+    for config in configs:
+        if args.isolate:
+            # spawn rather than fork, a forked child would start with the parent's resident memory
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                metrics = pool.submit(run_config, config, args).result()
+        else:
+            metrics = run_config(config, args)
+        logging.info(f"{config_key(config)}: {json.dumps(metrics)}")
+        results.append({"config": config, "metrics": metrics})
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(args), "results": results}, f, indent=2)
+    logging.info(f"results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            logging.warning(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import numpy as np
+from experiments.new.cFHN.dataset import tensor_client_loaders
+from experiments.new.cFHN.node import TensorNodes, random_contexts
+from experiments.new.cFHN.partition import ClientArrays
+
+def synthetic_table(n, n_features, which_position, rng):
+    # standard normal features with a binary sensitive column, labels from a logistic model that leans on it
+    X = rng.standard_normal((n, n_features)).astype(np.float32)
+    X[:, which_position] = rng.randint(0, 2, n)
+    w = rng.standard_normal(n_features) / np.sqrt(n_features)
+    p = 1 / (1 + np.exp(-(X @ w + 0.5 * X[:, which_position])))
+    y = (rng.rand(n) < p).astype(np.float32)
+    return X, y
+
+class SyntheticNodes(TensorNodes):
+    """TensorNodes on generated tabular data, so the benchmarks run offline at any number of clients.
+
+    Every client gets `rows_per_client` training rows and a quarter as many test rows.
+    """
+    def __init__(self, n_nodes, batch_size, n_features=12, rows_per_client=256, which_position=8, device='cpu', seed=0, **kwargs):
+        self.n_features = n_features
+        self.rows_per_client = rows_per_client
+        self.which_position = which_position
+        self.seed = seed
+        super().__init__('synthetic', n_nodes, batch_size, classes_per_node=2, device=device, **kwargs)
+
+    def _init_dataloaders(self):
+        rng = np.random.RandomState(self.seed)
+        self.features = [f'x{i}' for i in range(self.n_features)]
+
+        loaders = []
+        for j, rows in enumerate([self.rows_per_client, max(2, self.rows_per_client // 4)]):
+            X, y = synthetic_table(self.n_nodes * rows, self.n_features, self.which_position, rng)
+            clients = ClientArrays(X, y, np.repeat(np.arange(self.n_nodes), rows), self.n_nodes)
+            loaders.append(tensor_client_loaders(clients, self.batch_size, shuffle=(j == 0), device=self.device))
+
+        self.train_loaders, self.test_loaders = loaders
+        self.c_i = random_contexts(self.n_nodes, self.n_features, **self.context_kwargs).to(self.device)
@@ -0,0 +1,187 @@
+import io
+import logging
+import queue
+import multiprocessing
+import numpy as np
+import torch
+from experiments.new.cFHN.models import flatten_weights
+from experiments.new.sampling import make_sampler
+
+STALENESS_POLICIES = ['bound', 'weight']
+
+def pack(obj):
+    # tensors go through the queue as bytes, torch's fd sharing breaks once the sending worker has exited
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getvalue()
+
+def unpack(data):
+    return torch.load(io.BytesIO(data), weights_only=False)
+
+class HnetSnapshot:
+    """Server-side hypernetwork parameters in shared memory, versioned by the number of applied updates."""
+    def __init__(self, hnet):
+        self.params = [p.detach().clone().share_memory_() for p in hnet.parameters()]
+        self.version = multiprocessing.get_context("fork").Value('l', 0)
+        self.lock = multiprocessing.get_context("fork").Lock()
+
+    @torch.no_grad()
+    def publish(self, hnet):
+        with self.lock:
+            for shared, p in zip(self.params, hnet.parameters()):
+                shared.copy_(p)
+            self.version.value += 1
+
+    @torch.no_grad()
+    def pull(self, hnet, version):
+        # copy into a local hnet only if the server moved on since `version`, returns the version now held
+        if self.version.value == version:
+            return version
+        with self.lock:
+            for shared, p in zip(self.params, hnet.parameters()):
+                p.copy_(shared)
+            return self.version.value
+
+def worker_loop(worker_id, owned, snapshot, results, stop, train_client, nodes, hnet, models, cnets, constraints, client_duals, client_losses,
+                alphas, inner_steps, num_features, ctx, fair, which_position, sampler, max_staleness, seed):
+    # one process per worker, forked so every argument is inherited rather than pickled
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    client_sampler = make_sampler(sampler, len(owned), sizes=nodes.client_sizes()[owned], max_staleness=max_staleness)
+    version = -1
+
+    try:
+        while not stop.is_set():
+            local_id = client_sampler.sample()[0]
+            node_id = owned[local_id]
+            version = snapshot.pull(hnet, version)
+
+            context_vec = ctx.float(nodes.c_i[node_id].view(1, -1))
+            with torch.no_grad():
+                flat_weights = flatten_weights(hnet.forward_batch(context_vec, ctx.index(node_id)))
+
+            delta_theta, client_loss = train_client(nodes, node_id, flat_weights, models[node_id], cnets[node_id], constraints[node_id],
+                                                    client_duals[node_id], client_losses[node_id], alphas[node_id], None,
+                                                    inner_steps, num_features, ctx, fair, which_position)
+            client_sampler.update(local_id, client_loss)
+
+            while not stop.is_set():
+                try:
+                    results.put(('update', pack((node_id, context_vec, delta_theta, nodes.c_i[node_id].clone(), version))), timeout=1)
+                    break
+                except queue.Full:
+                    pass
+    except Exception as e:
+        results.put(('error', worker_id, repr(e)))
+        raise
+
+    # hand the trained client state back so the server can evaluate it
+    # c_i rows are cloned, a view would serialize the whole [n_nodes, d] store
+    states = {node_id: (models[node_id].state_dict(), cnets[node_id].state_dict(), constraints[node_id].state_dict(), nodes.c_i[node_id].clone())
+              for node_id in owned}
+    results.put(('done', worker_id, pack(states)))
+
+def next_message(results, procs, finished, poll=1.0):
+    # the next queued message, or ('dead', worker_id, exitcode) for a worker that exited (OOM, signal) without posting 'error' or 'done'
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            pass
+        for worker_id, proc in enumerate(procs):
+            if worker_id not in finished and not proc.is_alive():
+                # whatever it queued before exiting is already in the pipe, one more wait picks it up
+                try:
+                    return results.get(timeout=poll)
+                except queue.Empty:
+                    return ('dead', worker_id, proc.exitcode)
+
+def run_async(step_iter, workers, train_client, nodes, hnet, optimizer, models, cnets, constraints, client_duals, client_losses, alphas,
+              inner_steps, num_features, ctx, fair, which_position, sampler='uniform', max_staleness=None, staleness='weight', max_update_staleness=None):
+    """Asynchronous outer loop: `workers` forked processes train clients against the latest hypernetwork snapshot
+    and queue (node_id, delta_theta, c_i), the server turns each into a hypergradient step.
+
+    Clients are owned round-robin by the workers, so a client's model, context net, multipliers and Adam state
+    never leave its worker until the end. Each queued update carries the snapshot version it was computed from.
+    staleness='bound' drops updates more than max_update_staleness versions old, 'weight' scales them by 1 / (1 + staleness).
+    A worker that dies without reporting fails the run, and is no longer waited for at shutdown.
+    Returns the node id of the last applied update.
+    """
+    if ctx.device.type != 'cpu':
+        raise ValueError("asynchronous workers fork the process and run on cpu only")
+    if staleness not in STALENESS_POLICIES:
+        raise ValueError(f"unknown staleness policy '{staleness}', expected one of {STALENESS_POLICIES}")
+
+    mp = multiprocessing.get_context("fork")
+    snapshot = HnetSnapshot(hnet)
+    results = mp.Queue(maxsize=2 * workers)
+    stop = mp.Event()
+
+    procs = []
+    for worker_id in range(workers):
+        owned = list(range(worker_id, len(nodes), workers))
+        proc = mp.Process(target=worker_loop, args=(worker_id, owned, snapshot, results, stop, train_client, nodes, hnet, models, cnets,
+                                                    constraints, client_duals, client_losses, alphas, inner_steps, num_features, ctx, fair,
+                                                    which_position, sampler, max_staleness, torch.initial_seed() + worker_id + 1), daemon=True)
+        proc.start()
+        procs.append(proc)
+
+    version, dropped, node_id = 0, 0, None
+    finished = set()
+    try:
+        for step in step_iter:
+            while True:
+                message = next_message(results, procs, finished)
+                if message[0] == 'error':
+                    finished.add(message[1])
+                    raise RuntimeError(f"async worker {message[1]} failed: {message[2]}")
+                if message[0] == 'dead':
+                    finished.add(message[1])
+                    raise RuntimeError(f"async worker {message[1]} exited with code {message[2]} without reporting")
+                # the other workers keep the queue busy, so a dead one is looked for on every message too
+                for worker_id, proc in enumerate(procs):
+                    if proc.exitcode is not None:
+                        finished.add(worker_id)
+                        raise RuntimeError(f"async worker {worker_id} exited with code {proc.exitcode} during training")
+                node_id, context_vec, delta_theta, c_i, update_version = unpack(message[1])
+                nodes.c_i[node_id] = c_i
+                update_staleness = version - update_version
+                if staleness == 'bound' and max_update_staleness is not None and update_staleness > max_update_staleness:
+                    dropped += 1
+                    continue
+                break
+
+            scale = 1 / (1 + update_staleness) if staleness == 'weight' else 1
+
+            # hypergradient at the current parameters for the weights the worker was given
+            flat_weights = flatten_weights(hnet.forward_batch(ctx.float(context_vec), ctx.index(node_id)))
+            optimizer.zero_grad()
+            hnet_grads = torch.autograd.grad(flat_weights, hnet.parameters(), grad_outputs=ctx.float(delta_theta) * scale)
+            for p, g in zip(hnet.parameters(), hnet_grads):
+                p.grad = g
+            optimizer.step()
+
+            snapshot.publish(hnet)
+            version += 1
+    finally:
+        stop.set()
+
+        while len(finished) < workers:
+            message = next_message(results, procs, finished)
+            if message[0] in ('error', 'done', 'dead'):
+                finished.add(message[1])
+            if message[0] == 'dead':
+                logging.warning(f"async worker {message[1]} exited with code {message[2]}, the state of its clients is lost")
+            if message[0] == 'done':
+                for client_id, (model_state, cnet_state, constraint_state, c_i) in unpack(message[2]).items():
+                    models[client_id].load_state_dict(model_state)
+                    cnets[client_id].load_state_dict(cnet_state)
+                    constraints[client_id].load_state_dict(constraint_state)
+                    nodes.c_i[client_id] = c_i
+        for proc in procs:
+            proc.join()
+
+    logging.info(f"async: {version} updates applied, {dropped} dropped as too stale")
+    return node_id
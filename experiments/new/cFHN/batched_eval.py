@@ -0,0 +1,169 @@
+from collections import defaultdict
+import numpy as np
+import torch
+import torch.nn.functional as F
+from experiments.new.cFHN.models import LR
+from experiments.new.cFHN.utils import counts_to_TP_FP_TN_FN, metrics
+
+def test_segments(offsets, num_nodes, batch_size):
+    """(client, batch) segments of the concatenated test rows of the first num_nodes clients.
+
+    Segment k covers rows start[k]:start[k] + length[k] of the split, the rows the unshuffled test loader
+    puts in one batch, so batch statistics and per-batch context vectors match evaluate().
+    """
+    sizes = np.diff(offsets[:num_nodes + 1])
+    n_batches = (sizes + batch_size - 1) // batch_size
+    client = np.repeat(np.arange(num_nodes), n_batches)
+    first = np.concatenate(([0], np.cumsum(n_batches)[:-1]))
+    start = offsets[client] + (np.arange(len(client)) - first[client]) * batch_size
+    length = np.minimum(batch_size, offsets[client + 1] - start)
+    return client, start, length
+
+def stack_context_nets(cnets, client, ctx):
+    # the parameters of every segment's context net, stacked along a leading segment dim
+    names = ['fc1.weight', 'fc1.bias', 'fc2.weight', 'fc2.bias', 'fc3.weight', 'fc3.bias', 'bn1.weight', 'bn1.bias', 'bn2.weight', 'bn2.bias',
+             'bn1.running_mean', 'bn1.running_var', 'bn2.running_mean', 'bn2.running_var']
+    unique, inverse = np.unique(client, return_inverse=True)
+    states = [cnets[i].state_dict() for i in unique]
+    index = ctx.long(torch.from_numpy(inverse))
+    return {name: ctx.float(torch.stack([state[name] for state in states]))[index] for name in names}
+
+def masked_batch_norm(h, mask, counts, weight, bias, running_mean, running_var, training, eps=1e-5, momentum=None):
+    # BatchNorm1d over the valid rows of every segment, with batch statistics in train mode as the loop gets them,
+    # with a momentum the batch statistics are also folded into the running ones in place, as BatchNorm1d.train() does
+    if training:
+        mean = (h * mask).sum(1, keepdim=True) / counts
+        var = (((h - mean) ** 2) * mask).sum(1, keepdim=True) / counts
+        if momentum is not None:
+            with torch.no_grad():
+                running_mean.mul_(1 - momentum).add_(mean.squeeze(1), alpha=momentum)
+                running_var.mul_(1 - momentum).add_((var * counts / (counts - 1)).squeeze(1), alpha=momentum)
+    else:
+        mean, var = running_mean.unsqueeze(1), running_var.unsqueeze(1)
+    return (h - mean) / torch.sqrt(var + eps) * weight.unsqueeze(1) + bias.unsqueeze(1)
+
+def batched_context(params, x, mask, counts, training, momentum=None):
+    # Context.forward for all segments at once, x: [S, B, d] -> average context vector per segment [S, d]
+    linear = lambda h, layer: torch.baddbmm(params[f'{layer}.bias'].unsqueeze(1), h, params[f'{layer}.weight'].transpose(1, 2))
+    bn = lambda h, layer: masked_batch_norm(h, mask, counts, params[f'{layer}.weight'], params[f'{layer}.bias'],
+                                            params[f'{layer}.running_mean'], params[f'{layer}.running_var'], training, momentum=momentum)
+    h = F.relu(bn(linear(x, 'fc1'), 'bn1'))
+    h = F.relu(bn(linear(h, 'fc2'), 'bn2'))
+    context = linear(h, 'fc3')
+    return (context * mask).sum(1) / counts[:, 0]
+
+def segment_m_mu_q(model, pred, s, y, mask):
+    # M_mu_q of every segment with one scatter_add over the code segment * 4 + s * 2 + y, pred/s/y/mask: [S, B]
+    S = pred.shape[0]
+    C = model.num_classes
+    G = len(model.sensitive_classes) * C
+    s, y = s.long(), y.long()
+    valid = (s >= 0) & (s < len(model.sensitive_classes)) & (y >= 0) & (y < C) & (mask > 0)
+    code = torch.arange(S, device=pred.device).unsqueeze(1) * G + torch.where(valid, s * C + y, torch.zeros_like(s))
+    weight = valid.to(pred.dtype)
+
+    sums = pred.new_zeros(S * G).scatter_add(0, code.flatten(), (pred * weight).flatten()).view(S, -1, C)
+    counts = pred.new_zeros(S * G).scatter_add(0, code.flatten(), weight.flatten()).view(S, -1, C)
+
+    if model.fairness == 'eo':
+        mu = torch.cat(((sums / counts.clamp(min=1)).flatten(1), sums.sum(1) / counts.sum(1).clamp(min=1)), dim=1)
+    else:
+        overall = (pred * mask).sum(1, keepdim=True) / mask.sum(1, keepdim=True)
+        mu = torch.cat((sums.sum(2) / counts.sum(2).clamp(min=1), overall), dim=1)
+    return mu @ model.M.T - model.c
+
+@torch.no_grad()
+def evaluate_batched(nodes, num_nodes, hnet, models, cnets, num_features, loss, ctx, fair, constraints, alpha, which_position, reservoir_size=0, max_segments=4096):
+    """evaluate() for the LR family as one pass over the concatenated test sets of all clients.
+
+    The test rows are cut into the same (client, batch) segments the loop uses and padded to [S, B, d].
+    All context nets run as stacked batched matmuls and the hypernetwork generates the weights of every segment
+    in one forward_batch call. Predictions are one einsum of every row with its segment's generated weights, and
+    losses, confusion counts and fairness terms are reduced per client with segment sums. Segments are processed
+    max_segments at a time to bound memory. Returns what evaluate() returns; preds/true hold the first
+    reservoir_size rows of every client instead of a reservoir sample.
+    """
+    if any(type(models[i]) is not LR for i in range(num_nodes)):
+        raise ValueError("batched evaluation covers LR client models only")
+    hnet.eval()
+
+    clients = nodes.test_loaders.clients
+    client, start, length = test_segments(clients.offsets, num_nodes, nodes.batch_size)
+    B = int(length.max())
+    X = ctx.float(torch.as_tensor(clients.X))
+    Y = ctx.float(torch.as_tensor(clients.y))
+    training = cnets[0].training
+
+    client_loss = torch.zeros(num_nodes, device=ctx.device, dtype=ctx.dtype)
+    confusion = torch.zeros(num_nodes * 8, device=ctx.device, dtype=torch.long)
+
+    for lo in range(0, len(client), max_segments):
+        seg_client = client[lo:lo + max_segments]
+        rows = torch.from_numpy(start[lo:lo + max_segments, None] + np.arange(B)[None, :])
+        valid = torch.from_numpy(np.arange(B)[None, :] < length[lo:lo + max_segments, None])
+        rows = ctx.long(torch.where(valid, rows, rows[:, :1]))
+        mask = ctx.float(valid)
+        counts = mask.sum(1, keepdim=True)
+
+        x, y = X[rows], Y[rows]
+        s = x[:, :, which_position]
+
+        avg_context = batched_context(stack_context_nets(cnets, seg_client, ctx), x, mask.unsqueeze(2), counts.unsqueeze(2), training)
+        weights = hnet.forward_batch(avg_context, ctx.index(seg_client.tolist()))
+
+        # [context, x] of every row against its segment's fc1, without materializing the prediction vectors
+        w, b = weights['fc1.weight'][:, 0], weights['fc1.bias']
+        logits = torch.einsum('sd,sd->s', avg_context, w[:, :num_features]).unsqueeze(1) + torch.einsum('sbd,sd->sb', x, w[:, num_features:]) + b
+        pred = torch.sigmoid(logits)
+
+        seg_loss = (F.binary_cross_entropy(pred, y, reduction='none') * mask).sum(1) / counts.squeeze(1)
+        if fair != 'none':
+            penalty = torch.zeros_like(seg_loss)
+            for fairness in ['dp', 'eo']:
+                sel = np.flatnonzero([models[c].fairness == fairness for c in seg_client])
+                if len(sel) == 0:
+                    continue
+                sel_t = ctx.long(torch.from_numpy(sel))
+                m_mu_q = segment_m_mu_q(ctx.module(models[seg_client[sel[0]]]), pred[sel_t], s[sel_t], y[sel_t], mask[sel_t])
+                lmbda = torch.stack([constraints[c].lmbda.detach().flatten() for c in seg_client[sel]]).to(ctx.device, ctx.dtype)
+                penalty[sel_t] = (lmbda * m_mu_q).sum(1)
+            # evaluate() divides by len(batch), the (x, y) pair
+            seg_loss = (seg_loss + alpha * penalty) / 2
+
+        seg_client_t = ctx.long(torch.from_numpy(seg_client))
+        client_loss.scatter_add_(0, seg_client_t, seg_loss)
+
+        pred_thresh = (pred > 0.5).long()
+        code = seg_client_t.unsqueeze(1) * 8 + (s != 0).long() * 4 + y.long() * 2 + pred_thresh
+        confusion += torch.bincount(code[valid.to(ctx.device)], minlength=num_nodes * 8)
+
+        if reservoir_size:
+            if lo == 0:
+                kept_pred, kept_true = [[] for i in range(num_nodes)], [[] for i in range(num_nodes)]
+            flat_client = seg_client_t.unsqueeze(1).expand_as(pred_thresh)[valid.to(ctx.device)].cpu().numpy()
+            flat_pred = pred_thresh[valid.to(ctx.device)].cpu().numpy()
+            flat_true = y[valid.to(ctx.device)].cpu().float().numpy()
+            for c in np.unique(flat_client):
+                kept_pred[c].extend(flat_pred[flat_client == c][:reservoir_size - len(kept_pred[c])])
+                kept_true[c].extend(flat_true[flat_client == c][:reservoir_size - len(kept_true[c])])
+
+    confusion = confusion.view(num_nodes, 2, 2, 2).cpu()
+    client_loss = client_loss.cpu().tolist()
+
+    results = defaultdict(lambda: defaultdict(list))
+    preds, true = [], []
+    f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd = [], [], [], [], [], [], [], [], []
+
+    for node_id in range(num_nodes):
+        tp, fp, tn, fn = counts_to_TP_FP_TN_FN(confusion[node_id])
+        f1_score_prediction, f1_female, f1_male, accuracy, f_acc, m_acc, AOD, EOD, SPD = metrics(tp, fp, tn, fn)
+        for values, value in zip([f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd], [f1_score_prediction, f1_female, f1_male, accuracy, f_acc, m_acc, AOD, EOD, SPD]):
+            values.append(value)
+
+        results[node_id]['loss'] = client_loss[node_id]
+        results[node_id]['correct'] = tp[0] + tn[0]
+        results[node_id]['total'] = tp[0] + tn[0] + fp[0] + fn[0]
+        preds.append(np.array(kept_pred[node_id]) if reservoir_size else np.zeros(0, dtype=np.int64))
+        true.append(np.array(kept_true[node_id]) if reservoir_size else np.zeros(0))
+
+    return results, preds, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd
@@ -0,0 +1,182 @@
+import torch
+import torch.nn.functional as F
+from experiments.new.cFHN.models import LR
+from experiments.new.cFHN.batched_eval import batched_context, segment_m_mu_q
+from experiments.new.dual import DualAscent
+from experiments.new.profiling import NO_TIMER
+
+class StackedAdam:
+    """The torch.optim.Adam of K clients stepped as one, over their parameters stacked along a leading client dim.
+
+    Every client keeps its own step count, so the bias corrections are the ones its own Adam would apply.
+    The clients' exp_avg/exp_avg_sq are gathered on construction and scatter() writes everything back into
+    their optimizers, so checkpoints and the loop engine see the same state either way.
+    """
+    def __init__(self, optimizers, client_params, params):
+        group = optimizers[0].param_groups[0]
+        for optimizer in optimizers:
+            other = optimizer.param_groups[0]
+            if len(optimizer.param_groups) != 1 or any(other[k] != group[k] for k in ['lr', 'betas', 'eps', 'weight_decay']):
+                raise ValueError("batched inner steps need one Adam param group with the same settings for every client")
+            if other['amsgrad'] or other['maximize']:
+                raise ValueError("batched inner steps support plain Adam only")
+
+        self.lr, (self.beta1, self.beta2), self.eps, self.weight_decay = group['lr'], group['betas'], group['eps'], group['weight_decay']
+        self.optimizers = optimizers
+        self.client_params = client_params
+        self.params = params
+
+        states = [[optimizer.state[p] for p in ps] for optimizer, ps in zip(optimizers, client_params)]
+        # all parameters of a client are stepped together, so the first one's count is the client's
+        self.steps = torch.tensor([float(state[0]['step']) if state[0] else 0. for state in states], dtype=torch.float64, device=params[0].device)
+        self.exp_avg = [torch.stack([state[i]['exp_avg'] if state[i] else torch.zeros_like(p[k]) for k, state in enumerate(states)])
+                        for i, p in enumerate(params)]
+        self.exp_avg_sq = [torch.stack([state[i]['exp_avg_sq'] if state[i] else torch.zeros_like(p[k]) for k, state in enumerate(states)])
+                           for i, p in enumerate(params)]
+
+    def zero_grad(self):
+        for p in self.params:
+            p.grad = None
+
+    @torch.no_grad()
+    def step(self):
+        # torch's single-tensor Adam with a per-client step size and bias correction
+        self.steps += 1
+        step_size = -self.lr / (1 - self.beta1 ** self.steps)
+        bias_correction2_sqrt = (1 - self.beta2 ** self.steps).sqrt()
+
+        for p, exp_avg, exp_avg_sq in zip(self.params, self.exp_avg, self.exp_avg_sq):
+            if p.grad is None:
+                continue
+            shape = (-1,) + (1,) * (p.dim() - 1)
+            grad = p.grad if self.weight_decay == 0 else p.grad.add(p, alpha=self.weight_decay)
+            exp_avg.lerp_(grad, 1 - self.beta1)
+            exp_avg_sq.mul_(self.beta2).addcmul_(grad, grad, value=1 - self.beta2)
+            denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt.to(p.dtype).view(shape)).add_(self.eps)
+            p.addcdiv_(exp_avg * step_size.to(p.dtype).view(shape), denom)
+
+    def scatter(self):
+        for k, (optimizer, ps) in enumerate(zip(self.optimizers, self.client_params)):
+            for i, p in enumerate(ps):
+                # torch keeps the step count as a float32 scalar tensor
+                optimizer.state[p] = {'step': torch.tensor(float(self.steps[k])),
+                                      'exp_avg': self.exp_avg[i][k].clone(), 'exp_avg_sq': self.exp_avg_sq[i][k].clone()}
+
+def stack_batches(batches, ctx):
+    # K client batches -> x [K, B, d], y [K, B] zero padded to the longest, the valid-row mask [K, B] and the row counts [K]
+    lengths = [len(y) for x, y in batches]
+    B = max(lengths)
+    x = torch.stack([F.pad(ctx.float(x), (0, 0, 0, B - len(x))) for x, y in batches])
+    y = torch.stack([F.pad(ctx.float(y), (0, B - len(y))) for x, y in batches])
+    mask = (torch.arange(B, device=ctx.device).unsqueeze(0) < torch.tensor(lengths, device=ctx.device).unsqueeze(1)).to(ctx.dtype)
+    return x, y, mask, mask.sum(1)
+
+def train_group(nodes, node_ids, batches, flat_weights, models, cnets, constraints, client_duals, alphas, inner_steps, num_features, ctx, fair, which_position, timer):
+    # one batch of clients with the same fairness term, so M and the multipliers stack
+    for node_id in node_ids:
+        ctx.module(models[node_id])
+        ctx.module(cnets[node_id])
+        ctx.module(constraints[node_id])
+
+    with timer.phase('load_weights'):
+        for k, node_id in enumerate(node_ids):
+            models[node_id].load_flat(flat_weights[k])
+
+        # the parameters of every client in the order of its optimizer, stacked per tensor
+        names = ([('model', n) for n, p in models[node_ids[0]].named_parameters()] + [('cnet', n) for n, p in cnets[node_ids[0]].named_parameters()]
+                 + [('constraint', n) for n, p in constraints[node_ids[0]].named_parameters()])
+        client_params = [list(models[i].parameters()) + list(cnets[i].parameters()) + list(constraints[i].parameters()) for i in node_ids]
+        params = [torch.stack([ps[j].detach() for ps in client_params]).requires_grad_() for j in range(len(names))]
+        stacked = {name: p for name, p in zip(names, params)}
+
+        model_params = {n: stacked[('model', n)] for m, n in names if m == 'model'}
+        cnet_params = {n: stacked[('cnet', n)] for m, n in names if m == 'cnet'}
+        bn_buffers = ['bn1.running_mean', 'bn1.running_var', 'bn2.running_mean', 'bn2.running_var']
+        cnet_params.update({n: torch.stack([cnets[i].state_dict()[n] for i in node_ids]) for n in bn_buffers})
+
+    duals = [client_duals[i] for i in node_ids]
+    if any(dual.radius is not None for dual in duals):
+        raise ValueError("batched inner steps support multipliers bounded below only, not an l1 radius")
+    multipliers = [stacked[('constraint', 'lmbda')]] if ('constraint', 'lmbda') in stacked else []
+    dual = DualAscent(multipliers, StackedAdam([d.optimizer for d in duals], client_params, params), debug=duals[0].debug)
+
+    model = models[node_ids[0]]
+    alpha = ctx.tensor([alphas[i] for i in node_ids]) if fair != 'none' else None
+    momentum = cnets[node_ids[0]].bn1.momentum
+    context_sum = 0
+    running_err = 0
+
+    for j in range(inner_steps):
+        dual.zero_grad()
+
+        with timer.phase('data'):
+            x, y, mask, counts = stack_batches([b[j] for b in batches], ctx)
+            s = x[:, :, which_position]
+
+        with timer.phase('inner_forward'):
+            avg_context = batched_context(cnet_params, x, mask.unsqueeze(2), counts.view(-1, 1, 1), training=True, momentum=momentum)
+            w, b = model_params['fc1.weight'][:, 0], model_params['fc1.bias']
+            logits = torch.einsum('kd,kd->k', avg_context, w[:, :num_features]).unsqueeze(1) + torch.einsum('kbd,kd->kb', x, w[:, num_features:]) + b
+            pred = torch.sigmoid(logits)
+
+            context_sum = context_sum + avg_context.detach()
+
+            err = (F.binary_cross_entropy(pred, y, reduction='none') * mask).sum(1) / counts
+            if fair != 'none':
+                err = err + alpha * (stacked[('constraint', 'lmbda')][:, :, 0] * segment_m_mu_q(model, pred, s, y, mask)).sum(1)
+
+        # the clients share no parameters, so the gradient of the sum is every client's own
+        with timer.phase('inner_backward'):
+            err.sum().backward()
+            running_err += err.detach()
+
+        with timer.phase('inner_step'):
+            dual.step()
+        timer.count('inner_steps', len(node_ids))
+        timer.count('samples', sum(len(b[j][1]) for b in batches))
+
+    with timer.phase('inner_step'), torch.no_grad():
+        dual.optimizer.scatter()
+        for k, i in enumerate(node_ids):
+            for p, stacked_p in zip(client_params[k], params):
+                p.copy_(stacked_p[k])
+            cnet_state = cnets[i].state_dict()
+            for n in bn_buffers:
+                cnet_state[n].copy_(cnet_params[n][k])
+            cnets[i].bn1.num_batches_tracked += inner_steps
+            cnets[i].bn2.num_batches_tracked += inner_steps
+
+    with timer.phase('context_update'):
+        for k, i in enumerate(node_ids):
+            nodes.c_i.update(i, context_sum[k] / inner_steps)
+
+    delta_theta = flat_weights.detach() - torch.stack([models[i].flat for i in node_ids])
+    return delta_theta, running_err / inner_steps
+
+def train_clients_batched(nodes, node_ids, flat_weights, models, cnets, constraints, client_duals, alphas, inner_steps, num_features, ctx, fair, which_position, timer=NO_TIMER):
+    """The inner loops of the K sampled clients of an outer step, run together instead of one client after another.
+
+    Every inner step is a handful of batched ops over all K clients: the stacked context nets as in
+    evaluate_batched, one einsum for the LR predictions, one scatter_add for the fairness terms, one backward
+    and one StackedAdam step. Clients with different fairness terms ('both') run as one batch per term.
+    LR client models only. Returns delta_theta [K, P] and the mean inner loss of every client, as train_client
+    does for one.
+    """
+    if any(type(models[i]) is not LR for i in node_ids):
+        raise ValueError("batched inner steps cover LR client models only")
+
+    # drawn client by client up front, in the order the loop engine draws them, so both train on the same batches
+    with timer.phase('data'):
+        batches = [[next(iter(nodes.train_loaders[i])) for j in range(inner_steps)] for i in node_ids]
+
+    delta_theta = torch.empty_like(flat_weights)
+    losses = [None] * len(node_ids)
+    for fairness in dict.fromkeys(models[i].fairness for i in node_ids):
+        group = [k for k, i in enumerate(node_ids) if models[i].fairness == fairness]
+        group_delta, group_losses = train_group(nodes, [node_ids[k] for k in group], [batches[k] for k in group], flat_weights[group], models, cnets, constraints, client_duals,
+                                                alphas, inner_steps, num_features, ctx, fair, which_position, timer)
+        delta_theta[group] = group_delta
+        for k, client_loss in zip(group, group_losses):
+            losses[k] = client_loss
+
+    return delta_theta, losses
@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 import random
 from torch.utils.data import Dataset
 import torch.utils.data
@@ -9,6 +11,29 @@ from sklearn.model_selection import train_test_split
 import numpy as np
 from collections import defaultdict
 from torch.utils.data.sampler import SubsetRandomSampler
+from experiments.new.cFHN.partition import PARTITIONS, ClientArrays, sorted_first_set_range, assign_sorted, assign_iid, assign_dirichlet, assign_shards
+
+COMPAS_URL = 'https://raw.githubusercontent.com/propublica/compas-analysis/master/compas-scores-two-years.csv'
+
+# everything that changes the cleaned data goes in here, the cache key is a hash of it
+CLEANING_PARAMS = {
+    'adult': {
+        'replace': [
+            [['Divorced', 'Married-AF-spouse', 'Married-civ-spouse', 'Married-spouse-absent', 'Never-married', 'Separated', 'Widowed'],
+             ['not married', 'married', 'married', 'married', 'not married', 'not married', 'not married']],
+            [['Federal-gov', 'Local-gov', 'State-gov'], ['government', 'government', 'government']],
+            [['Never-worked', 'Private', 'Self-emp-inc', 'Self-emp-not-inc', 'Without-pay'],
+             ['private', 'private', 'private', 'private', 'private']],
+        ],
+        'encode': ['workclass', 'education', 'marital_status', 'occupation', 'relationship', 'race', 'sex', 'native_country', 'income_class'],
+    },
+    'compas': {
+        'cols': ['age', 'c_charge_degree', 'race', 'age_cat', 'score_text', 'sex', 'priors_count', 'length_of_stay', 'days_b_screening_arrest', 'decile_score', 'two_year_recid'],
+        'encode': ['sex','race', 'c_charge_degree', 'score_text', 'age_cat'],
+        'test_size': .1,
+        'random_state': 42,
+    },
+}
 
 class TabularData(Dataset):
     def __init__(self, X, y):
@@ -16,8 +41,9 @@ class TabularData(Dataset):
         n, m = X.shape
         self.n = n
         self.m = m
-        self.X = torch.tensor(X)
-        self.y = torch.tensor(y)
+        # as_tensor so a client's rows stay a view into the shared split arrays
+        self.X = torch.as_tensor(X)
+        self.y = torch.as_tensor(y)
 
     def __len__(self):
         return self.n
@@ -45,11 +71,15 @@ def read_dataset(path, data_types, data_name):
             },
         )
     elif data_name == 'compas':
-        url = 'https://raw.githubusercontent.com/propublica/compas-analysis/master/compas-scores-two-years.csv'
-        data = pd.read_csv(url)
+        # path is a local copy of the propublica csv, fall back to fetching it
+        data = pd.read_csv(path if path is not None else COMPAS_URL)
     return data
 
-def clean_and_encode_dataset(data, data_name):
+def clean_and_encode_dataset(data, data_name, encoders=None):
+    params = CLEANING_PARAMS[data_name]
+    if encoders is None:
+        encoders = {}
+
     if data_name == 'adult':
         data['income_class'] = data.income_class.str.rstrip('.').astype('category')
 
@@ -61,17 +91,10 @@ def clean_and_encode_dataset(data, data_name):
 
         data.capital_gain = data.capital_gain.astype(int)
 
-        data.replace(['Divorced', 'Married-AF-spouse', 'Married-civ-spouse', 'Married-spouse-absent', 'Never-married',
-                      'Separated', 'Widowed'],
-                     ['not married', 'married', 'married', 'married', 'not married', 'not married', 'not married'],
-                     inplace=True)
-        data.replace(['Federal-gov', 'Local-gov', 'State-gov'], ['government', 'government', 'government'],
-                     inplace=True)
-        data.replace(['Never-worked', 'Private', 'Self-emp-inc', 'Self-emp-not-inc', 'Without-pay'],
-                     ['private', 'private', 'private', 'private', 'private'], inplace=True)
-        encoders = {}
+        for to_replace, value in params['replace']:
+            data.replace(to_replace, value, inplace=True)
 
-        for col in ['workclass', 'education', 'marital_status', 'occupation', 'relationship', 'race', 'sex', 'native_country', 'income_class']:
+        for col in params['encode']:
             encoders[col] = LabelEncoder().fit(data[col])
             data.loc[:, col] = encoders[col].transform(data[col])
 
@@ -87,22 +110,77 @@ def clean_and_encode_dataset(data, data_name):
                 pd.to_datetime(data['c_jail_out']) - pd.to_datetime(data['c_jail_in']))
 
         #cols = ['age', 'c_charge_degree', 'sex', 'age_cat', 'score_text', 'race', 'priors_count', 'length_of_stay', 'days_b_screening_arrest', 'decile_score', 'two_year_recid']
-        cols = ['age', 'c_charge_degree', 'race', 'age_cat', 'score_text', 'sex', 'priors_count', 'length_of_stay', 'days_b_screening_arrest', 'decile_score', 'two_year_recid']
+        cols = params['cols']
 
         data = data[cols]
 
         data['length_of_stay'] /= np.timedelta64(1, 'D')
         data['length_of_stay'] = np.ceil(data['length_of_stay'])
 
-        encoders = {}
-
-        for col in ['sex','race', 'c_charge_degree', 'score_text', 'age_cat']:
+        for col in params['encode']:
             encoders[col] = LabelEncoder().fit(data[col])
             data.loc[:, col] = encoders[col].transform(data[col])
 
     return data
 
-def get_dataset(data_name, num_clients):
+def cache_key(data_name):
+    return hashlib.sha1(json.dumps({data_name: CLEANING_PARAMS[data_name]}, sort_keys=True).encode()).hexdigest()[:12]
+
+def save_cached_dataset(cache_dir, data_name, datasets, splits, features, labels, encoders):
+    path = os.path.join(cache_dir, f'{data_name}-{cache_key(data_name)}')
+    tmp_path = path + f'.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    for name, data in zip(['train', 'test'], datasets):
+        np.save(os.path.join(tmp_path, f'{name}.npy'), data.values.astype(np.float64))
+
+    meta = {
+        'columns': list(datasets[0].columns),
+        'features': list(features),
+        'labels': labels,
+        'splits': [int(split) for split in splits],
+        'vocab': {col: [str(c) for c in enc.classes_] for col, enc in encoders.items()},
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # another sweep worker may have written it first, theirs is just as good
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        for name in os.listdir(tmp_path):
+            os.remove(os.path.join(tmp_path, name))
+        os.rmdir(tmp_path)
+
+def load_cached_dataset(cache_dir, data_name):
+    path = os.path.join(cache_dir, f'{data_name}-{cache_key(data_name)}')
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    datasets = [pd.DataFrame(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'), columns=meta['columns'], copy=False) for name in ['train', 'test']]
+    features = pd.Index(meta['features'])
+
+    return datasets, meta['splits'], features, meta['labels'], meta['vocab']
+
+def get_dataset(data_name, num_clients, cache_dir=None, compas_path=None):
+    if cache_dir is not None:
+        cached = load_cached_dataset(cache_dir, data_name)
+        if cached is not None:
+            datasets, splits, features, labels, _ = cached
+            return datasets, splits, features, labels
+
+    datasets, splits, features, labels, encoders = build_dataset(data_name, compas_path)
+
+    if cache_dir is not None:
+        save_cached_dataset(cache_dir, data_name, datasets, splits, features, labels, encoders)
+
+    return datasets, splits, features, labels
+
+def build_dataset(data_name, compas_path=None):
+    encoders = {}
     if data_name == 'adult':
 
         CURRENT_DIR = os.path.abspath(os.path.dirname(__name__))
@@ -127,7 +205,7 @@ def get_dataset(data_name, num_clients):
             ("income_class", "category"),
         ])
 
-        train_data = clean_and_encode_dataset(read_dataset(TRAIN_DATA_FILE, data_types, 'adult'), 'adult')  #(32561, 14)
+        train_data = clean_and_encode_dataset(read_dataset(TRAIN_DATA_FILE, data_types, 'adult'), 'adult', encoders)  #(32561, 14)
         test_data = clean_and_encode_dataset(read_dataset(TEST_DATA_FILE, data_types, 'adult'), 'adult')    #(16281, 14)
         train_data = train_data.sort_values('workclass').reset_index(drop=True)
         test_data = test_data.sort_values('workclass').reset_index(drop=True)
@@ -137,11 +215,12 @@ def get_dataset(data_name, num_clients):
         cols = train_data.columns
         features, labels = cols[:-1], cols[-1]
 
-        return datasets, splits, features, labels
+        return datasets, splits, features, labels, encoders
 
     elif data_name == 'compas':
-        data = clean_and_encode_dataset(read_dataset(None, None, 'compas'), 'compas')
-        train_data, test_data = train_test_split(data, test_size=.1, train_size=.9, random_state=42, shuffle=True)
+        params = CLEANING_PARAMS['compas']
+        data = clean_and_encode_dataset(read_dataset(compas_path, None, 'compas'), 'compas', encoders)
+        train_data, test_data = train_test_split(data, test_size=params['test_size'], train_size=1 - params['test_size'], random_state=params['random_state'], shuffle=True)
         train_data = train_data.sort_values('age').reset_index(drop=True)
         test_data = test_data.sort_values('age').reset_index(drop=True)
         splits = [train_data.index[np.searchsorted(train_data['age'], 31, side='left')],
@@ -151,49 +230,151 @@ def get_dataset(data_name, num_clients):
         cols = train_data.columns
         features, labels = cols[:-1], cols[-1]
 
-    return datasets, splits, features, labels
-
-def gen_random_loaders(data_name, num_clients, bz):
-    loader_params = {"batch_size": bz, "shuffle": False, "pin_memory": True, "num_workers": 0}
+    return datasets, splits, features, labels, encoders
+
+def split_clients(data_name, num_clients, cache_dir=None, compas_path=None, partition='sort', partition_by=None, dirichlet_beta=0.5, shards_per_client=2):
+    datasets, splits, features, labels = get_dataset(data_name, num_clients, cache_dir, compas_path)
+
+    # dirichlet and shard group/sort the rows by this column, the label unless told otherwise (e.g. a sensitive attribute)
+    by = labels if partition_by is None else partition_by
+    values = [data[by].values for data in datasets]
+
+    # anything random is drawn once and applied to train and test, so a client's test split follows its train split
+    if partition == 'sort':
+        first_set = random.randint(*sorted_first_set_range([len(data) for data in datasets], splits, num_clients))
+    elif partition == 'dirichlet':
+        group_values, groups = np.unique(np.concatenate(values), return_inverse=True)
+        groups = np.split(groups, [len(values[0])])
+        proportions = np.random.dirichlet([dirichlet_beta] * num_clients, size=len(group_values))
+    elif partition == 'shard':
+        shard_perm = np.random.permutation(num_clients * shards_per_client)
+    elif partition != 'iid':
+        raise ValueError(f"unknown partition '{partition}', expected one of {PARTITIONS}")
+
+    all_client_test_train = []
+
+    for j, data in enumerate(datasets):
+        if partition == 'sort':
+            client_ids = assign_sorted(len(data), splits[j], num_clients, first_set)
+        elif partition == 'iid':
+            client_ids = assign_iid(len(data), num_clients)
+        elif partition == 'dirichlet':
+            client_ids = assign_dirichlet(groups[j], proportions)
+        elif partition == 'shard':
+            client_ids = assign_shards(values[j], num_clients, shard_perm)
+
+        all_client_test_train.append(ClientArrays(data[features].values, data[labels].values, client_ids, num_clients))
+
+    return all_client_test_train, features
+
+class ClientLoaders:
+    # list of per-client loaders that builds each one on first access, so thousands of clients cost nothing up front
+    def __init__(self, clients, make_loader):
+        self.clients = clients
+        self.make_loader = make_loader
+        self.loaders = {}
 
-    dataloaders = []
+    def __len__(self):
+        return len(self.clients)
 
-    datasets, splits, features, labels = get_dataset(data_name, num_clients)
+    def __getitem__(self, i):
+        if i not in self.loaders:
+            if not 0 <= i < len(self):
+                raise IndexError(i)
+            self.loaders[i] = self.make_loader(i)
+        return self.loaders[i]
 
-    all_client_test_train = [[], []]
+    def state_dict(self):
+        # only loaders that keep a position between iter() calls (TensorLoader) have state to save
+        return {i: loader.state_dict() for i, loader in self.loaders.items() if hasattr(loader, 'state_dict')}
 
-    first_set = random.randint(1,num_clients-1)
-    second_set = abs(num_clients - first_set)
+    def load_state_dict(self, state):
+        for i, loader_state in state.items():
+            self[i].load_state_dict(loader_state)
 
-    assert first_set > 0
-    assert second_set > 0
+def gen_random_loaders(data_name, num_clients, bz, cache_dir=None, compas_path=None, pin_memory=False, **partition_kwargs):
+    dataloaders = []
 
-    for j, data_copy in enumerate(datasets):
-        amount_two = int((data_copy.shape[0] - splits[j]) / second_set)
+    all_client_test_train, features = split_clients(data_name, num_clients, cache_dir, compas_path, **partition_kwargs)
 
-        for i in range(num_clients):
-            if i < first_set:
-                amount = int((splits[j] - 1) / first_set)
-            else:
-                amount = amount_two
+    def loader_factory(clients, loader_params):
+        return lambda i: torch.utils.data.DataLoader(TabularData(*clients[i]), **loader_params)
 
-            # last client gets the remainders
-            if i == num_clients - 1:
-                client_data = data_copy
-            else:
-                client_data = data_copy[0:amount]
+    for j, clients in enumerate(all_client_test_train):
+        loader_params = {"batch_size": bz, "shuffle": j == 0, "pin_memory": pin_memory, "num_workers": 0}
+        dataloaders.append(ClientLoaders(clients, loader_factory(clients, loader_params)))
 
+    return dataloaders, features
 
-            all_client_test_train[j].append(TabularData(client_data[features].values, client_data[labels].values))
-            data_copy = data_copy[amount:]
+class TensorLoader:
+    """Serves minibatches of one client by slicing resident X/y tensors.
 
-        subsets = all_client_test_train[j]
-        if j == 0:
-            loader_params['shuffle'] = True
-        else:
-            loader_params['shuffle'] = False
-        dataloaders.append(list(map(lambda x: torch.utils.data.DataLoader(x, **loader_params), subsets)))
+    The permutation and cursor persist across iter() calls, so next(iter(loader)) walks
+    through an epoch instead of restarting it, and a full for-loop yields the rest of the epoch.
+    When shuffling, a single leftover row is merged into the epoch's last full batch, since the
+    Context BatchNorm cannot train on a batch of one.
+    """
+    def __init__(self, X, y, batch_size, shuffle, device='cpu'):
+        assert len(X) == len(y)
+        self.X = torch.as_tensor(X, dtype=torch.float32).contiguous().to(device)
+        self.y = torch.as_tensor(y, dtype=torch.float32).contiguous().to(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dataset = self.X
+        self.cursor = 0
+        self.perm = None
+        self._new_epoch()
+
+    def _new_epoch(self):
+        self.cursor = 0
+        if self.shuffle:
+            self.perm = torch.randperm(len(self.X), device=self.X.device)
 
-    return dataloaders, features
+    def __len__(self):
+        n_batches = (len(self.X) + self.batch_size - 1) // self.batch_size
+        if self.shuffle and n_batches > 1 and len(self.X) % self.batch_size == 1:
+            return n_batches - 1
+        return n_batches
+
+    def state_dict(self):
+        return {'cursor': self.cursor, 'perm': None if self.perm is None else self.perm.cpu()}
+
+    def load_state_dict(self, state):
+        self.cursor = state['cursor']
+        if state['perm'] is not None:
+            self.perm = state['perm'].to(self.X.device)
+
+    def __iter__(self):
+        n = len(self.X)
+        while True:
+            start = self.cursor
+            end = min(start + self.batch_size, n)
+            if self.shuffle and n - end == 1:
+                end = n
+            idx = self.perm[start:end] if self.shuffle else slice(start, end)
+            self.cursor = end
+
+            epoch_done = end >= n
+            if epoch_done:
+                self._new_epoch()
+
+            yield self.X[idx], self.y[idx]
+
+            if epoch_done:
+                return
+
+def tensor_client_loaders(clients, bz, shuffle, device='cpu'):
+    # one device copy per split, each client's loader slices a view of it
+    X = torch.as_tensor(clients.X, dtype=torch.float32).to(device)
+    y = torch.as_tensor(clients.y, dtype=torch.float32).to(device)
+    offsets = clients.offsets
+    return ClientLoaders(clients, lambda i: TensorLoader(X[offsets[i]:offsets[i + 1]], y[offsets[i]:offsets[i + 1]], bz, shuffle=shuffle, device=device))
+
+def gen_tensor_loaders(data_name, num_clients, bz, device='cpu', cache_dir=None, compas_path=None, **partition_kwargs):
+    all_client_test_train, features = split_clients(data_name, num_clients, cache_dir, compas_path, **partition_kwargs)
 
+    dataloaders = []
+    for j, clients in enumerate(all_client_test_train):
+        dataloaders.append(tensor_client_loaders(clients, bz, shuffle=(j == 0), device=device))
 
+    return dataloaders, features
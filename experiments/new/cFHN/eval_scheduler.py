@@ -0,0 +1,121 @@
+import copy
+import logging
+import threading
+import time
+import numpy as np
+from experiments.new.cFHN.dataset import tensor_client_loaders
+from experiments.new.cFHN.partition import ClientArrays
+from experiments.new.checkpoint import rng_state, set_rng_state
+
+class ValidationShard:
+    """A fixed random subsample of at most rows_per_client test rows of every client, all of them when None.
+
+    Drawn once with its own RandomState so the training RNG is untouched, and exposes the parts of
+    the nodes object that evaluate() and evaluate_batched() read.
+    """
+    def __init__(self, nodes, rows_per_client, device='cpu', seed=0):
+        clients = nodes.test_loaders.clients
+        rng = np.random.RandomState(seed)
+
+        client_ids = np.repeat(np.arange(len(clients)), clients.sizes())
+        # rows stay grouped by client, in random order within each client
+        order = np.lexsort((rng.rand(len(client_ids)), client_ids))
+        rank = np.arange(len(client_ids)) - clients.offsets[client_ids]
+        keep = np.sort(order[rank < rows_per_client]) if rows_per_client is not None else np.arange(len(client_ids))
+
+        self.n_nodes = len(clients)
+        self.batch_size = nodes.batch_size
+        self.test_loaders = tensor_client_loaders(ClientArrays(clients.X[keep], clients.y[keep], client_ids[keep], len(clients)),
+                                                  nodes.batch_size, shuffle=False, device=device)
+
+    def __len__(self):
+        return self.n_nodes
+
+class EvalScheduler:
+    """Evaluation every `every` outer steps, with its cost bounded so the run is not blind until the end.
+
+    With shard_rows set, each evaluation runs on a fixed ValidationShard instead of the full test sets. With
+    background=True the hypernetwork and client modules are snapshotted and evaluated on a thread while training
+    goes on; an evaluation that comes due while the previous one is still running is skipped, never waited for.
+    Evaluating never moves the training RNG: synchronous runs restore it afterwards and background runs read
+    tensor loaders, which draw nothing from it.
+    Results go to the log and to the TensorBoard panels 'testing accuracy', 'testing loss', 'AOD', 'EOD' and
+    'SPD', with the average and the first log_clients clients.
+    """
+    def __init__(self, eval_fn, nodes, num_nodes, num_features, ctx, fair, which_position, every=0, writer=None, engine='loop',
+                 shard_rows=None, background=False, log_clients=4):
+        self.eval_fn = eval_fn
+        # a torch DataLoader draws a seed from the global RNG on every pass, which a thread cannot put back
+        self.nodes = nodes if shard_rows is None and not background else ValidationShard(nodes, shard_rows, ctx.device)
+        self.num_nodes = num_nodes
+        self.num_features = num_features
+        self.ctx = ctx
+        self.fair = fair
+        self.which_position = which_position
+        self.every = every
+        self.writer = writer
+        self.engine = engine
+        self.background = background
+        self.log_clients = log_clients
+
+        self.thread = None
+        self.error = None
+        self.skipped = 0
+        self.history = []
+
+    def due(self, step):
+        return self.every > 0 and (step + 1) % self.every == 0
+
+    def run(self, step, hnet, models, cnets, constraints, loss, alpha):
+        if self.error is not None:
+            raise RuntimeError("background evaluation failed") from self.error
+
+        if not self.background:
+            state = rng_state()
+            self._evaluate(step, hnet, models, cnets, constraints, loss, alpha)
+            set_rng_state(state)
+            return
+
+        if self.thread is not None and self.thread.is_alive():
+            self.skipped += 1
+            logging.info(f"Step: {step + 1}, evaluation skipped, the previous one is still running")
+            return
+
+        # the trainer keeps updating these in place, the thread gets its own copy
+        snapshot = copy.deepcopy((hnet, models, cnets, constraints))
+        self.thread = threading.Thread(target=self._evaluate_safe, args=(step,) + snapshot + (loss, alpha), daemon=True)
+        self.thread.start()
+
+    def _evaluate_safe(self, *args):
+        try:
+            self._evaluate(*args)
+        except Exception as e:
+            self.error = e
+
+    def _evaluate(self, step, hnet, models, cnets, constraints, loss, alpha):
+        start = time.perf_counter()
+        was_training = hnet.training
+        step_results, avg_loss, avg_acc, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = self.eval_fn(
+            self.nodes, self.num_nodes, hnet, models, cnets, self.num_features, loss, self.ctx, confusion=False, fair=self.fair,
+            constraint=constraints, alpha=alpha, which_position=self.which_position, engine=self.engine)
+        hnet.train(was_training)
+
+        self.history.append({'step': step + 1, 'loss': avg_loss, 'acc': avg_acc, 'aod': np.nanmean(aod), 'eod': np.nanmean(eod), 'spd': np.nanmean(spd)})
+        logging.info(f"\nStep: {step + 1}, AVG Loss: {avg_loss:.4f},  AVG Acc: {avg_acc:.4f}, eval time: {time.perf_counter() - start:.2f}s")
+
+        if self.writer is None:
+            return
+        shown = range(min(self.log_clients, self.num_nodes))
+        for tag, average, values in [('testing accuracy', avg_acc, all_acc), ('testing loss', avg_loss, all_loss),
+                                     ('AOD', np.nanmean(aod), aod), ('EOD', np.nanmean(eod), eod), ('SPD', np.nanmean(spd), spd)]:
+            scalars = {'average': average}
+            scalars.update({f'client {i + 1}': values[i] for i in shown})
+            self.writer.add_scalars(tag, scalars, step)
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("background evaluation failed") from self.error
+        if self.skipped:
+            logging.info(f"{self.skipped} evaluations skipped while the previous one was running")
@@ -0,0 +1,67 @@
+import os
+import copy
+import json
+import logging
+import numpy as np
+import torch
+from experiments.new.cFHN.models import LR
+from experiments.new.cFHN.static_predictor import WEIGHTS_FILE, META_FILE
+
+EXPORT_CONTEXTS = ['data', 'store']
+
+@torch.no_grad()
+def frozen_contexts(nodes, num_nodes, cnets, num_features, ctx, context='data'):
+    """One fixed [num_nodes, d] context vector per client for the static models.
+
+    data: the client's Context net over all of its training rows as one batch, the way evaluate() runs it
+    per test batch, on a copy so the running statistics of the live net are untouched.
+    store: the c_i the hypernetwork is conditioned on during training.
+    """
+    if context == 'store':
+        return ctx.float(nodes.c_i[list(range(num_nodes))])
+    if context != 'data':
+        raise ValueError(f"unknown export context '{context}', expected one of {EXPORT_CONTEXTS}")
+
+    clients = nodes.train_loaders.clients
+    contexts = []
+    for node_id in range(num_nodes):
+        x = ctx.float(torch.as_tensor(clients.X[clients.offsets[node_id]:clients.offsets[node_id + 1]]))
+        cnet = ctx.module(copy.deepcopy(cnets[node_id]))
+        avg_context_vector, _ = cnet(x, num_features)
+        contexts.append(avg_context_vector)
+    return torch.stack(contexts)
+
+@torch.no_grad()
+def export_static_models(path, nodes, num_nodes, hnet, models, cnets, num_features, ctx, which_position, context='data'):
+    """Materializes every client's generated LR into one packed [num_nodes, d+1] float32 array in `path`.
+
+    The hypernetwork generates each client's fc1 once from its frozen context vector c. The context half of fc1
+    only ever multiplies c, so c . w_context + bias becomes the last column and the first d columns are
+    the weights on the raw features. The result is read by static_predictor.StaticPredictor, which needs
+    neither torch nor the hypernetwork. LR client models only.
+    """
+    if any(type(models[i]) is not LR for i in range(num_nodes)):
+        raise ValueError("static export covers LR client models only")
+    was_training = hnet.training
+    hnet.eval()
+
+    contexts = frozen_contexts(nodes, num_nodes, cnets, num_features, ctx, context)
+    weights = hnet.forward_batch(contexts, ctx.index(list(range(num_nodes))))
+    hnet.train(was_training)
+
+    w, b = weights['fc1.weight'][:, 0], weights['fc1.bias']
+    packed = torch.cat((w[:, num_features:], (contexts * w[:, :num_features]).sum(1, keepdim=True) + b), dim=1)
+    packed = packed.float().cpu().numpy()
+
+    # written under temporary names and renamed, a reader never sees a half-written export
+    os.makedirs(path, exist_ok=True)
+    meta = {'n_clients': num_nodes, 'num_features': num_features, 'which_position': which_position, 'context': context, 'dtype': str(packed.dtype)}
+    with open(os.path.join(path, WEIGHTS_FILE + '.tmp'), 'wb') as f:
+        np.save(f, packed)
+    with open(os.path.join(path, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(path, WEIGHTS_FILE + '.tmp'), os.path.join(path, WEIGHTS_FILE))
+    os.replace(os.path.join(path, META_FILE + '.tmp'), os.path.join(path, META_FILE))
+
+    logging.info(f"static models of {num_nodes} clients ({packed.nbytes / 2 ** 20:.2f} MB) written to {path}")
+    return packed
@@ -1,10 +1,22 @@
 from collections import OrderedDict
 import torch
 from torch import nn
+import torch.nn.functional as F
 import numpy as np
+from experiments.new.constraints import constraint_shape, constraint_matrix
 
 class NNHyper(nn.Module):
-    def __init__(self, n_nodes, embedding_dim, context_vector_size, hidden_size, hnet_hidden_dim = 100, hnet_n_hidden=3):
+    """Hypernetwork for the three-layer NN client model.
+
+    By default every target tensor has its own dense head, so the head parameters grow with
+    hidden_size ** 2. With chunk_size > 0 the flat target weights are instead generated chunk_size values at a
+    time: the hnet features of a client, joined with a learned embedding per chunk, go through one shared head,
+    which keeps the hypernetwork size and the activations bounded however wide the client MLP is.
+
+    With rank > 0 fc1 and fc2 are generated as rank-r factors U [out, r], V [in, r] and a bias for a
+    LowRankNN client, which applies them as x @ V @ U^T, so neither side ever holds the full matrices.
+    """
+    def __init__(self, n_nodes, embedding_dim, context_vector_size, hidden_size, hnet_hidden_dim = 100, hnet_n_hidden=3, chunk_size=0, chunk_embedding_dim=16, rank=0):
         super().__init__()
 
         self.n_nodes = n_nodes
@@ -13,6 +25,8 @@ class NNHyper(nn.Module):
         self.hidden_dim = hnet_hidden_dim
         self.n_hidden = hnet_n_hidden
         self.hidden_size = hidden_size
+        self.chunk_size = chunk_size
+        self.rank = rank
 
         self.embeddings = nn.Embedding(num_embeddings=self.n_nodes, embedding_dim=self.embedding_dim)
 
@@ -24,30 +38,66 @@ class NNHyper(nn.Module):
 
         self.mlp = nn.Sequential(*layers)
 
-        self.fc1_weights = nn.Linear(self.hidden_dim, 2 * self.context_vector_size * self.hidden_size)
-        self.fc1_bias = nn.Linear(self.hidden_dim, self.hidden_size)
-        self.fc2_weights = nn.Linear(self.hidden_dim, self.hidden_size * self.hidden_size)
-        self.fc2_bias = nn.Linear(self.hidden_dim, self.hidden_size)
-        self.fc3_weights = nn.Linear(self.hidden_dim, 1 * self.hidden_size)
-        self.fc3_bias = nn.Linear(self.hidden_dim, 1)
+        # target tensors in the order of NN.flat / LowRankNN.flat
+        if self.rank:
+            self.shapes = OrderedDict({
+                "fc1.U": (self.hidden_size, self.rank),
+                "fc1.V": (2*self.context_vector_size, self.rank),
+                "fc1.bias": (self.hidden_size,),
+                "fc2.U": (self.hidden_size, self.rank),
+                "fc2.V": (self.hidden_size, self.rank),
+                "fc2.bias": (self.hidden_size,),
+            })
+        else:
+            self.shapes = OrderedDict({
+                "fc1.weight": (self.hidden_size, 2*self.context_vector_size),
+                "fc1.bias": (self.hidden_size,),
+                "fc2.weight": (self.hidden_size, self.hidden_size),
+                "fc2.bias": (self.hidden_size,),
+            })
+        self.shapes["fc3.weight"] = (1, self.hidden_size)
+        self.shapes["fc3.bias"] = (1,)
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes.values()]
+
+        if self.chunk_size:
+            self.n_chunks = -(-sum(self.sizes) // self.chunk_size)
+            self.chunk_embeddings = nn.Parameter(torch.randn(self.n_chunks, chunk_embedding_dim))
+            self.chunk_mlp = nn.Linear(self.hidden_dim + chunk_embedding_dim, self.hidden_dim)
+            self.chunk_head = nn.Linear(self.hidden_dim, self.chunk_size)
+        else:
+            # one dense head per target tensor: fc1.weight -> fc1_weights, fc1.U -> fc1_U, ...
+            for name, size in zip(self.shapes, self.sizes):
+                setattr(self, self.head_name(name), nn.Linear(self.hidden_dim, size))
+
+    @staticmethod
+    def head_name(name):
+        return name.replace('.weight', '_weights').replace('.', '_')
+
+    def chunked_weights(self, features):
+        # [K, hidden_dim] features -> [K, n_weights] flat target weights, one shared head pass per chunk
+        # the first head layer is split in a features part and a chunk part, so [K, n_chunks, hidden_dim + chunk_embedding_dim] is never built
+        w = self.chunk_mlp.weight
+        h = F.linear(features, w[:, :self.hidden_dim], self.chunk_mlp.bias).unsqueeze(1) + F.linear(self.chunk_embeddings, w[:, self.hidden_dim:]).unsqueeze(0)
+        return self.chunk_head(F.relu(h)).flatten(1)[:, :sum(self.sizes)]
 
     def forward(self, context_vec, idx):
+        weights = self.forward_batch(context_vec.view(1, self.context_vector_size), idx.view(1))
+        return OrderedDict((name, tensor[0]) for name, tensor in weights.items())
+
+    def forward_batch(self, context_vecs, idx):
+        # one hypernetwork pass for K clients, weights come back with a leading K dim
+        k = len(idx)
         emd = self.embeddings(idx)
-        context_vec = context_vec.view(1, self.context_vector_size)
-        hnet_vector = context_vec.expand(len(context_vec), self.embedding_dim)
+        hnet_vector = context_vecs.view(k, self.context_vector_size)
         hnet_vector = torch.cat((emd, hnet_vector), dim=1)
         features = self.mlp(hnet_vector)
 
-        weights = OrderedDict({
-            "fc1.weight": self.fc1_weights(features).view(self.hidden_size, 2*self.context_vector_size),
-            "fc1.bias": self.fc1_bias(features).view(-1),
-            "fc2.weight": self.fc2_weights(features).view(self.hidden_size, self.hidden_size),
-            "fc2.bias": self.fc2_bias(features).view(-1),
-            "fc3.weight": self.fc3_weights(features).view(1, self.hidden_size),
-            "fc3.bias": self.fc3_bias(features).view(-1),
-        })
+        if self.chunk_size:
+            outputs = torch.split(self.chunked_weights(features), self.sizes, dim=1)
+        else:
+            outputs = [getattr(self, self.head_name(name))(features) for name in self.shapes]
 
-        return weights
+        return OrderedDict((name, tensor.view(k, *shape)) for (name, shape), tensor in zip(self.shapes.items(), outputs))
 
 class LRHyper(nn.Module):
     def __init__(self, device,n_nodes, embedding_dim, context_vector_size, hidden_size, hnet_hidden_dim = 100, hnet_n_hidden=3):
@@ -87,6 +137,21 @@ class LRHyper(nn.Module):
 
         return weights
 
+    def forward_batch(self, context_vecs, idx):
+        # one hypernetwork pass for K clients, weights come back with a leading K dim
+        k = len(idx)
+        emd = self.embeddings(idx)
+        hnet_vector = context_vecs.view(k, self.context_vector_size).to(self.device)
+        hnet_vector = torch.cat((emd, hnet_vector), dim=1)
+        features = self.mlp(hnet_vector)
+
+        weights = OrderedDict({
+            "fc1.weight": self.fc1_weights(features).view(k, 1, 2*self.context_vector_size),
+            "fc1.bias": self.fc1_bias(features).view(k, 1),
+        })
+
+        return weights
+
 class LR_Context(nn.Module):
     def __init__(self, input_size, context_vector_size, context_hidden_size, nn_hidden_size):
         super(LR_Context, self).__init__()
@@ -183,6 +248,10 @@ class LR_plain(nn.Module):
 
         return prediction
 
+def flatten_weights(weights):
+    # hypernetwork output dict -> one vector in the layout of LR.flat
+    return torch.cat([tensor.flatten() for tensor in weights.values()])
+
 class LR(nn.Module):
     def __init__(self, input_size, bound, fairness):
         super(LR, self).__init__()
@@ -192,86 +261,103 @@ class LR(nn.Module):
         self.bound = torch.Tensor([bound])
         self.sensitive_classes = [0, 1]
         self.input_size = input_size
-        self.fc1 = nn.Linear(2*self.input_size, 1)
+        self._build_layers()
         self.y_classes = [0, 1]
+        self.flat = None
+        self._bind_flat()
 
-        if self.fairness == 'dp':
-            self.n_constraints = 2 * self.num_classes
-            self.dim_condition = self.num_classes + 1
-            self.M = torch.zeros((self.n_constraints, self.dim_condition))
-
-            for i in range(self.n_constraints):
-                j = i % 2
-                if j == 0:
-                    self.M[i, j] = 1.0
-                    self.M[i, -1] = -1.0
-                else:
-                    self.M[i, j - 1] = -1.0
-                    self.M[i, -1] = 1.0
-
-        elif self.fairness == 'eo':
-            self.n_constraints = self.num_classes * self.num_classes * 2
-            self.dim_condition = self.num_classes * (self.num_classes + 1)
-            self.M = torch.zeros((self.n_constraints, self.dim_condition))
-
-            self.c = torch.zeros(self.n_constraints)
-            element_k_a = self.sensitive_classes + [None]
-
-            for i_a, a_0 in enumerate(self.sensitive_classes):
-                for i_y, y_0 in enumerate(self.y_classes):
-                    for i_s, s in enumerate([-1, 1]):
-                        for j_y, y_1 in enumerate(self.y_classes):
-                            for j_a, a_1 in enumerate(element_k_a):
-                                i = i_a * (2 * self.num_classes) + i_y * 2 + i_s
-                                j = j_y + self.num_classes * j_a
-                                self.M[i, j] = self.__element_M(a_0, a_1, y_1, y_1, s)
-
-    def __element_M(self, a0, a1, y0, y1, s):
-        if a0 is None or a1 is None:
-            x = y0 == y1
-            return -1 * s * x
-        else:
-            x = (a0 == a1) & (y0 == y1)
-            return s * float(x)
+        if self.fairness != 'none':
+            self.n_constraints, self.dim_condition = constraint_shape(self.fairness, self.num_classes, len(self.sensitive_classes))
+            self.register_buffer('M', constraint_matrix(self.fairness, self.num_classes, len(self.sensitive_classes)), persistent=False)
+            # M @ (mu - bound) == M @ mu - c, so the bound is folded into a per-client offset once
+            self.register_buffer('c', self.M.sum(1) * bound, persistent=False)
+
+    def _build_layers(self):
+        self.fc1 = nn.Linear(2*self.input_size, 1)
+
+    def logits(self, x):
+        return self.fc1(x)
+
+    def functional_logits(self, x, weights):
+        return F.linear(x, weights["fc1.weight"], weights["fc1.bias"])
+
+    def _bind_flat(self):
+        # every parameter is kept as a view into one contiguous buffer, self.flat, in registration order
+        # (fc1.weight, fc1.bias, ...), which is also the order of the hypernetwork's output dict
+        params = list(self.parameters())
+        offsets = np.cumsum([0] + [p.numel() for p in params])
+        if self.flat is not None and all(p.data_ptr() == self.flat[o:].data_ptr() for p, o in zip(params, offsets)):
+            return
+
+        self.flat = torch.cat([p.data.flatten() for p in params])
+        for p, o in zip(params, offsets):
+            p.data = self.flat[o:o + p.numel()].view_as(p)
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to()/.cuda() may replace the parameter storage, so re-point the views afterwards
+        super()._apply(fn, *args, **kwargs)
+        self._bind_flat()
+        if self.fairness != 'none':
+            # swap the private copy _apply made for the shared matrix on the new device
+            self.M = constraint_matrix(self.fairness, self.num_classes, len(self.sensitive_classes), self.M.device, self.M.dtype)
+        return self
+
+    @torch.no_grad()
+    def load_flat(self, flat_weights):
+        # flat_weights is fc1.weight followed by fc1.bias, as produced by flatten_weights
+        self.flat.copy_(flat_weights)
+
+    def group_sums(self, out, sensitive, y):
+        # sum and count of the predictions in every (sensitive, label) group, one scatter_add over the code s * C + y
+        n_groups = len(self.sensitive_classes) * self.num_classes
+        out = out.reshape(-1)
+        s = sensitive.reshape(-1).long()
+        y = y.reshape(-1).long()
+
+        # samples whose attribute or label falls outside the known classes only count towards the overall mean
+        valid = (s >= 0) & (s < len(self.sensitive_classes)) & (y >= 0) & (y < self.num_classes)
+        code = torch.where(valid, s * self.num_classes + y, torch.zeros_like(s))
+        weight = valid.to(out.dtype)
+
+        sums = out.new_zeros(n_groups).scatter_add(0, code, out * weight)
+        counts = out.new_zeros(n_groups).scatter_add(0, code, weight)
+        shape = (len(self.sensitive_classes), self.num_classes)
+        return sums.view(shape), counts.view(shape)
 
     def mu_f(self, out, sensitive, y):
-        expected_values_list = []
+        # empty groups get a mean of 0 (sum 0 over a count clamped to 1), so there is no data-dependent branch
+        sums, counts = self.group_sums(out, sensitive, y)
 
         if self.fairness == 'eo':
-            for u in self.sensitive_classes:
-                for v in self.y_classes:
-                    idx_true = (y == v) * (sensitive == u)
-                    if torch.sum(idx_true.type(torch.FloatTensor)) == 0:
-                        expected_values_list.append(out.mean() * 0)
-                    else:
-                        expected_values_list.append(out[idx_true].mean())
-
-            for v in self.y_classes:
-                idx_true = y == v
-                if torch.sum(idx_true.type(torch.FloatTensor)) == 0:
-                    expected_values_list.append(out.mean() * 0)
-                else:
-                    expected_values_list.append(out[idx_true].mean())
+            # E[f | s=u, y=v] for every (u, v), then E[f | y=v]
+            return torch.cat((
+                (sums / counts.clamp(min=1)).flatten(),
+                sums.sum(0) / counts.sum(0).clamp(min=1),
+            ))
 
         elif self.fairness == 'dp':
-            sensitive = sensitive.view(out.shape)
+            # E[f | s=u] for every u, then E[f]
+            return torch.cat((
+                sums.sum(1) / counts.sum(1).clamp(min=1),
+                out.mean().view(1),
+            ))
 
-            for v in self.sensitive_classes:
-                idx_true = sensitive == v
+    def M_mu_q(self, pred, sensitive, y):
+        return torch.mv(self.M, self.mu_f(pred, sensitive, y)) - self.c
 
-                if torch.sum(idx_true.type(torch.FloatTensor)) == 0:
-                    expected_values_list.append(out.mean()*0)
-                else:
-                    expected_values_list.append(out[idx_true].mean())
-            expected_values_list.append(out.mean())
+    def forward(self, x, s, y):
+        prediction = torch.sigmoid(self.logits(x))
 
-        return torch.stack(expected_values_list)
+        if self.fairness == 'none':
+            m_mu_q = None
+        else:
+            m_mu_q = self.M_mu_q(prediction, s, y)
 
-    def M_mu_q(self, pred, sensitive, y):
-        return torch.mv(self.M.to(pred.device), self.mu_f(pred, sensitive, y) - self.bound.to(pred.device))
+        return prediction, m_mu_q
 
-    def forward(self, x, s, y):
-        prediction = torch.sigmoid(self.fc1(x))
+    def functional_forward(self, x, s, y, weights):
+        # same as forward, but with generated weights bound directly instead of copied in through load_state_dict
+        prediction = torch.sigmoid(self.functional_logits(x, weights))
 
         if self.fairness == 'none':
             m_mu_q = None
@@ -279,6 +365,57 @@ class LR(nn.Module):
             m_mu_q = self.M_mu_q(prediction, s, y)
 
         return prediction, m_mu_q
+class NN(LR):
+    # the three-layer client MLP generated by NNHyper, same flat buffer and fairness terms as LR
+    def __init__(self, input_size, hidden_size, bound, fairness):
+        self.hidden_size = hidden_size
+        super().__init__(input_size, bound, fairness)
+
+    def _build_layers(self):
+        self.fc1 = nn.Linear(2*self.input_size, self.hidden_size)
+        self.fc2 = nn.Linear(self.hidden_size, self.hidden_size)
+        self.fc3 = nn.Linear(self.hidden_size, 1)
+
+    def logits(self, x):
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        return self.fc3(x)
+
+    def functional_logits(self, x, weights):
+        x = F.relu(F.linear(x, weights["fc1.weight"], weights["fc1.bias"]))
+        x = F.relu(F.linear(x, weights["fc2.weight"], weights["fc2.bias"]))
+        return F.linear(x, weights["fc3.weight"], weights["fc3.bias"])
+
+def low_rank_linear(x, U, V, bias):
+    # x @ (U @ V^T)^T + bias as two thin matmuls, O(r * (in + out)) per row instead of O(in * out)
+    return F.linear(x @ V, U, bias)
+
+class LowRankLinear(nn.Module):
+    def __init__(self, in_features, out_features, rank):
+        super().__init__()
+        self.U = nn.Parameter(torch.empty(out_features, rank).uniform_(-rank ** -0.5, rank ** -0.5))
+        self.V = nn.Parameter(torch.empty(in_features, rank).uniform_(-in_features ** -0.5, in_features ** -0.5))
+        self.bias = nn.Parameter(torch.empty(out_features).uniform_(-in_features ** -0.5, in_features ** -0.5))
+
+    def forward(self, x):
+        return low_rank_linear(x, self.U, self.V, self.bias)
+
+class LowRankNN(NN):
+    # NN with rank-r fc1 and fc2, the client model of NNHyper(rank=r)
+    def __init__(self, input_size, hidden_size, rank, bound, fairness):
+        self.rank = rank
+        super().__init__(input_size, hidden_size, bound, fairness)
+
+    def _build_layers(self):
+        self.fc1 = LowRankLinear(2*self.input_size, self.hidden_size, self.rank)
+        self.fc2 = LowRankLinear(self.hidden_size, self.hidden_size, self.rank)
+        self.fc3 = nn.Linear(self.hidden_size, 1)
+
+    def functional_logits(self, x, weights):
+        x = F.relu(low_rank_linear(x, weights["fc1.U"], weights["fc1.V"], weights["fc1.bias"]))
+        x = F.relu(low_rank_linear(x, weights["fc2.U"], weights["fc2.V"], weights["fc2.bias"]))
+        return F.linear(x, weights["fc3.weight"], weights["fc3.bias"])
+
 # class LR(nn.Module):
 #     def __init__(self, input_size, bound):
 #         super(LR, self).__init__()
@@ -384,14 +521,7 @@ class Constraint(torch.nn.Module):
             self.register_parameter(name='lmbda', param=torch.nn.Parameter(torch.rand((8,1))))
 
     def forward(self, value):
-        with torch.no_grad():
-            self.lmbda.data = self.lmbda.data.clamp(min=0, max=(np.linalg.norm(self.lmbda.data.cpu().numpy()) + (1/.05)))
-
-        for i, lm in enumerate(self.lmbda.data):
-            if lm.item() < 0:
-                print('hit', lm.item())
-                exit(1)
-
+        # lmbda is kept non-negative by DualAscent.project after every step
         loss = torch.matmul(self.lmbda.T, value)
 
         return loss
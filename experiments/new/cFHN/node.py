@@ -1,20 +1,113 @@
-from experiments.new.cFHN.dataset import gen_random_loaders
+from experiments.new.cFHN.dataset import gen_random_loaders, gen_tensor_loaders
+import numbers
 import torch
 
+CONTEXT_MODES = ['last', 'running', 'ema', 'window']
+
+class ContextStore:
+    """Context vectors c_i of all clients as one [n_nodes, d] tensor.
+
+    update() folds the mean context of a client's latest round into its row in place:
+    last keeps only that round (the original behaviour), running averages every round so far,
+    ema decays older rounds by `decay`, window averages the last `window` rounds.
+    store[i] is a [1, d] view of row i and store[ids] gathers several rows.
+    """
+    def __init__(self, vectors, mode='last', decay=0.9, window=10):
+        if mode not in CONTEXT_MODES:
+            raise ValueError(f"unknown context mode '{mode}', expected one of {CONTEXT_MODES}")
+        self.vectors = vectors
+        self.mode = mode
+        self.decay = decay
+        self.window = window
+        self.counts = torch.zeros(len(vectors), dtype=torch.long, device=vectors.device)
+        # ring buffer of the last rounds, only allocated in window mode
+        self.history = torch.zeros((len(vectors), window, vectors.shape[1]), dtype=vectors.dtype, device=vectors.device) if mode == 'window' else None
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, numbers.Integral):
+            return self.vectors[idx:idx + 1]
+        return self.vectors[idx]
+
+    def __setitem__(self, idx, value):
+        self.vectors[idx] = value.to(self.vectors.device, self.vectors.dtype).view(-1)
+
+    @torch.no_grad()
+    def update(self, idx, round_mean):
+        round_mean = round_mean.to(self.vectors.device, self.vectors.dtype).view(-1)
+        count = self.counts[idx]
+
+        if self.mode == 'last':
+            self.vectors[idx] = round_mean
+        elif self.mode == 'running':
+            self.vectors[idx] += (round_mean - self.vectors[idx]) / (count + 1)
+        elif self.mode == 'ema':
+            # the first round replaces the random initial vector instead of being decayed into it
+            weight = torch.where(count > 0, 1 - self.decay, 1.0)
+            self.vectors[idx] += weight * (round_mean - self.vectors[idx])
+        elif self.mode == 'window':
+            self.history[idx, count % self.window] = round_mean
+            self.vectors[idx] = self.history[idx].sum(0) / (count + 1).clamp(max=self.window)
+
+        self.counts[idx] += 1
+
+    def to(self, device):
+        self.vectors = self.vectors.to(device)
+        self.counts = self.counts.to(device)
+        if self.history is not None:
+            self.history = self.history.to(device)
+        return self
+
+    def state_dict(self):
+        return {'vectors': self.vectors, 'counts': self.counts, 'history': self.history}
+
+    def load_state_dict(self, state):
+        self.vectors.copy_(state['vectors'])
+        self.counts.copy_(state['counts'])
+        if self.history is not None and state['history'] is not None:
+            self.history.copy_(state['history'])
+
+def random_contexts(n_nodes, d, mode='last', decay=0.9, window=10):
+    # one rand call per client, so seeded runs draw the same initial vectors as the old list of tensors
+    return ContextStore(torch.cat([torch.rand((1, d)) for i in range(n_nodes)]), mode, decay, window)
+
 class BaseNodes:
-    def __init__(self, data_name, n_nodes, batch_size, classes_per_node):
+    def __init__(self, data_name, n_nodes, batch_size, classes_per_node, cache_dir=None, compas_path=None,
+                 partition='sort', partition_by=None, dirichlet_beta=0.5, shards_per_client=2, context_mode='last', context_decay=0.9, context_window=10, pin_memory=False):
         self.data_name = data_name
         self.n_nodes = n_nodes
         self.batch_size = batch_size
         self.classes_per_node = classes_per_node
+        self.cache_dir = cache_dir
+        self.compas_path = compas_path
+        self.pin_memory = pin_memory
+        self.partition_kwargs = dict(partition=partition, partition_by=partition_by, dirichlet_beta=dirichlet_beta, shards_per_client=shards_per_client)
+        self.context_kwargs = dict(mode=context_mode, decay=context_decay, window=context_window)
         self.train_loaders, self.test_loaders, self.features = None, None, None
         self.c_i = None
         self._init_dataloaders()
 
     def _init_dataloaders(self):
-        loaders, self.features = gen_random_loaders(self.data_name, self.n_nodes, self.batch_size)
+        loaders, self.features = gen_random_loaders(self.data_name, self.n_nodes, self.batch_size, self.cache_dir, self.compas_path, self.pin_memory, **self.partition_kwargs)
         self.train_loaders, self.test_loaders = loaders
-        self.c_i = [torch.rand((1, len(self.features))) for i in range(self.n_nodes)]
+        self.c_i = random_contexts(self.n_nodes, len(self.features), **self.context_kwargs)
+
+    def client_sizes(self):
+        # training rows per client
+        return self.train_loaders.clients.sizes()
 
     def __len__(self):
-        return self.n_nodes
\ No newline at end of file
+        return self.n_nodes
+
+class TensorNodes(BaseNodes):
+    # same surface as BaseNodes, but every client split stays resident as one tensor on device
+    def __init__(self, data_name, n_nodes, batch_size, classes_per_node, device='cpu', cache_dir=None, compas_path=None, **kwargs):
+        self.device = device
+        super().__init__(data_name, n_nodes, batch_size, classes_per_node, cache_dir, compas_path, **kwargs)
+
+    def _init_dataloaders(self):
+        loaders, self.features = gen_tensor_loaders(self.data_name, self.n_nodes, self.batch_size, self.device, self.cache_dir, self.compas_path, **self.partition_kwargs)
+        self.train_loaders, self.test_loaders = loaders
+        self.c_i = random_contexts(self.n_nodes, len(self.features), **self.context_kwargs).to(self.device)
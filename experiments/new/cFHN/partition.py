@@ -0,0 +1,89 @@
+import numpy as np
+
+PARTITIONS = ['sort', 'iid', 'dirichlet', 'shard']
+
+# clients need at least two rows, the context network's BatchNorm cannot train on a batch of one
+MIN_CLIENT_SIZE = 2
+
+class ClientArrays:
+    """Every client of one split as a contiguous row range of a single shared X/y.
+
+    Rows are reordered once by client id, so client i is X[offsets[i]:offsets[i + 1]] (a view, no copy) and
+    the per-client bookkeeping is one offsets array, whatever the number of clients.
+    """
+    def __init__(self, X, y, client_ids, num_clients):
+        order = np.argsort(client_ids, kind='stable')
+        self.X = np.ascontiguousarray(X[order])
+        self.y = np.ascontiguousarray(y[order])
+        self.offsets = np.zeros(num_clients + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(client_ids, minlength=num_clients))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.X[start:end], self.y[start:end]
+
+    def sizes(self):
+        return np.diff(self.offsets)
+
+def check_size(n, num_clients, min_size):
+    if n < num_clients * min_size:
+        raise ValueError(f"{n} rows cannot give {num_clients} clients at least {min_size} rows each")
+
+def sorted_first_set_range(sizes, splits, num_clients, min_size=MIN_CLIENT_SIZE):
+    # the values of first_set for which assign_sorted gives every client at least min_size rows in every split
+    lo = max([1] + [num_clients - (n - split) // min_size for n, split in zip(sizes, splits)])
+    hi = min([num_clients - 1] + [(split - 1) // min_size for split in splits])
+    if lo > hi:
+        raise ValueError(f"the sort partition cannot give {num_clients} clients at least {min_size} rows each on both sides of the split")
+    return lo, hi
+
+def assign_sorted(n, split, num_clients, first_set):
+    # the original split of a split sorted by one feature: the first `first_set` clients share the rows before
+    # `split`, the others share the rest, and the last client takes the remainder
+    check_size(split - 1, first_set, MIN_CLIENT_SIZE)
+    check_size(n - split, num_clients - first_set, MIN_CLIENT_SIZE)
+    amounts = [int((split - 1) / first_set)] * first_set + [int((n - split) / (num_clients - first_set))] * (num_clients - first_set)
+    amounts[-1] = max(0, n - sum(amounts[:-1]))
+    client_ids = np.repeat(np.arange(num_clients), amounts)
+    return client_ids[:n]
+
+def assign_iid(n, num_clients, rng=np.random):
+    check_size(n, num_clients, MIN_CLIENT_SIZE)
+    return rng.permutation(np.arange(n) % num_clients)
+
+def assign_dirichlet(groups, proportions, min_size=MIN_CLIENT_SIZE, rng=np.random):
+    # groups: group code of every row (label or sensitive attribute), proportions: [n_groups, num_clients], rows sum to 1
+    n, num_clients = len(groups), proportions.shape[1]
+    check_size(n, num_clients, min_size)
+
+    client_ids = np.empty(n, dtype=np.int64)
+    perm = rng.permutation(n)
+
+    # every client first gets min_size uniformly drawn rows, so no client ends up empty however skewed the draw
+    n_floor = num_clients * min_size
+    client_ids[perm[:n_floor]] = np.arange(n_floor) % num_clients
+
+    rest = perm[n_floor:]
+    for g in range(proportions.shape[0]):
+        idx = rest[groups[rest] == g]
+        cuts = (np.cumsum(proportions[g])[:-1] * len(idx)).astype(np.int64)
+        amounts = np.diff(np.concatenate(([0], cuts, [len(idx)])))
+        client_ids[idx] = np.repeat(np.arange(num_clients), amounts)
+
+    return client_ids
+
+def assign_shards(values, num_clients, shard_perm):
+    # sort by `values`, cut into len(shard_perm) equal contiguous shards and hand them out as shard_perm says
+    n, n_shards = len(values), len(shard_perm)
+    check_size(n, n_shards, 1)
+
+    order = np.argsort(values, kind='stable')
+    shard_of_rank = np.arange(n) * n_shards // n
+    client_ids = np.empty(n, dtype=np.int64)
+    client_ids[order] = (shard_perm % num_clients)[shard_of_rank]
+    return client_ids
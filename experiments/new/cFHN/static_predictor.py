@@ -0,0 +1,41 @@
+import os
+import json
+import numpy as np
+
+# file names inside an export dir, shared with export.py
+WEIGHTS_FILE = 'weights.npy'
+META_FILE = 'meta.json'
+
+class StaticPredictor:
+    """Serves the per-client LR models written by export.export_static_models, with NumPy only.
+
+    Row i of the [n_clients, d+1] weight array is client i's weights on the d raw features followed by its
+    bias, the frozen context term already folded in. The array is memory-mapped by default, so a host
+    loads only the pages of the clients it actually serves.
+    """
+    def __init__(self, path, mmap=True):
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.weights = np.load(os.path.join(path, WEIGHTS_FILE), mmap_mode='r' if mmap else None)
+        self.n_clients, self.num_features = self.weights.shape[0], self.weights.shape[1] - 1
+
+    def __len__(self):
+        return self.n_clients
+
+    def decision_function(self, client_ids, X):
+        # logits of the rows of X [B, d], client_ids is one client for all rows or one per row
+        X = np.asarray(X, dtype=self.weights.dtype)
+        if X.ndim != 2 or X.shape[1] != self.num_features:
+            raise ValueError(f"expected rows of {self.num_features} features, got shape {X.shape}")
+        if np.ndim(client_ids) == 0:
+            w = self.weights[client_ids]
+            return X @ w[:-1] + w[-1]
+        w = self.weights[np.asarray(client_ids)]
+        return np.einsum('bd,bd->b', X, w[:, :-1]) + w[:, -1]
+
+    def predict_proba(self, client_ids, X):
+        # sigmoid written as exp(-log(1 + exp(-z))) so large |z| neither overflows nor warns
+        return np.exp(-np.logaddexp(0, -self.decision_function(client_ids, X)))
+
+    def predict(self, client_ids, X, threshold=0.5):
+        return (self.predict_proba(client_ids, X) > threshold).astype(np.int64)
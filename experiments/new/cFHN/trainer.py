@@ -1,5 +1,4 @@
 import os
-os.environ['CUDA_VISIBLE_DEVICES'] = "1, 2, 3, 4, 5, 6, 7"
 import argparse
 import logging
 import random
@@ -10,17 +9,32 @@ import torch
 import pandas as pd
 import torch.utils.data
 from tqdm import trange
-from experiments.new.cFHN.models import LR, Context, LRHyper, Constraint
-from experiments.new.cFHN.node import BaseNodes
-from experiments.new.cFHN.utils import seed_everything, set_logger, TP_FP_TN_FN, metrics
+from experiments.new.cFHN.models import LR, NN, LowRankNN, Context, LRHyper, NNHyper, Constraint
+from experiments.new.cFHN.node import BaseNodes, TensorNodes, CONTEXT_MODES
+from experiments.new.cFHN.partition import PARTITIONS
+from experiments.new.cFHN.async_workers import run_async, STALENESS_POLICIES
+from experiments.new.cFHN.batched_eval import evaluate_batched
+from experiments.new.cFHN.batched_train import train_clients_batched
+from experiments.new.cFHN.eval_scheduler import EvalScheduler
+from experiments.new.cFHN.export import export_static_models, EXPORT_CONTEXTS
+from experiments.new.execution import add_execution_args, execution_from_args
+from experiments.new.dual import DualAscent
+from experiments.new.profiling import NO_TIMER, add_profiling_args, profiler_from_args
+from experiments.new.checkpoint import pack_optimizer_states, load_optimizer_states, pack_module_states, load_module_states, rng_state, set_rng_state, add_checkpoint_args, checkpoints_from_args
+from experiments.new.sampling import make_sampler, add_sampler_args
+from experiments.new.cFHN.utils import seed_everything, set_logger, ConfusionCounts, Reservoir, metrics
 from torch.utils.tensorboard import SummaryWriter
 import matplotlib.pyplot as plt
 import seaborn as sn
 
 warnings.filterwarnings("ignore")
 
-def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, device, fair, constraint, alpha, confusion, which_position):
-    curr_results, pred, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd = evaluate(nodes, num_nodes, hnet, model, cnet, num_features, loss, device, fair, constraint, alpha, which_position)
+def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, ctx, fair, constraint, alpha, confusion, which_position, reservoir_size=10000, engine='loop'):
+    # predictions/labels are only kept (as a bounded sample) when they are needed for the confusion plots
+    if engine == 'batched':
+        curr_results, pred, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd = evaluate_batched(nodes, num_nodes, hnet, model, cnet, num_features, loss, ctx, fair, constraint, alpha, which_position, reservoir_size if confusion else 0)
+    else:
+        curr_results, pred, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd = evaluate(nodes, num_nodes, hnet, model, cnet, num_features, loss, ctx, fair, constraint, alpha, which_position, reservoir_size if confusion else 0)
     total_correct = sum([val['correct'] for val in curr_results.values()])
     total_samples = sum([val['total'] for val in curr_results.values()])
     avg_loss = np.mean([val['loss'] for val in curr_results.values()])
@@ -46,7 +60,7 @@ def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, device,
     return curr_results, avg_loss, avg_acc, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd
 
 @torch.no_grad()
-def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, device, fair, constraints, alpha, which_position):
+def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, ctx, fair, constraints, alpha, which_position, reservoir_size=0):
     hnet.eval()
     results = defaultdict(lambda: defaultdict(list))
     preds = []
@@ -54,48 +68,46 @@ def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, device,
     f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd = [], [], [], [], [], [], [], [], []
 
     for node_id in range(num_nodes):
-        pred_client = []
-        true_client = []
-        queries_client = []
+        counts = ConfusionCounts()
+        reservoir = Reservoir(reservoir_size)
         model = models[node_id]
         cnet = cnets[node_id]
         constraint = constraints[node_id]
 
-        model.to(device)
-        cnet.to(device)
-        constraint.to(device)
+        ctx.module(model)
+        ctx.module(cnet)
+        ctx.module(constraint)
 
         running_loss, running_correct, running_samples = 0, 0, 0
 
         curr_data = nodes.test_loaders[node_id]
 
         for batch_count, batch in enumerate(curr_data):
-            x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-            s = x[:, which_position].to(device)
-
-            true_client.extend(y.cpu().numpy())
-            queries_client.extend(x.cpu().numpy())
+            x, y = ctx.batch(batch)
+            s = x[:, which_position]
 
             avg_context_vector, prediction_vector = cnet(x, num_features)
-            weights = hnet(avg_context_vector, torch.tensor([node_id], dtype=torch.long).to(device))
-            model.load_state_dict(weights)
+            weights = hnet(avg_context_vector, ctx.index(node_id))
 
-            pred, m_mu_q = model(prediction_vector, s, y) # y is only passed to calculate m_mu_q
+            pred, m_mu_q = model.functional_forward(prediction_vector, s, y, weights) # y is only passed to calculate m_mu_q
 
             pred_thresh = (pred > 0.5).long()
-            pred_client.extend(pred_thresh.flatten().cpu().numpy())
+            counts.update(s, y, pred_thresh)
+            reservoir.update(y, pred_thresh)
 
+            # running sums stay on device, they are read once per client below
             if fair == 'none':
-                running_loss += loss(pred, y.unsqueeze(1)).item()
+                running_loss += loss(pred, y.unsqueeze(1))
             else:
-                running_loss += ((loss(pred, y.unsqueeze(1)) + alpha*constraint(m_mu_q).to(device)).item()) / len(batch)
+                running_loss += (loss(pred, y.unsqueeze(1)) + alpha*constraint(m_mu_q)).squeeze() / len(batch)
 
-            correct = torch.eq(pred_thresh,y.unsqueeze(1)).type(torch.cuda.LongTensor)
-            running_correct += torch.count_nonzero(correct).item()
+            running_correct += torch.eq(pred_thresh,y.unsqueeze(1)).sum()
 
             running_samples += len(y)
 
-        tp, fp, tn, fn = TP_FP_TN_FN(queries_client, pred_client, true_client, which_position)
+        running_loss, running_correct = float(running_loss), int(running_correct)
+        tp, fp, tn, fn = counts.TP_FP_TN_FN()
+        true_client, pred_client = reservoir.samples()
 
         f1_score_prediction, f1_female, f1_male, accuracy, f_acc, m_acc, AOD, EOD, SPD = metrics(tp, fp, tn, fn)
         f1.append(f1_score_prediction)
@@ -115,7 +127,103 @@ def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, device,
 
     return results, preds, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd
 
-def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,inner_steps,lr,inner_lr,wd,inner_wd, hyper_hid,n_hidden,bs, alpha,fair, which_position):
+def train_client(nodes, node_id, flat_weights, model, cnet, constraint, dual, loss, alpha, optimizer, inner_steps, num_features, ctx, fair, which_position, timer=NO_TIMER):
+    ctx.module(model)
+    ctx.module(cnet)
+    ctx.module(constraint)
+
+    # the generated weights are written straight into the model's flat parameter buffer
+    with timer.phase('load_weights'):
+        model.load_flat(flat_weights)
+
+    context_sum = 0
+    running_err = 0
+
+    for j in range(inner_steps):
+        model.train()
+
+        dual.zero_grad()
+        if optimizer is not None:
+            optimizer.zero_grad()
+
+        with timer.phase('data'):
+            batch = next(iter(nodes.train_loaders[node_id]))
+            x, y = ctx.batch(batch)
+            s = x[:,which_position]
+
+        with timer.phase('inner_forward'):
+            avg_context_vector, pred_vec = cnet(x, num_features)
+            pred, m_mu_q = model(pred_vec, s, y) # we pass y only for m_mu_q calculation
+
+            context_sum = context_sum + avg_context_vector.detach()
+
+            if fair == 'none':
+                err = loss(pred, y.unsqueeze(1))
+            else:
+                err = loss(pred, y.unsqueeze(1)) + alpha*constraint(m_mu_q)
+
+        with timer.phase('inner_backward'):
+            err.backward()
+            running_err += err.detach().sum()
+
+        # descent on the model and context net, projected ascent on the multipliers
+        with timer.phase('inner_step'):
+            dual.step()
+        timer.count('inner_steps')
+        timer.count('samples', len(y))
+
+    with timer.phase('context_update'):
+        nodes.c_i.update(node_id, context_sum / inner_steps)
+
+    delta_theta = flat_weights.detach() - model.flat
+
+    # the loss stays on device, only a loss-driven sampler pulls it to the host
+    return delta_theta, running_err / inner_steps
+
+def outer_step(nodes, node_ids, hnet, optimizer, models, cnets, constraints, client_duals, client_losses, alphas, inner_steps, num_features, ctx, fair, which_position, timer=NO_TIMER, inner_engine='loop'):
+    # generate the weights of all sampled clients with a single hypernetwork pass
+    with timer.phase('hnet_forward'):
+        context_vecs = ctx.float(nodes.c_i[node_ids])
+        batch_weights = hnet.forward_batch(context_vecs, ctx.index(node_ids))
+        flat_weights = torch.cat([tensor.reshape(len(node_ids), -1) for tensor in batch_weights.values()], dim=1)
+
+    if inner_engine == 'batched':
+        batch_deltas, step_losses = train_clients_batched(nodes, node_ids, flat_weights, models, cnets, constraints, client_duals, alphas,
+                                                          inner_steps, num_features, ctx, fair, which_position, timer)
+        timer.count('clients', len(node_ids))
+    else:
+        batch_deltas = []
+        step_losses = []
+
+        for k_i, node_id in enumerate(node_ids):
+            delta_theta, client_loss = train_client(nodes, node_id, flat_weights[k_i], models[node_id], cnets[node_id], constraints[node_id],
+                                       client_duals[node_id], client_losses[node_id],
+                                       alphas[node_id], optimizer, inner_steps, num_features, ctx, fair, which_position, timer)
+
+            batch_deltas.append(delta_theta)
+            step_losses.append(client_loss)
+            timer.count('clients')
+        batch_deltas = torch.stack(batch_deltas)
+
+    # average the hypergradients of the sampled clients
+    with timer.phase('hnet_grad'):
+        optimizer.zero_grad()
+        hnet_grads = torch.autograd.grad(flat_weights, hnet.parameters(), grad_outputs=batch_deltas / len(node_ids))
+
+        for p, g in zip(hnet.parameters(), hnet_grads):
+            p.grad = g
+
+    with timer.phase('hnet_step'):
+        optimizer.step()
+
+    return step_losses
+
+def train(writer, ctx, data_name,model_name,classes_per_node,num_nodes,steps,inner_steps,lr,inner_lr,wd,inner_wd, hyper_hid,n_hidden,bs, alpha,fair, which_position, clients_per_step=1, loader='torch', cache_dir=None, compas_path=None,
+          partition='sort', partition_by=None, dirichlet_beta=0.5, shards_per_client=2, sampler='uniform', max_staleness=None, sampler_log_every=100,
+          workers=0, staleness='weight', max_update_staleness=None, context_mode='last', context_decay=0.9, context_window=10,
+          checkpoints=None, resume=False, timer=NO_TIMER, profile_log_every=100, eval_engine='loop',
+          eval_every=0, eval_shard_rows=None, eval_background=False, eval_log_clients=4, nn_hidden=None, hnet_chunk_size=0, hnet_chunk_dim=16, hnet_rank=0,
+          export_dir=None, export_context='data', inner_engine='loop'):
     avg_acc = [[] for i in range(num_nodes + 1)]
     all_f1 = [[] for i in range(num_nodes)]
     all_aod = [[] for i in range(num_nodes)]
@@ -127,14 +235,21 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
     constraints = []
     client_fairness = []
     client_optimizers = []
+    client_duals = []
     client_losses = []
     combo_parameters = []
     alphas = []
 
+    node_kwargs = dict(partition=partition, partition_by=partition_by, dirichlet_beta=dirichlet_beta, shards_per_client=shards_per_client,
+                            context_mode=context_mode, context_decay=context_decay, context_window=context_window)
+
     for i in range(1):
         seed_everything(0)
 
-        nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node)
+        if loader == 'tensor':
+            nodes = TensorNodes(data_name, num_nodes, bs, classes_per_node, device=ctx.device, cache_dir=cache_dir, compas_path=compas_path, **node_kwargs)
+        else:
+            nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node, cache_dir=cache_dir, compas_path=compas_path, pin_memory=ctx.pin_memory, **node_kwargs)
         num_features = len(nodes.features)
         embed_dim = num_features
 
@@ -156,136 +271,123 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
         elif fair == 'none':
             client_fairness = ['none' for i in range(num_nodes)]
             alphas = ['none' for i in range(num_nodes)]
-        hnet = LRHyper(device=device, n_nodes=num_nodes, embedding_dim=embed_dim, context_vector_size=num_features,
-                       hidden_size=num_features, hnet_hidden_dim=hyper_hid, hnet_n_hidden=n_hidden)
+        if model_name == 'NN':
+            nn_hidden = nn_hidden or num_features
+            hnet = NNHyper(n_nodes=num_nodes, embedding_dim=embed_dim, context_vector_size=num_features, hidden_size=nn_hidden,
+                           hnet_hidden_dim=hyper_hid, hnet_n_hidden=n_hidden, chunk_size=hnet_chunk_size, chunk_embedding_dim=hnet_chunk_dim, rank=hnet_rank)
+        else:
+            hnet = LRHyper(device=ctx.device, n_nodes=num_nodes, embedding_dim=embed_dim, context_vector_size=num_features,
+                           hidden_size=num_features, hnet_hidden_dim=hyper_hid, hnet_n_hidden=n_hidden)
 
         # Set models for all clients
         for i in range(num_nodes):
-            models.append(LR(input_size=num_features, bound=0.05, fairness=client_fairness[i]))
-            cnets.append(Context(input_size=num_features, context_vector_size=num_features, context_hidden_size=100))
-            constraints.append(Constraint(fair=client_fairness[i]))
+            if model_name == 'NN' and hnet_rank:
+                models.append(ctx.module(LowRankNN(input_size=num_features, hidden_size=nn_hidden, rank=hnet_rank, bound=0.05, fairness=client_fairness[i])))
+            elif model_name == 'NN':
+                models.append(ctx.module(NN(input_size=num_features, hidden_size=nn_hidden, bound=0.05, fairness=client_fairness[i])))
+            else:
+                models.append(ctx.module(LR(input_size=num_features, bound=0.05, fairness=client_fairness[i])))
+            cnets.append(ctx.module(Context(input_size=num_features, context_vector_size=num_features, context_hidden_size=100)))
+            constraints.append(ctx.module(Constraint(fair=client_fairness[i])))
             #constraints.append(Constraint())
             if fair == 'none':
                 combo_parameters.append(list(models[i].parameters()) + list(cnets[i].parameters()))
             else:
                 combo_parameters.append(list(models[i].parameters()) + list(cnets[i].parameters()) + list(constraints[i].parameters()))
             client_optimizers.append(torch.optim.Adam(combo_parameters[i], lr=inner_lr, weight_decay=inner_wd))
+            client_duals.append(DualAscent(constraints[i].parameters(), client_optimizers[i]))
             client_losses.append(torch.nn.BCELoss())
-        hnet.to(device)
+        ctx.module(hnet)
 
         optimizer = torch.optim.Adam(params=hnet.parameters(), lr=lr, weight_decay=wd)
 
-        step_iter = trange(steps)
-
-        for step in step_iter:
+        clients_per_step = min(clients_per_step, num_nodes)
+        client_sampler = make_sampler(sampler, num_nodes, sizes=nodes.client_sizes(), max_staleness=max_staleness)
+
+        start_step = 0
+        if checkpoints is not None and workers > 0:
+            raise ValueError("checkpointing is not supported with asynchronous workers, the client state lives in the worker processes")
+        if eval_every > 0 and workers > 0:
+            raise ValueError("evaluation during training is not supported with asynchronous workers, the client state lives in the worker processes")
+        if timer.enabled and workers > 0:
+            raise ValueError("phase profiling is not supported with asynchronous workers, the phases run in the worker processes")
+        if inner_engine == 'batched' and (model_name != 'LR' or workers > 0):
+            raise ValueError("batched inner steps cover synchronous training of LR client models only")
+        state = checkpoints.load() if checkpoints is not None and resume else None
+        if state is not None:
+            start_step, node_ids = state['step'], state['node_ids']
+            hnet.load_state_dict(state['hnet'])
+            optimizer.load_state_dict(state['optimizer'])
+            load_module_states(models, state['models'])
+            load_module_states(cnets, state['cnets'])
+            load_module_states(constraints, state['constraints'])
+            load_optimizer_states(client_optimizers, state['client_optimizers'])
+            nodes.c_i.load_state_dict(state['c_i'])
+            client_sampler.load_state_dict(state['sampler'])
+            # restoring the loaders draws fresh permutations, the rng goes last so it is exactly as saved
+            nodes.train_loaders.load_state_dict(state['train_loaders'])
+            set_rng_state(state['rng'])
+
+        step_iter = trange(start_step, steps)
+
+        eval_scheduler = EvalScheduler(eval_model, nodes, num_nodes, num_features, ctx, fair, which_position, every=eval_every, writer=writer, engine=eval_engine,
+                                       shard_rows=eval_shard_rows, background=eval_background, log_clients=eval_log_clients)
+
+        if workers > 0:
             hnet.train()
-            node_id = random.choice(range(num_nodes))
-
-            # get client models and optimizers
-            model = models[node_id]
-            cnet = cnets[node_id]
-            constraint = constraints[node_id]
-            combo_params = combo_parameters[node_id]
-            alpha = alphas[node_id]
-            loss = client_losses[node_id]
-            model.to(device)
-            cnet.to(device)
-            constraint.to(device)
-
-            inner_optim = client_optimizers[node_id]
+            node_ids = [run_async(step_iter, workers, train_client, nodes, hnet, optimizer, models, cnets, constraints, client_duals, client_losses,
+                                  alphas, inner_steps, num_features, ctx, fair, which_position, sampler, max_staleness, staleness, max_update_staleness)]
 
-            node_c_i = nodes.c_i[node_id]
-
-            weights = hnet(node_c_i, torch.tensor([node_id], dtype=torch.long).to(device))
-            model.load_state_dict(weights)
-
-            inner_state = OrderedDict({k: tensor.data for k, tensor in weights.items()})
-
-            avg_c_i = []
-
-
-            for j in range(inner_steps):
-                model.train()
-
-                inner_optim.zero_grad()
-                optimizer.zero_grad()
-
-                batch = next(iter(nodes.train_loaders[node_id]))
-                x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-                s = x[:,which_position].to(device)
-
-                avg_context_vector, pred_vec = cnet(x, num_features)
-                pred, m_mu_q = model(pred_vec, s, y) # we pass y only for m_mu_q calculation
-
-                avg_c_i.append(avg_context_vector)
-
-                if fair == 'none':
-                    err = loss(pred, y.unsqueeze(1))
-                else:
-                    err = loss(pred, y.unsqueeze(1)) + alpha*constraint(m_mu_q)
-
-                err.backward()
-
-                if fair != 'none':
-                    combo_params[len(combo_params) - 1].grad.data = -1 * combo_params[len(combo_params) - 1].grad.data
-
-                inner_optim.step()
-
-            nodes.c_i[node_id] = torch.cuda.FloatTensor([sum(sub_list) / len(sub_list) for sub_list in zip(*avg_c_i)])
+        # the synchronous loop, empty when the workers already ran the steps
+        for step in (step_iter if workers == 0 else []):
+            timer.step(step)
+            hnet.train()
 
-            optimizer.zero_grad()
-            final_state = model.state_dict()
-            delta_theta = OrderedDict({k: inner_state[k] - final_state[k] for k in weights.keys()})
-            hnet_grads = torch.autograd.grad(list(weights.values()), hnet.parameters(), grad_outputs=list(delta_theta.values()))
-
-            for p, g in zip(hnet.parameters(), hnet_grads):
-                p.grad = g
-
-            optimizer.step()
-
-            # if step % 99 == 0 or step == 1999 or step == 0:
-            #     step_results, avg_loss, avg_acc_all, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = eval_model(nodes, num_nodes, hnet, models, cnets, num_features, loss, device, confusion=False, fair=fair, constraint=constraints, alpha=alpha, which_position=which_position)
-            #
-            #     logging.info(f"\nStep: {step + 1}, AVG Loss: {avg_loss:.4f},  AVG Acc: {avg_acc_all:.4f}")
-            #     # writer.add_scalars('testing accuracy', {
-                #     'average': avg_acc,
-                #     'client 1': all_acc[0],
-                #     'client 2': all_acc[1],
-                #     'client 3': all_acc[2],
-                #     'client 4': all_acc[3]
-                # }, step)
-                # writer.add_scalars('testing loss', {
-                #     'average': avg_loss,
-                #     'client 1': all_loss[0],
-                #     'client 2': all_loss[1],
-                #     'client 3': all_loss[2],
-                #     'client 4': all_loss[3]
-                # }, step)
-                # writer.add_scalars('AOD', {
-                #     'average': np.mean(aod),
-                #     'client 1': aod[0],
-                #     'client 2': aod[1],
-                #     'client 3': aod[2],
-                #     'client 4': aod[3]
-                # }, step)
-                # writer.add_scalars('EOD', {
-                #     'average': np.mean(eod),
-                #     'client 1': eod[0],
-                #     'client 2': eod[1],
-                #     'client 3': eod[2],
-                #     'client 4': eod[3]
-                # }, step)
-                # writer.add_scalars('SPD', {
-                #     'average': np.mean(spd),
-                #     'client 1': spd[0],
-                #     'client 2': spd[1],
-                #     'client 3': spd[2],
-                #     'client 4': spd[3]
-                # }, step)
-
-
-        step_results, avg_loss, avg_acc_all, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = eval_model(nodes, num_nodes, hnet, models, cnets, num_features, loss, device, confusion=False,fair=fair, constraint=constraints, alpha=alpha, which_position=which_position)
+            with timer.phase('sample'):
+                node_ids = client_sampler.sample(clients_per_step)
+
+            step_losses = outer_step(nodes, node_ids, hnet, optimizer, models, cnets, constraints, client_duals, client_losses, alphas,
+                                     inner_steps, num_features, ctx, fair, which_position, timer, inner_engine)
+            for node_id, client_loss in zip(node_ids, step_losses):
+                client_sampler.update(node_id, client_loss)
+
+            if sampler_log_every and (step + 1) % sampler_log_every == 0:
+                sampler_stats = client_sampler.stats()
+                logging.info(f"Step: {step + 1}, sampler: {sampler_stats}")
+                if writer is not None:
+                    writer.add_scalars('sampler', sampler_stats, step)
+
+            if profile_log_every and (step + 1) % profile_log_every == 0:
+                timer.write_tensorboard(writer, step)
+
+            if checkpoints is not None and checkpoints.due(step):
+                checkpoints.save(step + 1, {
+                    'node_ids': node_ids,
+                    'hnet': hnet.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'models': pack_module_states(models),
+                    'cnets': pack_module_states(cnets),
+                    'constraints': pack_module_states(constraints),
+                    'client_optimizers': pack_optimizer_states(client_optimizers),
+                    'c_i': nodes.c_i.state_dict(),
+                    'sampler': client_sampler.state_dict(),
+                    'train_loaders': nodes.train_loaders.state_dict(),
+                    'rng': rng_state(),
+                })
+
+            if eval_scheduler.due(step):
+                with timer.phase('eval'):
+                    eval_scheduler.run(step, hnet, models, cnets, constraints, client_losses[node_ids[-1]], alphas[node_ids[-1]])
+
+        eval_scheduler.close()
+        timer.close(writer, steps)
+
+        loss = client_losses[node_ids[-1]]
+        alpha = alphas[node_ids[-1]]
+        step_results, avg_loss, avg_acc_all, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = eval_model(nodes, num_nodes, hnet, models, cnets, num_features, loss, ctx, confusion=False,fair=fair, constraint=constraints, alpha=alpha, which_position=which_position, engine=eval_engine)
         logging.info(f"\n\nFinal Results | AVG Loss: {avg_loss:.4f},  AVG Acc: {avg_acc_all:.4f}")
+        if export_dir is not None:
+            export_static_models(export_dir, nodes, num_nodes, hnet, models, cnets, num_features, ctx, which_position, context=export_context)
         avg_acc[0].append(avg_acc_all)
         for i in range(num_nodes):
             avg_acc[i + 1].append(all_acc[i])
@@ -317,11 +419,24 @@ def main():
     parser = argparse.ArgumentParser(description="Fair Hypernetworks")
 
     parser.add_argument("--data_name", type=str, default="adult", choices=["adult", "compas"], help="choice of dataset")
+    parser.add_argument("--cache_dir", type=str, default=None, help="dir for the preprocessed dataset cache")
+    parser.add_argument("--compas_path", type=str, default=None, help="local copy of compas-scores-two-years.csv")
     parser.add_argument("--model_name", type=str, default="LR", choices=["NN", "LR"], help="choice of model")
     parser.add_argument("--num_nodes", type=int, default=4, help="number of simulated clients")
     parser.add_argument("--num_steps", type=int, default=2000)
     parser.add_argument("--batch_size", type=int, default=256)
     parser.add_argument("--inner_steps", type=int, default=50, help="number of inner steps")
+    parser.add_argument("--clients_per_step", type=int, default=1, help="number of clients sampled per outer step")
+    parser.add_argument("--inner_engine", type=str, default="loop", choices=["loop", "batched"],
+                        help="loop: the sampled clients' inner loops one after another, batched: all of them as one (LR models)")
+    parser.add_argument("--loader", type=str, default="torch", choices=["torch", "tensor"],
+                        help="torch: DataLoader per client, tensor: device-resident tensors sliced per batch")
+    parser.add_argument("--partition", type=str, default="sort", choices=PARTITIONS,
+                        help="client split. sort: two blocks of the data sorted by one feature, iid: uniform, "
+                             "dirichlet: Dirichlet(beta) mix of the --partition_by groups, shard: shards of the data sorted by --partition_by")
+    parser.add_argument("--partition_by", type=str, default=None, help="column for dirichlet/shard, defaults to the label (e.g. sex for the sensitive attribute)")
+    parser.add_argument("--dirichlet_beta", type=float, default=0.5, help="concentration of the dirichlet partition, smaller is more skewed")
+    parser.add_argument("--shards_per_client", type=int, default=2, help="shards per client for the shard partition")
     parser.add_argument("--n_hidden", type=int, default=3, help="num. hidden layers")
     parser.add_argument("--inner_lr", type=float, default=.0001, help="learning rate for inner optimizer")
     parser.add_argument("--lr", type=float, default=1e-5, help="learning rate")
@@ -329,8 +444,17 @@ def main():
     parser.add_argument("--inner_wd", type=float, default=1e-10, help="inner weight decay")
     parser.add_argument("--embed_dim", type=int, default=10, help="embedding dim")
     parser.add_argument("--hyper_hid", type=int, default=100, help="hypernet hidden dim")
-    parser.add_argument("--gpu", type=int, default=5, help="gpu device ID")
-    parser.add_argument("--eval_every", type=int, default=50, help="eval every X selected epochs")
+    parser.add_argument("--nn_hidden", type=int, default=None, help="hidden width of the NN client model, defaults to the number of features")
+    parser.add_argument("--hnet_chunk_size", type=int, default=0, help="NN hypernet: generate the client weights X values at a time through one shared head, 0 uses a dense head per tensor")
+    parser.add_argument("--hnet_chunk_dim", type=int, default=16, help="NN hypernet: size of the learned chunk embeddings")
+    parser.add_argument("--hnet_rank", type=int, default=0, help="NN hypernet: generate fc1/fc2 as rank-X factors applied as x @ V @ U^T, 0 generates full matrices")
+    parser.add_argument("--export_dir", type=str, default=None, help="write the trained per-client LR models as one packed array for static_predictor")
+    parser.add_argument("--export_context", type=str, default="data", choices=EXPORT_CONTEXTS,
+                        help="context folded into the exported models. data: Context net over the client's training rows, store: the client's c_i")
+    parser.add_argument("--eval_every", type=int, default=0, help="evaluate every X outer steps during training, 0 only evaluates at the end")
+    parser.add_argument("--eval_shard_rows", type=int, default=None, help="evaluate during training on a fixed sample of at most X test rows per client")
+    parser.add_argument("--eval_background", action="store_true", help="evaluate during training on a thread against a snapshot of the hypernetwork")
+    parser.add_argument("--eval_log_clients", type=int, default=4, help="clients with their own curve in the TensorBoard eval panels")
     parser.add_argument("--save_path", type=str, default="/home/ancarey/FairFLHN/experiments/adult/results",
                         help="dir path for output file")
     parser.add_argument("--seed", type=int, default=0, help="seed value")
@@ -339,17 +463,32 @@ def main():
     parser.add_argument("--alpha", type=int, default=[100, 25], help="fairness/accuracy trade-off parameter")
     parser.add_argument("--which_position", type=int, default=8, choices=[5, 8],
                         help="which position the sensitive attribute is in. 5: compas, 8: adult")
+    parser.add_argument("--workers", type=int, default=0, help="asynchronous client worker processes, 0 trains synchronously")
+    parser.add_argument("--staleness", type=str, default="weight", choices=STALENESS_POLICIES,
+                        help="async updates from older hypernetwork snapshots. weight: scale by 1/(1+staleness), bound: drop past --max_update_staleness")
+    parser.add_argument("--max_update_staleness", type=int, default=None, help="max snapshot age of an applied async update")
+    parser.add_argument("--context_mode", type=str, default="last", choices=CONTEXT_MODES,
+                        help="how a client's c_i folds in each round. last: latest round only, running: mean of all rounds, ema: decayed, window: last --context_window rounds")
+    parser.add_argument("--context_decay", type=float, default=0.9, help="decay of the ema context mode")
+    parser.add_argument("--context_window", type=int, default=10, help="rounds averaged by the window context mode")
+    parser.add_argument("--eval_engine", type=str, default="loop", choices=["loop", "batched"],
+                        help="loop: client by client and batch by batch, batched: all clients in one pass (LR models)")
+    add_sampler_args(parser)
+    add_execution_args(parser)
+    add_checkpoint_args(parser)
+    add_profiling_args(parser)
     args = parser.parse_args()
-    assert args.gpu <= torch.cuda.device_count()
     set_logger()
 
-    device = "cuda:1"
+    ctx = execution_from_args(args)
+    checkpoints = checkpoints_from_args(args)
+    timer = profiler_from_args(args, ctx.device)
 
     args.classes_per_node = 2
 
     train(
     writer,
-    device=device,
+    ctx=ctx,
     data_name=args.data_name,
     model_name=args.model_name,
     classes_per_node = args.classes_per_node,
@@ -365,7 +504,40 @@ def main():
     bs = args.batch_size,
     alpha = args.alpha,
     fair = args.fair,
-    which_position = args.which_position)
+    which_position = args.which_position,
+    clients_per_step = args.clients_per_step,
+    loader = args.loader,
+    cache_dir = args.cache_dir,
+    compas_path = args.compas_path,
+    partition = args.partition,
+    partition_by = args.partition_by,
+    dirichlet_beta = args.dirichlet_beta,
+    shards_per_client = args.shards_per_client,
+    sampler = args.sampler,
+    max_staleness = args.max_staleness,
+    sampler_log_every = args.sampler_log_every,
+    workers = args.workers,
+    staleness = args.staleness,
+    max_update_staleness = args.max_update_staleness,
+    context_mode = args.context_mode,
+    context_decay = args.context_decay,
+    context_window = args.context_window,
+    checkpoints = checkpoints,
+    resume = args.resume,
+    timer = timer,
+    profile_log_every = args.profile_log_every,
+    eval_engine = args.eval_engine,
+    inner_engine = args.inner_engine,
+    eval_every = args.eval_every,
+    eval_shard_rows = args.eval_shard_rows,
+    eval_background = args.eval_background,
+    eval_log_clients = args.eval_log_clients,
+    nn_hidden = args.nn_hidden,
+    hnet_chunk_size = args.hnet_chunk_size,
+    hnet_chunk_dim = args.hnet_chunk_dim,
+    hnet_rank = args.hnet_rank,
+    export_dir = args.export_dir,
+    export_context = args.export_context)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -69,7 +69,71 @@ def TP_FP_TN_FN(x, predicted_prediction, labels_pred, which_position):
 
     return TP, FP, TN, FN
 
+def confusion_counts(s, y, y_hat):
+    # counts[group, label, prediction] in one bincount, group 0 is s == 0 (f) and 1 is everything else (m)
+    code = (s.flatten() != 0).long() * 4 + y.flatten().long() * 2 + y_hat.flatten().long()
+    return torch.bincount(code, minlength=8).view(2, 2, 2)
+
+def counts_to_TP_FP_TN_FN(counts):
+    c = counts.tolist()
+
+    TP = [c[0][1][1] + c[1][1][1], c[0][1][1], c[1][1][1]] # all, f, m
+    FP = [c[0][0][1] + c[1][0][1], c[0][0][1], c[1][0][1]]
+    TN = [c[0][0][0] + c[1][0][0], c[0][0][0], c[1][0][0]]
+    FN = [c[0][1][0] + c[1][1][0], c[0][1][0], c[1][1][0]]
+
+    return TP, FP, TN, FN
+
+class ConfusionCounts:
+    # accumulates confusion_counts over batches on the batch device, only synced in TP_FP_TN_FN
+    def __init__(self):
+        self.counts = None
+
+    def update(self, s, y, y_hat):
+        batch_counts = confusion_counts(s, y, y_hat)
+        if self.counts is None:
+            self.counts = batch_counts
+        else:
+            self.counts += batch_counts
+
+    def TP_FP_TN_FN(self):
+        if self.counts is None:
+            return [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0]
+        return counts_to_TP_FP_TN_FN(self.counts)
+
+class Reservoir:
+    # uniform sample of at most size (label, prediction) pairs from a stream of batches (algorithm R)
+    def __init__(self, size):
+        self.size = size
+        self.seen = 0
+        self.true = np.zeros(size)
+        self.pred = np.zeros(size, dtype=np.int64)
+
+    def update(self, y, y_hat):
+        if self.size == 0:
+            return
+
+        n = len(y)
+        positions = np.arange(self.seen, self.seen + n)
+        slots = np.where(positions < self.size, positions, (np.random.rand(n) * (positions + 1)).astype(np.int64))
+        keep = np.nonzero(slots < self.size)[0]
+        self.seen += n
+
+        if len(keep) == 0:
+            return
+
+        # only the kept rows leave the device, later rows win on repeated slots like in the sequential algorithm
+        keep_idx = torch.from_numpy(keep).to(y.device)
+        self.true[slots[keep]] = y.flatten()[keep_idx].cpu().float().numpy()
+        self.pred[slots[keep]] = y_hat.flatten()[keep_idx].cpu().numpy()
+
+    def samples(self):
+        n = min(self.seen, self.size)
+        return self.true[:n], self.pred[:n]
+
 def metrics(TP, FP, TN, FN): #double checked, all metrics are calculated correctly based on the aif360
+    # numpy scalars, so a group that is empty or has no positives on a skewed client gives nan instead of raising
+    TP, FP, TN, FN = ([np.float64(v) for v in counts] for counts in (TP, FP, TN, FN))
     blank = [0, 0, 0]
 
     #TP[all, f, m]
@@ -0,0 +1,141 @@
+import os
+import glob
+import random
+import logging
+from collections import namedtuple, defaultdict
+import numpy as np
+import torch
+
+# where one tensor of a packed state lives: buffers[dtype][offset:offset + numel].view(shape)
+Packed = namedtuple('Packed', ['dtype', 'offset', 'shape'])
+
+def pack_states(states):
+    """Packs a list of (nested) state dicts into one flat buffer per dtype.
+
+    Every tensor is replaced by a Packed reference, so thousands of per-client Adam states or models are saved as
+    a handful of storages instead of one storage per tensor. None entries (clients without an optimizer) are kept.
+    """
+    chunks = defaultdict(list)
+    sizes = defaultdict(int)
+
+    def pack(obj):
+        if torch.is_tensor(obj):
+            flat = obj.detach().reshape(-1).cpu()
+            ref = Packed(flat.dtype, sizes[flat.dtype], tuple(obj.shape))
+            chunks[flat.dtype].append(flat)
+            sizes[flat.dtype] += flat.numel()
+            return ref
+        if isinstance(obj, dict):
+            return {k: pack(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(pack(v) for v in obj)
+        return obj
+
+    packed = [pack(state) for state in states]
+    buffers = {dtype: torch.cat(chunk) for dtype, chunk in chunks.items()}
+    return {'states': packed, 'buffers': buffers}
+
+def unpack_states(packed):
+    buffers = packed['buffers']
+
+    def unpack(obj):
+        if isinstance(obj, Packed):
+            numel = int(np.prod(obj.shape))
+            return buffers[obj.dtype][obj.offset:obj.offset + numel].view(obj.shape).clone()
+        if isinstance(obj, dict):
+            return {k: unpack(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(unpack(v) for v in obj)
+        return obj
+
+    return [unpack(state) for state in packed['states']]
+
+def pack_optimizer_states(optimizers):
+    # DualAscent wrappers are saved through the optimizer they step
+    optimizers = [getattr(opt, 'optimizer', opt) for opt in optimizers]
+    return pack_states([None if opt is None else opt.state_dict() for opt in optimizers])
+
+def load_optimizer_states(optimizers, packed):
+    optimizers = [getattr(opt, 'optimizer', opt) for opt in optimizers]
+    for opt, state in zip(optimizers, unpack_states(packed)):
+        if opt is not None:
+            opt.load_state_dict(state)
+
+def pack_module_states(modules):
+    return pack_states([module.state_dict() for module in modules])
+
+def load_module_states(modules, packed):
+    for module, state in zip(modules, unpack_states(packed)):
+        module.load_state_dict(state)
+
+def rng_state():
+    state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class CheckpointManager:
+    """Periodic checkpoints of a training run in `ckpt_dir`, the newest `keep` are retained.
+
+    A checkpoint is written to a temporary file next to its final name and moved into place with os.replace,
+    so a run killed mid-save leaves the previous checkpoint intact and never a truncated one.
+    """
+    def __init__(self, ckpt_dir, every=0, keep=3):
+        self.ckpt_dir = ckpt_dir
+        self.every = every
+        self.keep = keep
+
+    def due(self, step):
+        # step is the index of the outer step that just finished
+        return self.every > 0 and (step + 1) % self.every == 0
+
+    def paths(self):
+        return sorted(glob.glob(os.path.join(self.ckpt_dir, 'ckpt_*.pt')))
+
+    def latest(self):
+        paths = self.paths()
+        return paths[-1] if paths else None
+
+    def save(self, step, state):
+        os.makedirs(self.ckpt_dir, exist_ok=True)
+        path = os.path.join(self.ckpt_dir, f'ckpt_{step:08d}.pt')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(dict(state, step=step), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+        if self.keep:
+            for old in self.paths()[:-self.keep]:
+                os.remove(old)
+        logging.info(f"checkpoint: step {step} saved to {path}")
+        return path
+
+    def load(self, path=None):
+        path = path or self.latest()
+        if path is None:
+            return None
+        logging.info(f"checkpoint: resuming from {path}")
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+def add_checkpoint_args(parser):
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="dir for periodic training checkpoints")
+    parser.add_argument("--ckpt_every", type=int, default=0, help="checkpoint every X outer steps, 0 disables")
+    parser.add_argument("--ckpt_keep", type=int, default=3, help="number of most recent checkpoints kept, 0 keeps all")
+    parser.add_argument("--resume", action="store_true", help="resume from the latest checkpoint in --ckpt_dir, if there is one")
+    return parser
+
+def checkpoints_from_args(args):
+    if args.ckpt_dir is None:
+        if args.ckpt_every or args.resume:
+            raise ValueError("--ckpt_every and --resume need --ckpt_dir")
+        return None
+    return CheckpointManager(args.ckpt_dir, args.ckpt_every, args.ckpt_keep)
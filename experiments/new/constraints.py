@@ -0,0 +1,55 @@
+import torch
+
+# M of the linear fairness constraints M @ mu(f) <= c, shared by the cFHN and pFedHN client models
+_CONSTRAINT_MATRICES = {}
+
+def _element_M(a0, a1, y0, y1, s):
+    if a0 is None or a1 is None:
+        x = y0 == y1
+        return -1 * s * x
+    else:
+        x = (a0 == a1) & (y0 == y1)
+        return s * float(x)
+
+def constraint_shape(fairness, num_classes, n_sensitive):
+    # (n_constraints, dim_condition) of M
+    if fairness == 'dp':
+        return 2 * n_sensitive, n_sensitive + 1
+    elif fairness == 'eo':
+        return n_sensitive * num_classes * 2, num_classes * (n_sensitive + 1)
+    raise ValueError(f"no constraint matrix for fairness '{fairness}'")
+
+def build_constraint_matrix(fairness, num_classes, n_sensitive):
+    n_constraints, dim_condition = constraint_shape(fairness, num_classes, n_sensitive)
+    M = torch.zeros((n_constraints, dim_condition))
+
+    if fairness == 'dp':
+        # rows 2k and 2k+1 bound E[f | s=k] - E[f] from above and below
+        for k in range(n_sensitive):
+            M[2 * k, k] = 1.0
+            M[2 * k, -1] = -1.0
+            M[2 * k + 1, k] = -1.0
+            M[2 * k + 1, -1] = 1.0
+
+    elif fairness == 'eo':
+        sensitive_classes = list(range(n_sensitive))
+        y_classes = list(range(num_classes))
+        element_k_a = sensitive_classes + [None]
+
+        for i_a, a_0 in enumerate(sensitive_classes):
+            for i_y, y_0 in enumerate(y_classes):
+                for i_s, s in enumerate([-1, 1]):
+                    for j_y, y_1 in enumerate(y_classes):
+                        for j_a, a_1 in enumerate(element_k_a):
+                            i = i_a * (2 * num_classes) + i_y * 2 + i_s
+                            j = j_y + num_classes * j_a
+                            M[i, j] = _element_M(a_0, a_1, y_1, y_1, s)
+
+    return M
+
+def constraint_matrix(fairness, num_classes, n_sensitive, device='cpu', dtype=torch.float32):
+    # one read-only M per (fairness, classes, groups, device, dtype), shared by every client model
+    key = (fairness, num_classes, n_sensitive, torch.device(device), dtype)
+    if key not in _CONSTRAINT_MATRICES:
+        _CONSTRAINT_MATRICES[key] = build_constraint_matrix(fairness, num_classes, n_sensitive).to(device, dtype)
+    return _CONSTRAINT_MATRICES[key]
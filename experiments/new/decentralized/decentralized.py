@@ -1,5 +1,4 @@
 import os
-os.environ['CUDA_VISIBLE_DEVICES'] = "1, 2, 3, 4, 5, 6, 7"
 import warnings
 import torch
 import torch.utils.data
@@ -7,22 +6,24 @@ from tqdm import trange
 from experiments.new.pFedHN.utils import seed_everything, set_logger, TP_FP_TN_FN, metrics
 from experiments.new.pFedHN.pFedHN_models import LR, Constraint
 from experiments.new.pFedHN.node import BaseNodes
+from experiments.new.execution import ExecutionContext
+from experiments.new.dual import DualAscent
 warnings.filterwarnings("ignore")
 
 @torch.no_grad()
-def evaluate(model, device, which_position, test_loader):
+def evaluate(model, ctx, which_position, test_loader):
     preds = []
     true = []
     queries = []
 
     model.eval()
-    model.to(device)
+    ctx.module(model)
 
     running_loss, running_correct, running_samples = 0, 0, 0
 
     for batch_count, batch in enumerate(test_loader):
-        x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-        s = x[:, which_position].to(device)
+        x, y = ctx.batch(batch)
+        s = x[:, which_position]
 
         true.extend(y.cpu().numpy())
         queries.extend(x.cpu().numpy())
@@ -31,7 +32,7 @@ def evaluate(model, device, which_position, test_loader):
         pred_thresh = (pred > 0.5).long()
         preds.extend(pred_thresh.flatten().cpu().numpy())
 
-        correct = torch.eq(pred_thresh, y.unsqueeze(1)).type(torch.cuda.LongTensor)
+        correct = torch.eq(pred_thresh, y.unsqueeze(1)).long()
         running_correct += torch.count_nonzero(correct).item()
 
         running_samples += len(y)
@@ -42,22 +43,21 @@ def evaluate(model, device, which_position, test_loader):
     return accuracy, eod, spd
 
 
-def train(device, steps, lr, wd, alpha, fair, which_position, num_features, train_loader, test_loader, client_num):
+def train(ctx, steps, lr, wd, alpha, fair, which_position, num_features, train_loader, test_loader, client_num):
     seed_everything(0)
-    b = 1/alpha
 
     model = LR(input_size=num_features, bound=alpha, fairness=fair)
     constraint= Constraint(fair=fair, bound=alpha)
     client_optimizers_theta = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=wd)
     if fair != 'none':
-        client_optimizers_lambda = torch.optim.Adam(constraint.parameters(), lr=lr, weight_decay=wd)
+        client_optimizers_lambda = DualAscent(constraint.parameters(), torch.optim.Adam(constraint.parameters(), lr=lr, weight_decay=wd), radius=constraint.bound)
 
     loss = torch.nn.BCELoss()
 
     model.train()
-    model.to(device)
+    ctx.module(model)
     if fair != 'none':
-        constraint.to(device)
+        ctx.module(constraint)
 
     step_iter = trange(steps)
     for j in step_iter:
@@ -67,8 +67,8 @@ def train(device, steps, lr, wd, alpha, fair, which_position, num_features, trai
             client_optimizers_lambda.zero_grad()
 
         batch = next(iter(train_loader))
-        x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-        s = x[:, which_position].to(device)
+        x, y = ctx.batch(batch)
+        s = x[:, which_position]
 
         pred, m_mu_q = model(x, s, y)
 
@@ -81,26 +81,9 @@ def train(device, steps, lr, wd, alpha, fair, which_position, num_features, trai
         client_optimizers_theta.step()
 
         if fair != 'none':
-            constraint.lmbda.data = torch.clamp(constraint.lmbda.data, min=0)
-            torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1)
-
-            if torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1) > b:
-                print(torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1))
-                print(constraint.lmbda)
-                exit(1)
-
-            for i, item in enumerate(constraint.lmbda.data):
-                if item < 0:
-                    print(constraint.lmbda)
-                    exit(2)
-
-            for group in client_optimizers_lambda.param_groups:
-                for p in group['params']:
-                    p.grad = -1 * p.grad
-
             client_optimizers_lambda.step()
 
-    accuracy, eod, spd = evaluate(model, device, which_position, test_loader)
+    accuracy, eod, spd = evaluate(model, ctx, which_position, test_loader)
     print(f"Acc: {accuracy:.4f}, EOD: {eod:.4f}, SPD: {spd:.4f}")
 
 
@@ -112,7 +95,7 @@ def main():
     fairness = 'dp'
     data_name = 'compas'
     classes_per_node = 2
-    device = 'cuda:5'
+    ctx = ExecutionContext()
     num_steps = 5000
     wd = 1e-10
 
@@ -150,7 +133,7 @@ def main():
                 alpha = alphas[1]
 
         print("\nTraining Client: ", i+1, fair, alpha)
-        train(device=device, steps=num_steps, lr=lr, wd=wd, alpha=alpha, fair=fair, which_position=which_position, num_features=num_features, train_loader=nodes.train_loaders[i], test_loader=nodes.test_loaders[i], client_num=i+1)
+        train(ctx=ctx, steps=num_steps, lr=lr, wd=wd, alpha=alpha, fair=fair, which_position=which_position, num_features=num_features, train_loader=nodes.train_loaders[i], test_loader=nodes.test_loaders[i], client_num=i+1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
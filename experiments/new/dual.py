@@ -0,0 +1,64 @@
+import os
+import torch
+
+DEBUG = os.environ.get("DUAL_DEBUG", "0") == "1"
+
+def project_l1_ball(v, radius):
+    # euclidean projection onto {x >= 0, sum(x) <= radius} (Duchi et al. 2008), branch-free so it never syncs with the host
+    v = v.clamp(min=0)
+    flat = v.flatten()
+    u, _ = torch.sort(flat, descending=True)
+    cssv = torch.cumsum(u, dim=0) - radius
+    ind = torch.arange(1, len(u) + 1, device=v.device, dtype=v.dtype)
+    rho = (u - cssv / ind > 0).sum().clamp(min=1)
+    theta = cssv.gather(0, rho - 1) / rho.to(v.dtype)
+    projected = (flat - theta).clamp(min=0).view_as(v)
+    return torch.where(flat.sum() > radius, projected, v)
+
+class DualAscent:
+    """Projected dual ascent on the Lagrange multipliers of the fairness constraints.
+
+    The multiplier gradients are negated so that `optimizer` (which may also hold the primal parameters) ascends on them,
+    then the multipliers are projected back onto {lambda >= 0} or, when `radius` is given, onto {lambda >= 0, |lambda|_1 <= radius}.
+    Everything stays in tensor ops; invariants are only checked (with a host sync) in debug mode.
+    """
+    def __init__(self, multipliers, optimizer, radius=None, debug=None):
+        self.multipliers = list(multipliers)
+        self.optimizer = optimizer
+        self.radius = radius
+        self.debug = DEBUG if debug is None else debug
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    @torch.no_grad()
+    def ascend(self):
+        for p in self.multipliers:
+            if p.grad is not None:
+                p.grad.neg_()
+
+    @torch.no_grad()
+    def project(self):
+        for p in self.multipliers:
+            if self.radius is None:
+                p.clamp_(min=0)
+            else:
+                p.copy_(project_l1_ball(p, self.radius))
+
+        if self.debug:
+            self.check()
+
+    def check(self):
+        for p in self.multipliers:
+            if not torch.isfinite(p).all():
+                raise RuntimeError(f"non-finite lagrange multipliers: {p.flatten().tolist()}")
+            if (p < 0).any():
+                raise RuntimeError(f"negative lagrange multipliers: {p.flatten().tolist()}")
+            if self.radius is not None and p.sum() > self.radius * (1 + 1e-5):
+                raise RuntimeError(f"lagrange multipliers outside the l1 ball of radius {self.radius}: {p.flatten().tolist()}")
+
+    def step(self):
+        self.ascend()
+        self.optimizer.step()
+        self.project()
+
@@ -0,0 +1,103 @@
+import os
+import logging
+import torch
+
+DTYPES = {"float32": torch.float32, "float64": torch.float64, "bfloat16": torch.bfloat16}
+
+def parse_cpu_list(cpu_list):
+    # "0-3,8,10-11" -> {0, 1, 2, 3, 8, 10, 11}, the format of /sys/devices/system/node/node*/cpulist
+    cpus = set()
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def numa_node_cpus(node):
+    with open(f"/sys/devices/system/node/node{node}/cpulist") as f:
+        return parse_cpu_list(f.read())
+
+class ExecutionContext:
+    """Where and how the trainers run: device, dtype, host threads and pinned memory.
+
+    Every trainer moves its batches, index tensors and modules through one of these instead of hard-coding
+    cuda tensor types, so the same code runs on a GPU box or a CPU-only node.
+    """
+    def __init__(self, device=None, dtype=torch.float32, num_threads=None, interop_threads=None, cpus=None, pin_memory=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = torch.device(device)
+        if device.type == "cuda" and not torch.cuda.is_available():
+            logging.warning(f"{device} requested but cuda is not available, running on cpu")
+            device = torch.device("cpu")
+
+        self.device = device
+        self.dtype = dtype
+        self.pin_memory = device.type == "cuda" if pin_memory is None else pin_memory
+
+        # pin the process first so the default thread count follows the allowed cpus
+        if cpus is not None:
+            os.sched_setaffinity(0, cpus)
+
+        if num_threads is None and device.type == "cpu" and hasattr(os, "sched_getaffinity"):
+            num_threads = len(os.sched_getaffinity(0))
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError:
+                # can only be set before the first parallel region runs
+                logging.warning("inter-op thread count already fixed, ignoring interop_threads")
+
+        self.num_threads = torch.get_num_threads()
+
+    def float(self, t):
+        return t.to(self.device, self.dtype, non_blocking=self.pin_memory)
+
+    def module(self, m):
+        # parameters and floating buffers follow the batches, so --dtype applies to the whole model
+        return m.to(self.device, self.dtype)
+
+    def long(self, t):
+        return t.to(self.device, torch.long, non_blocking=self.pin_memory)
+
+    def batch(self, batch):
+        return tuple(self.float(t) for t in batch)
+
+    def tensor(self, data, dtype=None):
+        return torch.tensor(data, dtype=self.dtype if dtype is None else dtype, device=self.device)
+
+    def index(self, idx):
+        # node ids for the hypernetwork embeddings
+        return torch.tensor(idx if isinstance(idx, (list, tuple)) else [idx], dtype=torch.long, device=self.device)
+
+    def __repr__(self):
+        return f"ExecutionContext(device={self.device}, dtype={self.dtype}, num_threads={self.num_threads}, pin_memory={self.pin_memory})"
+
+def add_execution_args(parser):
+    parser.add_argument("--device", type=str, default=None, help="torch device, defaults to cuda when available and cpu otherwise")
+    parser.add_argument("--dtype", type=str, default="float32", choices=list(DTYPES.keys()), help="dtype of the batches and of the model parameters")
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads, defaults to the number of allowed cpus")
+    parser.add_argument("--interop_threads", type=int, default=None, help="inter-op threads")
+    parser.add_argument("--cpus", type=str, default=None, help="cpu affinity, e.g. 0-15,32-47")
+    parser.add_argument("--numa_node", type=int, default=None, help="pin to the cpus of this NUMA node")
+    parser.add_argument("--pin_memory", type=int, default=None, choices=[0, 1], help="pin host batches, defaults to on for cuda")
+    return parser
+
+def execution_from_args(args):
+    cpus = None
+    if args.cpus is not None:
+        cpus = parse_cpu_list(args.cpus)
+    if args.numa_node is not None:
+        node_cpus = numa_node_cpus(args.numa_node)
+        cpus = node_cpus if cpus is None else cpus & node_cpus
+
+    pin_memory = None if args.pin_memory is None else bool(args.pin_memory)
+    ctx = ExecutionContext(args.device, DTYPES[args.dtype], args.num_threads, args.interop_threads, cpus, pin_memory)
+    logging.info(ctx)
+    return ctx
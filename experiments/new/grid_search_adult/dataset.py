@@ -1,4 +1,5 @@
 import os
+import functools
 import random
 from torch.utils.data import Dataset
 import torch.utils.data
@@ -102,6 +103,8 @@ def clean_and_encode_dataset(data, data_name):
 
     return data
 
+# parsed once per process and shared read-only, the client splits below only take slices
+@functools.lru_cache(maxsize=None)
 def get_dataset(data_name, num_clients):
     if data_name == 'adult':
 
@@ -153,8 +156,8 @@ def get_dataset(data_name, num_clients):
 
     return datasets, splits, features, labels
 
-def gen_random_loaders(data_name, num_clients, bz):
-    loader_params = {"batch_size": bz, "shuffle": False, "pin_memory": True, "num_workers": 0}
+def gen_random_loaders(data_name, num_clients, bz, pin_memory=False):
+    loader_params = {"batch_size": bz, "shuffle": False, "pin_memory": pin_memory, "num_workers": 0}
 
     dataloaders = []
 
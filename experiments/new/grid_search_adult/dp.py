@@ -9,16 +9,18 @@ import torch
 import pandas as pd
 import torch.utils.data
 from tqdm import trange
-from models import LR, Context, LRHyper, Constraint
-from node import BaseNodes
-from utils import seed_everything, set_logger, TP_FP_TN_FN, metrics, make_ascent
+from experiments.new.grid_search_adult.models import LR, Context, LRHyper, Constraint
+from experiments.new.grid_search_adult.node import BaseNodes
+from experiments.new.grid_search_adult.utils import seed_everything, set_logger, TP_FP_TN_FN, metrics, make_ascent
+from experiments.new.execution import add_execution_args, execution_from_args
+from experiments.new.dual import DualAscent
 from torch.utils.tensorboard import SummaryWriter
 import matplotlib.pyplot as plt
 import seaborn as sn
 warnings.filterwarnings("ignore")
 
-def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, device, fair, constraint, alpha, confusion, which_position):
-    curr_results, pred, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd = evaluate(nodes, num_nodes, hnet, model, cnet, num_features, loss, device, fair, constraint, alpha, which_position)
+def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, ctx, fair, constraint, alpha, confusion, which_position):
+    curr_results, pred, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd = evaluate(nodes, num_nodes, hnet, model, cnet, num_features, loss, ctx, fair, constraint, alpha, which_position)
     total_correct = sum([val['correct'] for val in curr_results.values()])
     total_samples = sum([val['total'] for val in curr_results.values()])
     avg_loss = np.mean([val['loss'] for val in curr_results.values()])
@@ -44,7 +46,7 @@ def eval_model(nodes, num_nodes, hnet, model, cnet, num_features, loss, device,
     return curr_results, avg_loss, avg_acc, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd
 
 @torch.no_grad()
-def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, device, fair, constraints, alpha, which_position):
+def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, ctx, fair, constraints, alpha, which_position):
     hnet.eval()
     results = defaultdict(lambda: defaultdict(list))
     preds = []
@@ -59,23 +61,23 @@ def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, device,
         cnet = cnets[node_id]
         constraint = constraints[node_id]
 
-        model.to(device)
-        cnet.to(device)
-        constraint.to(device)
+        ctx.module(model)
+        ctx.module(cnet)
+        ctx.module(constraint)
 
         running_loss, running_correct, running_samples = 0, 0, 0
 
         curr_data = nodes.test_loaders[node_id]
 
         for batch_count, batch in enumerate(curr_data):
-            x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-            s = x[:, which_position].to(device)
+            x, y = ctx.batch(batch)
+            s = x[:, which_position]
 
-            true_client.extend(y.cpu().numpy())
-            queries_client.extend(x.cpu().numpy())
+            true_client.extend(y.cpu().float().numpy())
+            queries_client.extend(x.cpu().float().numpy())
 
             avg_context_vector, prediction_vector = cnet(x, num_features)
-            weights = hnet(avg_context_vector, torch.tensor([node_id], dtype=torch.long).to(device))
+            weights = hnet(avg_context_vector, ctx.index(node_id))
             model.load_state_dict(weights)
 
             pred, m_mu_q = model(prediction_vector, s, y) # y is only passed to calculate m_mu_q
@@ -86,9 +88,9 @@ def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, device,
             if fair == 'none':
                 running_loss += loss(pred, y.unsqueeze(1)).item()
             else:
-                running_loss += ((loss(pred, y.unsqueeze(1)) + alpha*constraint(m_mu_q).to(device)).item()) / len(batch)
+                running_loss += ((loss(pred, y.unsqueeze(1)) + alpha*constraint(m_mu_q)).item()) / len(batch)
 
-            correct = torch.eq(pred_thresh,y.unsqueeze(1)).type(torch.cuda.LongTensor)
+            correct = torch.eq(pred_thresh,y.unsqueeze(1)).long()
             running_correct += torch.count_nonzero(correct).item()
 
             running_samples += len(y)
@@ -113,7 +115,7 @@ def evaluate(nodes, num_nodes, hnet, models, cnets, num_features, loss, device,
 
     return results, preds, true, f1, f1_f, f1_m, a, f_a, m_a, aod, eod, spd
 
-def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,inner_steps,lr,inner_lr,wd,inner_wd, hyper_hid,n_hidden,bs, alpha,fair, which_position, context_hidden_size, save_file_name):
+def train(writer, ctx, data_name,model_name,classes_per_node,num_nodes,steps,inner_steps,lr,inner_lr,wd,inner_wd, hyper_hid,n_hidden,bs, alpha,fair, which_position, context_hidden_size, save_file_name):
     avg_acc = [[] for i in range(num_nodes + 1)]
     all_f1 = [[] for i in range(num_nodes)]
     all_aod = [[] for i in range(num_nodes)]
@@ -125,13 +127,14 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
     constraints = []
     client_fairness = []
     client_optimizers = []
+    client_duals = []
     combo_parameters = []
     alphas = []
 
     for i in range(1):
         seed_everything(0)
 
-        nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node)
+        nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node, pin_memory=ctx.pin_memory)
         num_features = len(nodes.features)
         embed_dim = num_features
 
@@ -153,7 +156,7 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
         elif fair == 'none':
             client_fairness = ['none' for i in range(num_nodes)]
             alphas = ['none' for i in range(num_nodes)]
-        hnet = LRHyper(device=device, n_nodes=num_nodes, embedding_dim=embed_dim, context_vector_size=num_features,
+        hnet = LRHyper(device=ctx.device, n_nodes=num_nodes, embedding_dim=embed_dim, context_vector_size=num_features,
                        hidden_size=num_features, hnet_hidden_dim=hyper_hid, hnet_n_hidden=n_hidden)
 
         # Set models for all clients
@@ -167,8 +170,9 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
             else:
                 combo_parameters.append(list(models[i].parameters()) + list(cnets[i].parameters()) + list(constraints[i].parameters()))
             client_optimizers.append(torch.optim.Adam(combo_parameters[i], lr=inner_lr, weight_decay=inner_wd))
+            client_duals.append(DualAscent(constraints[i].parameters(), client_optimizers[i]))
 
-        hnet.to(device)
+        ctx.module(hnet)
 
         optimizer = torch.optim.Adam(params=hnet.parameters(), lr=lr, weight_decay=wd)
         loss = torch.nn.BCELoss()
@@ -182,17 +186,16 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
             model = models[node_id]
             cnet = cnets[node_id]
             constraint = constraints[node_id]
-            combo_params = combo_parameters[node_id]
             alpha = alphas[node_id]
-            model.to(device)
-            cnet.to(device)
-            constraint.to(device)
+            ctx.module(model)
+            ctx.module(cnet)
+            ctx.module(constraint)
 
-            inner_optim = client_optimizers[node_id]
+            inner_optim = client_duals[node_id]
 
-            node_c_i = nodes.c_i[node_id]
+            node_c_i = ctx.float(nodes.c_i[node_id])
 
-            weights = hnet(node_c_i, torch.tensor([node_id], dtype=torch.long).to(device))
+            weights = hnet(node_c_i, ctx.index(node_id))
             model.load_state_dict(weights)
 
             inner_state = OrderedDict({k: tensor.data for k, tensor in weights.items()})
@@ -207,13 +210,13 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
                 optimizer.zero_grad()
 
                 batch = next(iter(nodes.train_loaders[node_id]))
-                x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-                s = x[:,which_position].to(device)
+                x, y = ctx.batch(batch)
+                s = x[:,which_position]
 
                 avg_context_vector, pred_vec = cnet(x, num_features)
                 pred, m_mu_q = model(pred_vec, s, y) # we pass y only for m_mu_q calculation
 
-                avg_c_i.append(avg_context_vector)
+                avg_c_i.append(avg_context_vector.detach())
 
                 if fair == 'none':
                     err = loss(pred, y.unsqueeze(1))
@@ -221,13 +224,9 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
                     err = loss(pred, y.unsqueeze(1)) + alpha*constraint(m_mu_q)
 
                 err.backward()
-
-                if fair != 'none':
-                    combo_params[len(combo_params) - 1].grad.data = -1 * combo_params[len(combo_params) - 1].grad.data
-
                 inner_optim.step()
 
-            nodes.c_i[node_id] = torch.cuda.FloatTensor([sum(sub_list) / len(sub_list) for sub_list in zip(*avg_c_i)])
+            nodes.c_i[node_id] = torch.stack(avg_c_i).mean(dim=0)
 
             optimizer.zero_grad()
             final_state = model.state_dict()
@@ -240,11 +239,11 @@ def train(writer, device, data_name,model_name,classes_per_node,num_nodes,steps,
             optimizer.step()
 
             # if step % 99 == 0 or step == 1999 or step == 0:
-            #     step_results, avg_loss, avg_acc_all, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = eval_model(nodes, num_nodes, hnet, models, cnets, num_features, loss, device, confusion=False, fair=fair, constraint=constraints, alpha=alpha, which_position=which_position)
+            #     step_results, avg_loss, avg_acc_all, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = eval_model(nodes, num_nodes, hnet, models, cnets, num_features, loss, ctx, confusion=False, fair=fair, constraint=constraints, alpha=alpha, which_position=which_position)
             #
             #     logging.info(f"\nStep: {step + 1}, AVG Loss: {avg_loss:.4f},  AVG Acc: {avg_acc_all:.4f}")
 
-        step_results, avg_loss, avg_acc_all, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = eval_model(nodes, num_nodes, hnet, models, cnets, num_features, loss, device, confusion=False,fair=fair, constraint=constraints, alpha=alpha, which_position=which_position)
+        step_results, avg_loss, avg_acc_all, all_acc, all_loss, f1, f1_f, f1_m, f_a, m_a, aod, eod, spd = eval_model(nodes, num_nodes, hnet, models, cnets, num_features, loss, ctx, confusion=False,fair=fair, constraint=constraints, alpha=alpha, which_position=which_position)
         # logging.info(f"\n\nFinal Results | AVG Loss: {avg_loss:.4f},  AVG Acc: {avg_acc_all:.4f}")
         avg_acc[0].append(avg_acc_all)
         for i in range(num_nodes):
@@ -288,7 +287,6 @@ def main():
         parser.add_argument("--inner_wd", type=float, default=1e-10, help="inner weight decay")
         parser.add_argument("--embed_dim", type=int, default=10, help="embedding dim")
         parser.add_argument("--hyper_hid", type=int, default=100, help="hypernet hidden dim")
-        parser.add_argument("--gpu", type=int, default=1, help="gpu device ID")
         parser.add_argument("--eval_every", type=int, default=50, help="eval every X selected epochs")
         parser.add_argument("--save_path", type=str, default="/home/ancarey/FairFLHN/experiments/adult/results",
                             help="dir path for output file")
@@ -302,16 +300,16 @@ def main():
                             help="size of hidden layers of context network")
         parser.add_argument("--save_file_name", type=str, default="/home/ancarey/FairFLHN/experiments/new/grid_search/results/dp.txt")
 
+        add_execution_args(parser)
         args = parser.parse_args()
         set_logger()
-
-        device = "cuda:1"
+        ctx = execution_from_args(args)
 
         args.classes_per_node = 2
 
         train(
             writer,
-            device=device,
+            ctx=ctx,
             data_name=args.data_name,
             model_name=args.model_name,
             classes_per_node=args.classes_per_node,
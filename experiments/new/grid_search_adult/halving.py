@@ -0,0 +1,149 @@
+import os
+import argparse
+import csv
+import json
+import logging
+import math
+import multiprocessing
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+from experiments.new.grid_search_adult.dataset import get_dataset
+from experiments.new.grid_search_adult.sweep import GRIDS, CellRun, expand_grid, cell_key, init_worker
+from experiments.new.grid_search_adult.utils import set_logger
+warnings.filterwarnings("ignore")
+
+RESULT_FIELDS = ["cell", "rung", "steps", "status", "score", "avg_acc", "acc", "f1", "aod", "eod", "spd", "wall_time", "error"]
+
+def fairness_objective(metric="eod", bound=0.05):
+    # accuracy subject to max |metric| over clients <= bound, infeasible cells rank below every feasible one
+    def objective(results):
+        if metric == "none":
+            return results["avg_acc"]
+        violation = max(abs(v) for v in results[metric]) - bound
+        if violation <= 0:
+            return results["avg_acc"]
+        return results["avg_acc"] - 1 - violation
+    return objective
+
+def rung_steps(min_steps, max_steps, eta):
+    steps = []
+    r = min_steps
+    while r < max_steps:
+        steps.append(r)
+        r *= eta
+    steps.append(max_steps)
+    return steps
+
+def advance(cell, ckpt_path, steps):
+    # runs in a worker: resume the cell from its checkpoint (or start it), train up to `steps`, evaluate
+    start = time.perf_counter()
+    try:
+        run = torch.load(ckpt_path, weights_only=False) if os.path.exists(ckpt_path) else CellRun(cell)
+        if run.step > steps:
+            raise ValueError(f"checkpoint is at step {run.step}, past the {steps} steps of this rung")
+        run.train(steps - run.step)
+        results = run.evaluate()
+        torch.save(run, ckpt_path + ".tmp")
+        os.replace(ckpt_path + ".tmp", ckpt_path)
+        status = "ok"
+    except Exception as e:
+        results = {"error": repr(e)}
+        status = "failed"
+    return cell, status, results, time.perf_counter() - start
+
+def load_rungs(results_path):
+    # latest row per (rung, cell) of earlier runs against the same results table
+    rows = {}
+    if os.path.exists(results_path):
+        with open(results_path, newline="") as f:
+            for row in csv.DictReader(f):
+                rows[(int(row["rung"]), row["cell"])] = row
+    return rows
+
+def successive_halving(cells, min_steps, max_steps, eta, objective, workers, ckpt_dir, results_path):
+    os.makedirs(ckpt_dir, exist_ok=True)
+    ckpt_paths = {cell_key(cell): os.path.join(ckpt_dir, f"cell{i}.pt") for i, cell in enumerate(cells)}
+
+    for data_name in {cell["data_name"] for cell in cells}:
+        for num_nodes in {cell["num_nodes"] for cell in cells}:
+            get_dataset(data_name, num_nodes)
+
+    rungs = rung_steps(min_steps, max_steps, eta)
+    survivors = list(cells)
+    scores = {}
+
+    # an interrupted search resumes from its table: rungs a later rung has started are replayed from their rows,
+    # the last started one only runs the cells it has no ok row for
+    done = load_rungs(results_path)
+    last_rung = max((rung for rung, key in done), default=-1)
+
+    write_header = not os.path.exists(results_path)
+    with open(results_path, "a", newline="") as f, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"), initializer=init_worker) as pool:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+
+        for rung, steps in enumerate(rungs):
+            scores = {}
+            todo = []
+            for cell in survivors:
+                row = done.get((rung, cell_key(cell)))
+                if row is not None and int(row["steps"]) != steps:
+                    raise ValueError(f"{results_path} has rung {rung} at {row['steps']} steps, this search runs it to {steps}")
+                if row is not None and (row["status"] == "ok" or rung < last_rung):
+                    scores[cell_key(cell)] = float(row["score"])
+                else:
+                    todo.append(cell)
+            logging.info(f"rung {rung}: {len(survivors)} cells to {steps} steps, {len(survivors) - len(todo)} already scored in {results_path}")
+
+            futures = [pool.submit(advance, cell, ckpt_paths[cell_key(cell)], steps) for cell in todo]
+            for future in as_completed(futures):
+                cell, status, results, wall_time = future.result()
+                score = objective(results) if status == "ok" else -math.inf
+                scores[cell_key(cell)] = score
+
+                row = {"cell": cell_key(cell), "rung": rung, "steps": steps, "status": status, "score": score, "wall_time": f"{wall_time:.2f}"}
+                row.update({k: json.dumps(v) for k, v in results.items()})
+                writer.writerow(row)
+                f.flush()
+
+            # promote the top 1/eta, drop the checkpoints of everything else
+            ranked = sorted(survivors, key=lambda cell: scores[cell_key(cell)], reverse=True)
+            if rung < len(rungs) - 1:
+                keep = max(1, len(ranked) // eta)
+                for cell in ranked[keep:]:
+                    if os.path.exists(ckpt_paths[cell_key(cell)]):
+                        os.remove(ckpt_paths[cell_key(cell)])
+                survivors = ranked[:keep]
+            else:
+                survivors = ranked
+
+    return [(cell, scores[cell_key(cell)]) for cell in survivors]
+
+def main():
+    parser = argparse.ArgumentParser(description="Fair Hypernetworks successive halving")
+    parser.add_argument("--grid", type=str, default="lr", choices=list(GRIDS.keys()), help="which grid to search")
+    parser.add_argument("--min_steps", type=int, default=200, help="outer steps at the first rung")
+    parser.add_argument("--max_steps", type=int, default=2000, help="outer steps at the last rung")
+    parser.add_argument("--eta", type=int, default=3, help="keep the top 1/eta of the cells at each rung")
+    parser.add_argument("--metric", type=str, default="none", choices=["none", "eod", "spd", "aod"], help="fairness metric bounded by --bound")
+    parser.add_argument("--bound", type=float, default=0.05, help="max |metric| over clients for a cell to count as feasible")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--ckpt_dir", type=str, default="results/halving_ckpt", help="dir for the checkpoints of live cells")
+    parser.add_argument("--results", type=str, default="results/halving.csv", help="results table, one row per cell and rung, an interrupted search resumes from it")
+    args = parser.parse_args()
+    set_logger()
+
+    os.makedirs(os.path.dirname(args.results) or ".", exist_ok=True)
+    cells = expand_grid(GRIDS[args.grid], {"num_steps": args.max_steps})
+
+    best = successive_halving(cells, args.min_steps, args.max_steps, args.eta, fairness_objective(args.metric, args.bound),
+                              args.workers, args.ckpt_dir, args.results)
+    for cell, score in best:
+        logging.info(f"score: {score:.4f}, cell: {cell_key(cell)}")
+
+if __name__ == "__main__":
+    main()
@@ -384,14 +384,7 @@ class Constraint(torch.nn.Module):
             self.register_parameter(name='lmbda', param=torch.nn.Parameter(torch.rand((8,1))))
 
     def forward(self, value):
-        with torch.no_grad():
-            self.lmbda.data = self.lmbda.data.clamp(min=0, max=(np.linalg.norm(self.lmbda.data.cpu().numpy()) + (1/.05)))
-
-        for i, lm in enumerate(self.lmbda.data):
-            if lm.item() < 0:
-                print('hit', lm.item())
-                exit(1)
-
+        # lmbda is kept non-negative by DualAscent.project after every step
         loss = torch.matmul(self.lmbda.T, value)
 
         return loss
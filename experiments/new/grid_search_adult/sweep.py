@@ -0,0 +1,289 @@
+import os
+import argparse
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+import torch.utils.data
+from experiments.new.grid_search_adult.models import LR, Context, LRHyper, Constraint
+from experiments.new.grid_search_adult.node import BaseNodes
+from experiments.new.grid_search_adult.dataset import get_dataset
+from experiments.new.grid_search_adult.utils import seed_everything, set_logger, confusion_counts, counts_to_TP_FP_TN_FN, metrics
+from experiments.new.dual import DualAscent
+from experiments.new.checkpoint import rng_state, set_rng_state
+warnings.filterwarnings("ignore")
+
+LR_VALUES = [1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2]
+ALPHA_VALUES = [1, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100, 125, 150, 175, 200, 250, 300, 400, 500, 1000]
+
+# settings shared by every cell unless the grid overrides them
+BASE_CONFIG = {
+    "data_name": "adult",
+    "num_nodes": 4,
+    "num_steps": 2000,
+    "batch_size": 256,
+    "inner_steps": 50,
+    "n_hidden": 3,
+    "inner_lr": .0001,
+    "lr": 1e-5,
+    "wd": 1e-10,
+    "hyper_hid": 100,
+    "fair": "none",
+    "alpha": 125,
+    "which_position": 8,
+    "context_hidden_size": 100,
+}
+
+GRIDS = {
+    # what the twelve 3-<batch size>-<context hidden size>.py scripts used to run, inner_wd follows wd
+    "lr": {
+        "batch_size": [32, 64, 128, 256],
+        "context_hidden_size": [25, 50, 100],
+        "inner_lr": LR_VALUES,
+        "lr": LR_VALUES,
+        "wd": [1e-10, 1e-8, 1e-6],
+    },
+    # dp.py / eo.py
+    "dp": {"fair": ["dp"], "alpha": ALPHA_VALUES},
+    "eo": {"fair": ["eo"], "alpha": ALPHA_VALUES},
+}
+
+RESULT_FIELDS = ["cell", "status", "avg_acc", "acc", "f1", "aod", "eod", "spd", "wall_time", "error"]
+
+def expand_grid(grid, overrides=None):
+    keys = list(grid.keys())
+    cells = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        cell = dict(BASE_CONFIG)
+        cell.update(overrides or {})
+        cell.update(zip(keys, values))
+        cells.append(cell)
+    return cells
+
+def cell_key(cell):
+    return json.dumps(cell, sort_keys=True)
+
+def client_fairness_alphas(fair, alpha, num_nodes):
+    # 'both' alternates dp and eo clients as the old scripts did, with alpha [dp, eo], a single alpha applies to both
+    if fair != 'both':
+        return [fair] * num_nodes, [alpha] * num_nodes
+    dp_alpha, eo_alpha = alpha if isinstance(alpha, (list, tuple)) else (alpha, alpha)
+    return ['dp' if i % 2 == 0 else 'eo' for i in range(num_nodes)], [dp_alpha if i % 2 == 0 else eo_alpha for i in range(num_nodes)]
+
+@torch.no_grad()
+def evaluate(nodes, hnet, models, cnets, num_features, device, which_position):
+    hnet.eval()
+    results = {"acc": [], "f1": [], "aod": [], "eod": [], "spd": []}
+    total_correct, total_samples = 0, 0
+
+    for node_id in range(len(nodes)):
+        model, cnet = models[node_id], cnets[node_id]
+        counts = 0
+
+        for batch in nodes.test_loaders[node_id]:
+            x, y = tuple(t.float().to(device) for t in batch)
+            s = x[:, which_position]
+
+            avg_context_vector, prediction_vector = cnet(x, num_features)
+            model.load_state_dict(hnet(avg_context_vector, torch.tensor([node_id], dtype=torch.long).to(device)))
+            pred, _ = model(prediction_vector, s, y)
+
+            counts = counts + confusion_counts(s, y, (pred > 0.5).long())
+
+        tp, fp, tn, fn = counts_to_TP_FP_TN_FN(counts)
+        f1, _, _, acc, _, _, aod, eod, spd = metrics(tp, fp, tn, fn)
+        for name, value in zip(["acc", "f1", "aod", "eod", "spd"], [acc, f1, aod, eod, spd]):
+            results[name].append(value)
+
+        total_correct += tp[0] + tn[0]
+        total_samples += tp[0] + tn[0] + fp[0] + fn[0]
+
+    results["avg_acc"] = total_correct / total_samples
+    return results
+
+class CellRun:
+    # one grid cell as a resumable run, so a scheduler can advance it in chunks of outer steps
+    def __init__(self, cell, device="cpu"):
+        seed_everything(0)
+
+        self.cell = cell
+        self.device = device
+        self.step = 0
+
+        num_nodes = cell["num_nodes"]
+        fair = cell["fair"]
+        inner_wd = cell.get("inner_wd", cell["wd"])
+
+        self.nodes = BaseNodes(cell["data_name"], num_nodes, cell["batch_size"], 2)
+        self.num_features = num_features = len(self.nodes.features)
+
+        client_fairness, self.alphas = client_fairness_alphas(fair, cell["alpha"], num_nodes)
+        self.hnet = LRHyper(device=device, n_nodes=num_nodes, embedding_dim=num_features, context_vector_size=num_features,
+                            hidden_size=num_features, hnet_hidden_dim=cell["hyper_hid"], hnet_n_hidden=cell["n_hidden"])
+
+        self.models, self.cnets, self.constraints, self.combo_parameters, self.client_optimizers, self.client_duals = [], [], [], [], [], []
+        for i in range(num_nodes):
+            self.models.append(LR(input_size=num_features, bound=0.05, fairness=client_fairness[i]).to(device))
+            self.cnets.append(Context(input_size=num_features, context_vector_size=num_features, context_hidden_size=cell["context_hidden_size"]).to(device))
+            self.constraints.append(Constraint(fair=client_fairness[i]).to(device))
+            if fair == 'none':
+                self.combo_parameters.append(list(self.models[i].parameters()) + list(self.cnets[i].parameters()))
+            else:
+                self.combo_parameters.append(list(self.models[i].parameters()) + list(self.cnets[i].parameters()) + list(self.constraints[i].parameters()))
+            self.client_optimizers.append(torch.optim.Adam(self.combo_parameters[i], lr=cell["inner_lr"], weight_decay=inner_wd))
+            self.client_duals.append(DualAscent(self.constraints[i].parameters(), self.client_optimizers[i]))
+
+        self.hnet.to(device)
+        self.optimizer = torch.optim.Adam(params=self.hnet.parameters(), lr=cell["lr"], weight_decay=cell["wd"])
+        self.loss = torch.nn.BCELoss()
+        # the cell's own random/numpy/torch streams, so chunks of train() continue them whichever worker runs them
+        self.rng = rng_state()
+
+    def train(self, steps):
+        cell, device, nodes, hnet, optimizer = self.cell, self.device, self.nodes, self.hnet, self.optimizer
+        fair, which_position, num_features = cell["fair"], cell["which_position"], self.num_features
+        set_rng_state(self.rng)
+
+        for step in range(steps):
+            hnet.train()
+            node_id = random.choice(range(cell["num_nodes"]))
+            model, cnet, constraint = self.models[node_id], self.cnets[node_id], self.constraints[node_id]
+            dual = self.client_duals[node_id]
+
+            weights = hnet(nodes.c_i[node_id].to(device), torch.tensor([node_id], dtype=torch.long).to(device))
+            model.load_state_dict(weights)
+            inner_state = {k: tensor.data for k, tensor in weights.items()}
+
+            avg_c_i = []
+            for j in range(cell["inner_steps"]):
+                model.train()
+                dual.zero_grad()
+
+                batch = next(iter(nodes.train_loaders[node_id]))
+                x, y = tuple(t.float().to(device) for t in batch)
+                s = x[:, which_position]
+
+                avg_context_vector, pred_vec = cnet(x, num_features)
+                pred, m_mu_q = model(pred_vec, s, y)
+                avg_c_i.append(avg_context_vector.detach())
+
+                if fair == 'none':
+                    err = self.loss(pred, y.unsqueeze(1))
+                else:
+                    err = self.loss(pred, y.unsqueeze(1)) + self.alphas[node_id] * constraint(m_mu_q)
+
+                err.backward()
+                dual.step()
+
+            nodes.c_i[node_id] = torch.stack(avg_c_i).mean(dim=0)
+
+            optimizer.zero_grad()
+            final_state = model.state_dict()
+            delta_theta = [inner_state[k] - final_state[k] for k in weights.keys()]
+            hnet_grads = torch.autograd.grad(list(weights.values()), hnet.parameters(), grad_outputs=delta_theta)
+            for p, g in zip(hnet.parameters(), hnet_grads):
+                p.grad = g
+            optimizer.step()
+
+            self.step += 1
+
+        self.rng = rng_state()
+
+    def __getstate__(self):
+        # the client splits are rebuilt on load instead of pickled, only the context vectors travel
+        state = dict(self.__dict__)
+        state["c_i"] = state.pop("nodes").c_i
+        return state
+
+    def __setstate__(self, state):
+        c_i = state.pop("c_i")
+        self.__dict__.update(state)
+
+        # same split as in __init__, which builds the nodes right after seed_everything(0)
+        py_state, torch_state = random.getstate(), torch.get_rng_state()
+        random.seed(0)
+        self.nodes = BaseNodes(self.cell["data_name"], self.cell["num_nodes"], self.cell["batch_size"], 2)
+        random.setstate(py_state)
+        torch.set_rng_state(torch_state)
+        self.nodes.c_i = c_i
+
+    def evaluate(self):
+        return evaluate(self.nodes, self.hnet, self.models, self.cnets, self.num_features, self.device, self.cell["which_position"])
+
+def train_cell(cell, device="cpu"):
+    run = CellRun(cell, device)
+    run.train(cell["num_steps"])
+    return run.evaluate()
+
+def init_worker():
+    # one worker per core, so keep torch from spawning its own thread pool in each of them
+    torch.set_num_threads(1)
+
+def run_cell(cell):
+    start = time.perf_counter()
+    try:
+        results = train_cell(cell)
+        status = "ok"
+    except Exception as e:
+        results = {"error": repr(e)}
+        status = "failed"
+    return cell, status, results, time.perf_counter() - start
+
+def load_finished(results_path):
+    # only cells that completed count, failed ones (OOM, a killed worker) are retried on the next run
+    if not os.path.exists(results_path):
+        return set()
+    with open(results_path, newline="") as f:
+        return {row["cell"] for row in csv.DictReader(f) if row["status"] == "ok"}
+
+def run_sweep(cells, results_path, workers):
+    finished = load_finished(results_path)
+    todo = [cell for cell in cells if cell_key(cell) not in finished]
+    logging.info(f"{len(cells)} cells, {len(cells) - len(todo)} already in {results_path}, running {len(todo)} on {workers} workers")
+
+    # parse the dataset once before forking, the workers inherit it read-only
+    for data_name in {cell["data_name"] for cell in todo}:
+        for num_nodes in {cell["num_nodes"] for cell in todo}:
+            get_dataset(data_name, num_nodes)
+
+    write_header = not os.path.exists(results_path)
+    with open(results_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+            f.flush()
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"), initializer=init_worker) as pool:
+            futures = [pool.submit(run_cell, cell) for cell in todo]
+            for done, future in enumerate(as_completed(futures)):
+                cell, status, results, wall_time = future.result()
+                row = {"cell": cell_key(cell), "status": status, "wall_time": f"{wall_time:.2f}"}
+                row.update({k: json.dumps(v) for k, v in results.items()})
+                writer.writerow(row)
+                f.flush()
+
+                logging.info(f"[{done + 1}/{len(todo)}] {status} in {wall_time:.1f}s, AVG Acc: {results.get('avg_acc', float('nan')):.4f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Fair Hypernetworks grid search")
+    parser.add_argument("--grid", type=str, default="lr", choices=list(GRIDS.keys()), help="which grid to sweep")
+    parser.add_argument("--results", type=str, default="results/sweep.csv", help="results table, cells that finished ok in it are skipped")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--num_steps", type=int, default=None, help="override the number of outer steps of every cell")
+    args = parser.parse_args()
+    set_logger()
+
+    overrides = {} if args.num_steps is None else {"num_steps": args.num_steps}
+    os.makedirs(os.path.dirname(args.results) or ".", exist_ok=True)
+
+    run_sweep(expand_grid(GRIDS[args.grid], overrides), args.results, args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -66,6 +66,21 @@ def TP_FP_TN_FN(x, predicted_prediction, labels_pred, which_position):
 
     return TP, FP, TN, FN
 
+def confusion_counts(s, y, y_hat):
+    # counts[group, label, prediction] in one bincount, group 0 is s == 0 (f) and 1 is everything else (m)
+    code = (s.flatten() != 0).long() * 4 + y.flatten().long() * 2 + y_hat.flatten().long()
+    return torch.bincount(code, minlength=8).view(2, 2, 2)
+
+def counts_to_TP_FP_TN_FN(counts):
+    c = counts.tolist()
+
+    TP = [c[0][1][1] + c[1][1][1], c[0][1][1], c[1][1][1]] # all, f, m
+    FP = [c[0][0][1] + c[1][0][1], c[0][0][1], c[1][0][1]]
+    TN = [c[0][0][0] + c[1][0][0], c[0][0][0], c[1][0][0]]
+    FN = [c[0][1][0] + c[1][1][0], c[0][1][0], c[1][1][0]]
+
+    return TP, FP, TN, FN
+
 def metrics(TP, FP, TN, FN): #double checked, all metrics are calculated correctly based on the aif360
     blank = [0, 0, 0]
 
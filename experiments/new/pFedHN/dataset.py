@@ -151,8 +151,8 @@ def get_dataset(data_name, num_clients):
 
     return datasets, splits, features, labels
 
-def gen_random_loaders(data_name, num_clients, bz):
-    loader_params = {"batch_size": bz, "shuffle": True, "pin_memory": True, "num_workers": 0}
+def gen_random_loaders(data_name, num_clients, bz, pin_memory=False):
+    loader_params = {"batch_size": bz, "shuffle": True, "pin_memory": pin_memory, "num_workers": 0}
 
     dataloaders = []
 
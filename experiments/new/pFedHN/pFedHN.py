@@ -1,5 +1,4 @@
 import os
-os.environ['CUDA_VISIBLE_DEVICES'] = "1, 2, 3, 4, 5, 6, 7"
 import argparse
 import logging
 import random
@@ -10,13 +9,20 @@ import torch
 import pandas as pd
 import torch.utils.data
 from tqdm import trange
-from pFedHN_models import LRHyper, LR, Constraint
-from node import BaseNodes
-from utils import seed_everything, set_logger, TP_FP_TN_FN, metrics
+from experiments.new.pFedHN.pFedHN_models import LRHyper, LR, Constraint, flatten_weights
+from experiments.new.pFedHN.node import BaseNodes
+from experiments.new.pFedHN.utils import seed_everything, set_logger, TP_FP_TN_FN, counts_to_TP_FP_TN_FN, metrics
+from experiments.new.execution import add_execution_args, execution_from_args
+from experiments.new.dual import DualAscent
+from experiments.new.sampling import make_sampler, add_sampler_args
+from experiments.new.checkpoint import pack_optimizer_states, load_optimizer_states, pack_module_states, load_module_states, rng_state, set_rng_state, add_checkpoint_args, checkpoints_from_args
 warnings.filterwarnings("ignore")
 
-def eval_model(nodes, num_nodes, hnet, model, device, which_position):
-    curr_results, preds, true, a, f_a, m_a, eod, spd = evaluate(nodes, num_nodes, hnet, model, device, which_position)
+def eval_model(nodes, num_nodes, hnet, model, ctx, which_position, engine='loop'):
+    if engine == 'batched':
+        curr_results, preds, true, a, f_a, m_a, eod, spd = evaluate_batched(nodes, num_nodes, hnet, ctx, which_position)
+    else:
+        curr_results, preds, true, a, f_a, m_a, eod, spd = evaluate(nodes, num_nodes, hnet, model, ctx, which_position)
     total_correct = sum([val['correct'] for val in curr_results.values()])
     total_samples = sum([val['total'] for val in curr_results.values()])
     avg_acc = total_correct / total_samples
@@ -26,7 +32,7 @@ def eval_model(nodes, num_nodes, hnet, model, device, which_position):
     return curr_results, avg_acc, all_acc, f_a, m_a, eod, spd
 
 @torch.no_grad()
-def evaluate(nodes, num_nodes, hnet, models, device, which_position):
+def evaluate(nodes, num_nodes, hnet, models, ctx, which_position):
     hnet.eval()
     results = defaultdict(lambda: defaultdict(list))
     preds = []
@@ -39,27 +45,28 @@ def evaluate(nodes, num_nodes, hnet, models, device, which_position):
         queries_client = []
         model = models[node_id]
         model.eval()
-        model.to(device)
+        ctx.module(model)
 
         running_loss, running_correct, running_samples = 0, 0, 0
 
         curr_data = nodes.test_loaders[node_id]
 
         for batch_count, batch in enumerate(curr_data):
-            x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-            s = x[:, which_position].to(device)
+            x, y = ctx.batch(batch)
+            s = x[:, which_position]
 
-            true_client.extend(y.cpu().numpy())
-            queries_client.extend(x.cpu().numpy())
+            # numpy has no bfloat16, the host copies are upcast
+            true_client.extend(y.cpu().float().numpy())
+            queries_client.extend(x.cpu().float().numpy())
 
-            weights = hnet(torch.tensor([node_id], dtype=torch.long).to(device))
+            weights = hnet(ctx.index(node_id))
             model.load_state_dict(weights)
 
             pred, m_mu_q = model(x, s, y)
             pred_thresh = (pred > 0.5).long()
             pred_client.extend(pred_thresh.flatten().cpu().numpy())
 
-            correct = torch.eq(pred_thresh, y.unsqueeze(1)).type(torch.cuda.LongTensor)
+            correct = torch.eq(pred_thresh, y.unsqueeze(1)).long()
             running_correct += torch.count_nonzero(correct).item()
 
             running_samples += len(y)
@@ -80,9 +87,48 @@ def evaluate(nodes, num_nodes, hnet, models, device, which_position):
 
     return results, preds, true, a, f_a, m_a, eod, spd
 
-def train(device, data_name, classes_per_node, num_nodes, steps, inner_steps, lr, inner_lr, wd, inner_wd, hyper_hid, n_hidden, bs, alpha, fair, which_position):
+@torch.no_grad()
+def evaluate_batched(nodes, num_nodes, hnet, ctx, which_position):
+    # evaluate() in one pass: the test sets of all clients concatenated with a client id per row, the weights of
+    # every client from one hypernetwork call, one einsum for all predictions and confusion counts per client by bincount
+    hnet.eval()
+
+    X = ctx.float(torch.cat([nodes.test_loaders[i].dataset.X for i in range(num_nodes)]))
+    Y = ctx.float(torch.cat([nodes.test_loaders[i].dataset.y for i in range(num_nodes)]))
+    client = ctx.long(torch.repeat_interleave(torch.arange(num_nodes), torch.tensor([len(nodes.test_loaders[i].dataset) for i in range(num_nodes)])))
+
+    weights = hnet.forward_batch(ctx.index(list(range(num_nodes))))
+    w, b = weights["fc1.weight"][:, 0], weights["fc1.bias"][:, 0]
+    pred = torch.sigmoid(torch.einsum('nd,nd->n', X, w[client]) + b[client])
+    pred_thresh = (pred > 0.5).long()
+
+    code = client * 8 + (X[:, which_position] != 0).long() * 4 + Y.long() * 2 + pred_thresh
+    counts = torch.bincount(code, minlength=num_nodes * 8).view(num_nodes, 2, 2, 2).cpu()
+
+    results = defaultdict(lambda: defaultdict(list))
+    preds, true = [], []
+    a, f_a, m_a, eod, spd = [], [], [], [], []
+    client, pred_thresh, Y = client.cpu().numpy(), pred_thresh.cpu().numpy(), Y.cpu().float().numpy()
+
+    for node_id in range(num_nodes):
+        tp, fp, tn, fn = counts_to_TP_FP_TN_FN(counts[node_id])
+        accuracy, f_acc, m_acc, EOD, SPD = metrics(tp, fp, tn, fn)
+
+        a.append(accuracy)
+        f_a.append(f_acc)
+        m_a.append(m_acc)
+        eod.append(EOD)
+        spd.append(SPD)
+        results[node_id]['correct'] = tp[0] + tn[0]
+        results[node_id]['total'] = tp[0] + tn[0] + fp[0] + fn[0]
+        preds.append(list(pred_thresh[client == node_id]))
+        true.append(list(Y[client == node_id]))
+
+    return results, preds, true, a, f_a, m_a, eod, spd
+
+def train(ctx, data_name, classes_per_node, num_nodes, steps, inner_steps, lr, inner_lr, wd, inner_wd, hyper_hid, n_hidden, bs, alpha, fair, which_position,
+          sampler='uniform', max_staleness=None, sampler_log_every=100, checkpoints=None, resume=False, eval_engine='loop'):
 
-    b = 1/alpha[0]
     avg_acc = [[] for i in range(num_nodes + 1)]
     all_eod =  [[] for i in range(num_nodes)]
     all_spd = [[] for i in range(num_nodes)]
@@ -97,7 +143,7 @@ def train(device, data_name, classes_per_node, num_nodes, steps, inner_steps, lr
     for i in range(1):
         seed_everything(0)
 
-        nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node)
+        nodes = BaseNodes(data_name, num_nodes, bs, classes_per_node, pin_memory=ctx.pin_memory)
         num_features = len(nodes.features)
         embed_dim = num_features
         mu_size = 0
@@ -122,42 +168,57 @@ def train(device, data_name, classes_per_node, num_nodes, steps, inner_steps, lr
             client_fairness = ['none' for i in range(num_nodes)]
             alphas = ['none' for i in range(num_nodes)]
 
-        hnet = LRHyper(device=device, n_nodes=num_nodes, embedding_dim=embed_dim, context_vector_size=num_features,
+        hnet = LRHyper(device=ctx.device, n_nodes=num_nodes, embedding_dim=embed_dim, context_vector_size=num_features,
                        hidden_size=num_features, hnet_hidden_dim=hyper_hid, hnet_n_hidden=n_hidden)
 
         for i in range(num_nodes):
-            models[i] = LR(input_size=num_features, bound=alphas[i], fairness=client_fairness[i])
-            constraints[i] = Constraint(bound=alphas[i], fair=client_fairness[i])
+            models[i] = ctx.module(LR(input_size=num_features, bound=alphas[i], fairness=client_fairness[i]))
+            constraints[i] = ctx.module(Constraint(bound=alphas[i], fair=client_fairness[i]))
             client_optimizers_theta[i] = torch.optim.Adam(models[i].parameters(), lr=inner_lr, weight_decay=inner_wd)
             if fair != 'none':
-                client_optimizers_lambda[i] = torch.optim.Adam(constraints[i].parameters(), lr=inner_lr, weight_decay=inner_wd)
+                client_optimizers_lambda[i] = DualAscent(constraints[i].parameters(), torch.optim.Adam(constraints[i].parameters(), lr=inner_lr, weight_decay=inner_wd), radius=constraints[i].bound)
 
-        hnet.to(device)
+        ctx.module(hnet)
 
         optimizer = torch.optim.Adam(params=hnet.parameters(), lr=lr, weight_decay=wd)
         loss = torch.nn.BCELoss()
-        step_iter = trange(steps)
 
-        nodes_choices = [0, 1, 2, 3]
+        client_sampler = make_sampler(sampler, num_nodes, sizes=[len(loader.dataset) for loader in nodes.train_loaders], max_staleness=max_staleness)
+
+        start_step = 0
+        state = checkpoints.load() if checkpoints is not None and resume else None
+        if state is not None:
+            start_step = state['step']
+            hnet.load_state_dict(state['hnet'])
+            optimizer.load_state_dict(state['optimizer'])
+            load_module_states(models, state['models'])
+            load_module_states(constraints, state['constraints'])
+            load_optimizer_states(client_optimizers_theta, state['client_optimizers_theta'])
+            load_optimizer_states(client_optimizers_lambda, state['client_optimizers_lambda'])
+            client_sampler.load_state_dict(state['sampler'])
+            set_rng_state(state['rng'])
 
-        for _ in step_iter:
+        step_iter = trange(start_step, steps)
+
+        for step in step_iter:
             hnet.train()
-            node_id = random.choice(nodes_choices)
+            node_id = client_sampler.sample()[0]
+            running_err = 0
 
             model = models[node_id]
             alpha=alphas[node_id]
 
             if fair != 'none':
                 constraint = constraints[node_id]
-                constraint.to(device)
+                ctx.module(constraint)
 
             inner_optim_theta = client_optimizers_theta[node_id]
             inner_optim_lambda = client_optimizers_lambda[node_id]
 
-            weights = hnet(torch.tensor([node_id], dtype=torch.long).to(device))
-            model.load_state_dict(weights)
-            model.to(device)
-            inner_state = OrderedDict({k: tensor.data for k, tensor in weights.items()})
+            weights = hnet(ctx.index(node_id))
+            flat_weights = flatten_weights(weights)
+            ctx.module(model)
+            model.load_flat(flat_weights)
             model.train()
 
             for j in range(inner_steps):
@@ -167,8 +228,8 @@ def train(device, data_name, classes_per_node, num_nodes, steps, inner_steps, lr
                 optimizer.zero_grad()
 
                 batch = next(iter(nodes.train_loaders[node_id]))
-                x, y = tuple((t.type(torch.cuda.FloatTensor)).to(device) for t in batch)
-                s = x[:, which_position].to(device)
+                x, y = ctx.batch(batch)
+                s = x[:, which_position]
 
                 pred, m_mu_q = model(x, s, y)
                 if fair == 'none':
@@ -180,38 +241,37 @@ def train(device, data_name, classes_per_node, num_nodes, steps, inner_steps, lr
                     err = er.mean()
 
                 err.backward()
+                running_err += err.detach().sum()
                 inner_optim_theta.step()
 
                 if fair != 'none':
-                    constraint.lmbda.data = torch.clamp(constraint.lmbda.data, min=0)
-                    torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1)
-
-                    if torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1) > b:
-                        print(torch.nn.utils.clip_grad_norm_(constraint.lmbda.data, b, norm_type=1))
-                        print(constraint.lmbda)
-                        exit(1)
-
-                    for i, item in enumerate(constraint.lmbda.data):
-                        if item < 0:
-                            print(constraint.lmbda)
-                            exit(2)
-
-                    for group in inner_optim_lambda.param_groups:
-                        for p in group['params']:
-                            p.grad = -1 * p.grad
-
                     inner_optim_lambda.step()
 
             optimizer.zero_grad()
-            final_state = model.state_dict()
-            delta_theta = OrderedDict({k: inner_state[k] - final_state[k] for k in weights.keys()})
-            hnet_grads = torch.autograd.grad(list(weights.values()), hnet.parameters(), grad_outputs=list(delta_theta.values()))
+            delta_theta = flat_weights.detach() - model.flat
+            hnet_grads = torch.autograd.grad(flat_weights, hnet.parameters(), grad_outputs=delta_theta)
             for p, g in zip(hnet.parameters(), hnet_grads):
                 p.grad = g
 
             optimizer.step()
 
-        step_results, avg_acc_all, all_acc, f_a, m_a, eod, spd = eval_model(nodes=nodes, num_nodes=num_nodes, hnet=hnet, model=models, device=device, which_position=which_position)
+            client_sampler.update(node_id, running_err / inner_steps)
+            if sampler_log_every and (step + 1) % sampler_log_every == 0:
+                logging.info(f"Step: {step + 1}, sampler: {client_sampler.stats()}")
+
+            if checkpoints is not None and checkpoints.due(step):
+                checkpoints.save(step + 1, {
+                    'hnet': hnet.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'models': pack_module_states(models),
+                    'constraints': pack_module_states(constraints),
+                    'client_optimizers_theta': pack_optimizer_states(client_optimizers_theta),
+                    'client_optimizers_lambda': pack_optimizer_states(client_optimizers_lambda),
+                    'sampler': client_sampler.state_dict(),
+                    'rng': rng_state(),
+                })
+
+        step_results, avg_acc_all, all_acc, f_a, m_a, eod, spd = eval_model(nodes=nodes, num_nodes=num_nodes, hnet=hnet, model=models, ctx=ctx, which_position=which_position, engine=eval_engine)
         logging.info(f"\n\nFinal Results | AVG Acc: {avg_acc_all:.4f}")
         avg_acc[0].append(avg_acc_all)
         for i in range(num_nodes):
@@ -267,13 +327,22 @@ def main():
                 parser.add_argument("--alpha", type=int, default=[.01,.1], help="fairness/accuracy trade-off parameter")
                 parser.add_argument("--which_position", type=int, default=5, choices=[5, 8],
                                     help="which position the sensitive attribute is in. 5: compas, 8: adult")
+                parser.add_argument("--eval_engine", type=str, default="loop", choices=["loop", "batched"],
+                                    help="loop: client by client and batch by batch, batched: all clients in one pass")
+                add_sampler_args(parser)
+                add_execution_args(parser)
+                add_checkpoint_args(parser)
                 args = parser.parse_args()
                 set_logger()
-                device = "cuda:2"
+                ctx = execution_from_args(args)
+                checkpoints = checkpoints_from_args(args)
+                if checkpoints is not None:
+                    # one checkpoint dir per grid point, so a resumed sweep never picks up another config's run
+                    checkpoints.ckpt_dir = os.path.join(args.ckpt_dir, f'clr{d}-hlr{h}-steps{s}')
                 print(args.alpha[0], args.which_position)
                 args.classes_per_node = 2
                 train(
-                    device=device,
+                    ctx=ctx,
                     data_name=args.data_name,
                     classes_per_node=args.classes_per_node,
                     num_nodes=args.num_nodes,
@@ -288,7 +357,13 @@ def main():
                     bs=args.batch_size,
                     alpha=args.alpha,
                     fair=args.fair,
-                    which_position=args.which_position)
+                    which_position=args.which_position,
+                    sampler=args.sampler,
+                    max_staleness=args.max_staleness,
+                    sampler_log_every=args.sampler_log_every,
+                    checkpoints=checkpoints,
+                    resume=args.resume,
+                    eval_engine=args.eval_engine)
 
 
 if __name__ == "__main__":
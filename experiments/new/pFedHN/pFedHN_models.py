@@ -2,6 +2,7 @@ from collections import OrderedDict
 import torch
 from torch import nn
 import numpy as np
+from experiments.new.constraints import constraint_shape, constraint_matrix
 
 
 class LRHyper(nn.Module):
@@ -41,6 +42,21 @@ class LRHyper(nn.Module):
 
         return weights
 
+    def forward_batch(self, idx):
+        # weights of K clients in one pass, with a leading K dim
+        features = self.mlp(self.embeddings(idx))
+
+        weights = OrderedDict({
+            "fc1.weight": self.fc1_weights(features).view(len(idx), 1, self.context_vector_size),
+            "fc1.bias": self.fc1_bias(features).view(len(idx), 1),
+        })
+
+        return weights
+
+
+def flatten_weights(weights):
+    # hypernetwork output dict -> one vector in the layout of LR.flat
+    return torch.cat([tensor.flatten() for tensor in weights.values()])
 
 class LR(nn.Module):
     def __init__(self, input_size, bound, fairness):
@@ -54,55 +70,37 @@ class LR(nn.Module):
         self.input_size = input_size
         self.fc1 = nn.Linear(self.input_size, 1)
         self.y_classes = [0, 1]
-
-        if self.fairness == 'dp':
-            self.n_constraints = 2 * self.num_classes
-            self.dim_condition = self.num_classes + 1
-            self.M = torch.zeros((self.n_constraints, self.dim_condition))
-            self.c = torch.tensor([self.eps for x in range(self.n_constraints)])
-
-            for i in range(self.n_constraints):
-                j = i % 2
-
-                if i == 0 or i == 1:
-                    if j == 0:
-                        self.M[i, j] = 1.0
-                        self.M[i, -1] = -1.0
-                    else:
-                        self.M[i, j - 1] = -1.0
-                        self.M[i, -1] = 1.0
-                elif i == 2 or i == 3:
-                    if j == 0:
-                        self.M[i, j + 1] = 1.0
-                        self.M[i, -1] = -1
-                    else:
-                        self.M[i, j] = -1
-                        self.M[i, -1] = 1
-
-        elif self.fairness == 'eo':
-            self.n_constraints = self.num_classes * self.num_classes * 2
-            self.dim_condition = self.num_classes * (self.num_classes + 1)
-            self.M = torch.zeros((self.n_constraints, self.dim_condition))
-
-            self.c = torch.tensor([self.eps for x in range(self.n_constraints)])
-            element_k_a = self.sensitive_classes + [None]
-
-            for i_a, a_0 in enumerate(self.sensitive_classes):
-                for i_y, y_0 in enumerate(self.y_classes):
-                    for i_s, s in enumerate([-1, 1]):
-                        for j_y, y_1 in enumerate(self.y_classes):
-                            for j_a, a_1 in enumerate(element_k_a):
-                                i = i_a * (2 * self.num_classes) + i_y * 2 + i_s
-                                j = j_y + self.num_classes * j_a
-                                self.M[i, j] = self.__element_M(a_0, a_1, y_1, y_1, s)
-
-    def __element_M(self, a0, a1, y0, y1, s):
-        if a0 is None or a1 is None:
-            x = y0 == y1
-            return -1 * s * x
-        else:
-            x = (a0 == a1) & (y0 == y1)
-            return s * float(x)
+        self.flat = None
+        self._bind_flat()
+
+        if self.fairness != 'none':
+            self.n_constraints, self.dim_condition = constraint_shape(self.fairness, self.num_classes, len(self.sensitive_classes))
+            self.register_buffer('M', constraint_matrix(self.fairness, self.num_classes, len(self.sensitive_classes)), persistent=False)
+            self.register_buffer('c', torch.full((self.n_constraints,), float(self.eps)), persistent=False)
+
+    def _bind_flat(self):
+        # fc1.weight and fc1.bias are kept as views into one contiguous buffer, self.flat
+        n = self.fc1.weight.numel()
+        if self.flat is not None and self.fc1.weight.data_ptr() == self.flat.data_ptr() and self.fc1.bias.data_ptr() == self.flat[n:].data_ptr():
+            return
+
+        self.flat = torch.cat((self.fc1.weight.data.flatten(), self.fc1.bias.data.flatten()))
+        self.fc1.weight.data = self.flat[:n].view_as(self.fc1.weight)
+        self.fc1.bias.data = self.flat[n:].view_as(self.fc1.bias)
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to()/.cuda() may replace the parameter storage, so re-point the views afterwards
+        super()._apply(fn, *args, **kwargs)
+        self._bind_flat()
+        if self.fairness != 'none':
+            # swap the private copy _apply made for the shared matrix on the new device
+            self.M = constraint_matrix(self.fairness, self.num_classes, len(self.sensitive_classes), self.M.device, self.M.dtype)
+        return self
+
+    @torch.no_grad()
+    def load_flat(self, flat_weights):
+        # flat_weights is fc1.weight followed by fc1.bias, as produced by flatten_weights
+        self.flat.copy_(flat_weights)
 
     def mu_f(self, out, sensitive, y):
         expected_values_list = []
@@ -139,7 +137,7 @@ class LR(nn.Module):
         return torch.stack(expected_values_list)
 
     def M_mu_q(self, pred, sensitive, y):
-        return torch.mv(self.M.to(pred.device), self.mu_f(pred, sensitive, y)) - self.c.to(pred.device)
+        return torch.mv(self.M, self.mu_f(pred, sensitive, y)) - self.c
 
     def forward(self, x, s, y):
         prediction = torch.sigmoid(self.fc1(x))
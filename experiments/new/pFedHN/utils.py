@@ -54,6 +54,17 @@ def TP_FP_TN_FN(x, predicted_prediction, labels_pred, which_position):
 
     return TP, FP, TN, FN
 
+def counts_to_TP_FP_TN_FN(counts):
+    # counts[group, label, prediction], group 0 is s == 0 (f) and 1 is everything else (m)
+    c = counts.tolist()
+
+    TP = [c[0][1][1] + c[1][1][1], c[0][1][1], c[1][1][1]] # all, f, m
+    FP = [c[0][0][1] + c[1][0][1], c[0][0][1], c[1][0][1]]
+    TN = [c[0][0][0] + c[1][0][0], c[0][0][0], c[1][0][0]]
+    FN = [c[0][1][0] + c[1][1][0], c[0][1][0], c[1][1][0]]
+
+    return TP, FP, TN, FN
+
 def metrics(TP, FP, TN, FN):
 
     accuracy = (TP[0] + TN[0]) / (TP[0] + FP[0] + FN[0] + TN[0])
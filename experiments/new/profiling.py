@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import logging
+import contextlib
+from collections import defaultdict
+import numpy as np
+import torch
+
+# what a disabled timer hands out, entering it does nothing
+_NULL_PHASE = contextlib.nullcontext()
+
+class PhaseTimer:
+    """Named wall-clock timers and counters around the phases of an outer step.
+
+    `with timer.phase('hnet_forward'):` times a block, `timer.count('inner_steps')` bumps a counter and
+    `timer.step(step)` marks the start of an outer step. Disabled, phase() returns a shared null context and count()
+    returns at once, so the hooks can stay in the hot loop. Enabled on cuda, every phase boundary synchronizes
+    so the time lands on the phase that queued the work.
+
+    Durations are kept per phase for the summary percentiles and TensorBoard histograms, the first
+    `max_trace_events` phases also as Chrome trace events. Between torch_profile_start and
+    torch_profile_start + torch_profile_steps a torch.profiler capture runs with every phase as a record_function.
+    """
+    def __init__(self, enabled=False, device=None, trace_path=None, max_trace_events=200000, torch_profile_start=None, torch_profile_steps=0, torch_profile_dir=None):
+        self.enabled = enabled
+        self.sync = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.trace_path = trace_path
+        self.max_trace_events = max_trace_events
+        self.torch_profile_start = torch_profile_start
+        self.torch_profile_steps = torch_profile_steps
+        self.torch_profile_dir = torch_profile_dir
+
+        self.durations = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.flushed = defaultdict(int)
+        self.trace_events = []
+        self.origin = time.perf_counter()
+        self.profiler = None
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        record = torch.profiler.record_function(name) if self.profiler is not None else _NULL_PHASE
+        start = time.perf_counter()
+        with record:
+            yield
+            if self.sync:
+                torch.cuda.synchronize()
+        end = time.perf_counter()
+
+        self.durations[name].append(end - start)
+        if len(self.trace_events) < self.max_trace_events:
+            self.trace_events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                                      'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6})
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def step(self, step):
+        # called at the start of outer step `step`, opens and closes the torch.profiler window
+        if not self.enabled:
+            return
+        if self.profiler is None and step == self.torch_profile_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.__enter__()
+        elif self.profiler is not None and step == self.torch_profile_start + self.torch_profile_steps:
+            self._stop_profiler(step)
+
+    def _stop_profiler(self, step):
+        self.profiler.__exit__(None, None, None)
+        path = os.path.join(self.torch_profile_dir or '.', f'torch_profile_{self.torch_profile_start}-{step}.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.profiler.export_chrome_trace(path)
+        logging.info(f"torch.profiler: steps {self.torch_profile_start}-{step} written to {path}")
+        logging.info(self.profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+        self.profiler = None
+        self.torch_profile_start = None
+
+    def summary(self):
+        # per phase: calls, total seconds, mean and percentiles in milliseconds
+        summary = {}
+        for name, durations in self.durations.items():
+            d = np.asarray(durations) * 1e3
+            summary[name] = {'calls': len(d), 'total_s': float(d.sum() / 1e3), 'mean_ms': float(d.mean()),
+                             'p50_ms': float(np.percentile(d, 50)), 'p90_ms': float(np.percentile(d, 90)), 'p99_ms': float(np.percentile(d, 99))}
+        return summary
+
+    def write_tensorboard(self, writer, step):
+        # mean per phase and a histogram of the phase times since the last write
+        if not self.enabled or writer is None:
+            return
+        means = {}
+        for name, durations in self.durations.items():
+            recent = np.asarray(durations[self.flushed[name]:]) * 1e3
+            self.flushed[name] = len(durations)
+            if len(recent):
+                means[name] = float(recent.mean())
+                writer.add_histogram(f'phase_ms/{name}', recent, step)
+        if means:
+            writer.add_scalars('phase_ms', means, step)
+        if self.counters:
+            writer.add_scalars('counters', dict(self.counters), step)
+
+    def export_chrome_trace(self, path=None):
+        path = path or self.trace_path
+        if not self.enabled or path is None:
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+        logging.info(f"phase trace with {len(self.trace_events)} events written to {path}")
+
+    def close(self, writer=None, step=None):
+        if not self.enabled:
+            return
+        if self.profiler is not None:
+            # the run ended inside the capture window
+            self._stop_profiler(step)
+        if step is not None:
+            self.write_tensorboard(writer, step)
+        self.export_chrome_trace()
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]['total_s']):
+            logging.info(f"phase {name}: {stats}")
+        if self.counters:
+            logging.info(f"counters: {dict(self.counters)}")
+
+# shared disabled timer, the default wherever a timer is optional
+NO_TIMER = PhaseTimer(enabled=False)
+
+def add_profiling_args(parser):
+    parser.add_argument("--profile", action="store_true", help="time the phases of every outer step")
+    parser.add_argument("--profile_dir", type=str, default="results/profile", help="dir for the phase trace and torch.profiler captures")
+    parser.add_argument("--profile_log_every", type=int, default=100, help="write phase times to TensorBoard every X outer steps")
+    parser.add_argument("--torch_profile_start", type=int, default=None, help="outer step at which a torch.profiler capture starts")
+    parser.add_argument("--torch_profile_steps", type=int, default=5, help="outer steps captured by torch.profiler")
+    return parser
+
+def profiler_from_args(args, device=None):
+    if not args.profile and args.torch_profile_start is None:
+        return NO_TIMER
+    return PhaseTimer(enabled=True, device=device, trace_path=os.path.join(args.profile_dir, 'phases.json'),
+                      torch_profile_start=args.torch_profile_start, torch_profile_steps=args.torch_profile_steps, torch_profile_dir=args.profile_dir)
@@ -0,0 +1,176 @@
+import random
+import numpy as np
+
+SAMPLERS = ['uniform', 'size', 'loss', 'round_robin', 'stale_first']
+
+class ClientSampler:
+    """Picks the clients of each outer step and keeps per-client counters.
+
+    selected[i] counts how often client i was picked and last_step[i] the outer step it was last picked at (-1 if never),
+    so staleness = step - last_step bounds how old its context vector c_i is. With max_staleness set, any client that has
+    not been picked for that many steps is forced in ahead of the policy.
+    """
+    def __init__(self, num_nodes, max_staleness=None):
+        self.num_nodes = num_nodes
+        self.max_staleness = max_staleness
+        self.step = 0
+        self.selected = np.zeros(num_nodes, dtype=np.int64)
+        self.last_step = np.full(num_nodes, -1, dtype=np.int64)
+
+    def staleness(self):
+        return self.step - self.last_step
+
+    def policy(self, k, exclude):
+        raise NotImplementedError
+
+    def sample(self, k=1):
+        k = min(k, self.num_nodes)
+        node_ids = []
+
+        if self.max_staleness is not None:
+            staleness = self.staleness()
+            overdue = np.flatnonzero(staleness >= self.max_staleness)
+            node_ids = overdue[np.argsort(-staleness[overdue], kind='stable')][:k].tolist()
+
+        if len(node_ids) < k:
+            node_ids += self.policy(k - len(node_ids), set(node_ids))
+
+        self.selected[node_ids] += 1
+        self.last_step[node_ids] = self.step
+        self.step += 1
+        return node_ids
+
+    def update(self, node_id, loss=None):
+        # feedback after a client trained, only used by the loss policy
+        pass
+
+    def stats(self):
+        staleness = self.staleness()
+        return {
+            'selected_min': int(self.selected.min()),
+            'selected_max': int(self.selected.max()),
+            'never_selected': int((self.last_step < 0).sum()),
+            'staleness_max': int(staleness.max()),
+            'staleness_mean': float(staleness.mean()),
+        }
+
+    def state_dict(self):
+        return {'step': self.step, 'selected': self.selected.copy(), 'last_step': self.last_step.copy()}
+
+    def load_state_dict(self, state):
+        self.step = state['step']
+        self.selected = state['selected'].copy()
+        self.last_step = state['last_step'].copy()
+
+class UniformSampler(ClientSampler):
+    def policy(self, k, exclude):
+        if k == 1 and not exclude:
+            # same draw as the original random.choice(range(num_nodes)), so seeded runs are unchanged
+            return [random.choice(range(self.num_nodes))]
+        return random.sample([i for i in range(self.num_nodes) if i not in exclude], k)
+
+class WeightedSampler(ClientSampler):
+    # samples without replacement with probability proportional to weights()
+    def weights(self):
+        raise NotImplementedError
+
+    def policy(self, k, exclude):
+        p = np.asarray(self.weights(), dtype=np.float64).copy()
+        p[list(exclude)] = 0
+        if p.sum() <= 0:
+            p = np.ones(self.num_nodes)
+            p[list(exclude)] = 0
+        return np.random.choice(self.num_nodes, size=k, replace=False, p=p / p.sum()).tolist()
+
+class SizeSampler(WeightedSampler):
+    def __init__(self, num_nodes, sizes, max_staleness=None):
+        super().__init__(num_nodes, max_staleness)
+        self.sizes = np.asarray(sizes, dtype=np.float64)
+
+    def weights(self):
+        return self.sizes
+
+class LossSampler(WeightedSampler):
+    # p_i proportional to (EMA of client i's training loss) ** power, clients not yet seen use the mean of the seen ones
+    def __init__(self, num_nodes, decay=0.9, power=1.0, max_staleness=None):
+        super().__init__(num_nodes, max_staleness)
+        self.decay = decay
+        self.power = power
+        self.losses = np.full(num_nodes, np.nan)
+
+    def update(self, node_id, loss=None):
+        if loss is None:
+            return
+        loss = float(loss)
+        if np.isnan(self.losses[node_id]):
+            self.losses[node_id] = loss
+        else:
+            self.losses[node_id] = self.decay * self.losses[node_id] + (1 - self.decay) * loss
+
+    def weights(self):
+        seen = ~np.isnan(self.losses)
+        if not seen.any():
+            return np.ones(self.num_nodes)
+        losses = np.where(seen, self.losses, self.losses[seen].mean())
+        return np.maximum(losses, 1e-8) ** self.power
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['losses'] = self.losses.copy()
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.losses = state['losses'].copy()
+
+class RoundRobinSampler(ClientSampler):
+    # walks a fresh random permutation of the clients every pass
+    def __init__(self, num_nodes, max_staleness=None):
+        super().__init__(num_nodes, max_staleness)
+        self.order = []
+
+    def policy(self, k, exclude):
+        node_ids = []
+        while len(node_ids) < k:
+            if not self.order:
+                self.order = np.random.permutation(self.num_nodes).tolist()
+            node_id = self.order.pop()
+            if node_id not in exclude and node_id not in node_ids:
+                node_ids.append(node_id)
+        return node_ids
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['order'] = list(self.order)
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.order = list(state['order'])
+
+class StaleFirstSampler(ClientSampler):
+    # the k clients with the oldest context vectors, never-picked ones first and ties broken at random
+    def policy(self, k, exclude):
+        staleness = self.staleness().astype(np.float64) + np.random.rand(self.num_nodes)
+        staleness[list(exclude)] = -np.inf
+        top = np.argpartition(-staleness, k - 1)[:k]
+        return top[np.argsort(-staleness[top])].tolist()
+
+def make_sampler(name, num_nodes, sizes=None, max_staleness=None):
+    if name == 'uniform':
+        return UniformSampler(num_nodes, max_staleness)
+    elif name == 'size':
+        return SizeSampler(num_nodes, sizes, max_staleness)
+    elif name == 'loss':
+        return LossSampler(num_nodes, max_staleness=max_staleness)
+    elif name == 'round_robin':
+        return RoundRobinSampler(num_nodes, max_staleness)
+    elif name == 'stale_first':
+        return StaleFirstSampler(num_nodes, max_staleness)
+    raise ValueError(f"unknown sampler '{name}', expected one of {SAMPLERS}")
+
+def add_sampler_args(parser):
+    parser.add_argument("--sampler", type=str, default="uniform", choices=SAMPLERS, help="client selection policy of the outer loop")
+    parser.add_argument("--max_staleness", type=int, default=None, help="force in any client not picked for this many outer steps")
+    parser.add_argument("--sampler_log_every", type=int, default=100, help="log the sampler counters every X outer steps")
+    return parser